@@ -5,19 +5,117 @@ Binary memcached test client.
 Copyright (c) 2007  Dustin Sallings <dustin@spy.net>
 """
 
+import os
+import re
 import sys
+import json
 import time
+import math
 import hmac
+import bisect
 import socket
+import asyncore
+import hashlib
+import heapq
+import zlib
+import marshal
+import cPickle
 import random
 import struct
+import itertools
+import threading
+import contextlib
 import exceptions
+import collections
 
 from memcacheConstants import REQ_MAGIC_BYTE, RES_MAGIC_BYTE
-from memcacheConstants import REQ_PKT_FMT, RES_PKT_FMT, MIN_RECV_PACKET
-from memcacheConstants import SET_PKT_FMT, DEL_PKT_FMT, INCRDECR_RES_FMT
+from memcacheConstants import REQ_PKT, RES_PKT, MIN_RECV_PACKET
+from memcacheConstants import SET_PKT, INCRDECR_RES
 import memcacheConstants
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class ResponseReader(object):
+    """Buffered reader for binary protocol responses.
+
+    Data is read with recv_into into a reusable bytearray, so a header and a
+    small body usually arrive with a single syscall.  Bodies are handed out
+    as memoryview objects:  small ones are views into the shared buffer and
+    are only valid until the next read, large ones get a buffer of their own
+    that the kernel fills directly."""
+
+    # Size of the shared receive buffer
+    BUFFER_SIZE = 16384
+
+    def __init__(self, sock, beforeRecv=None):
+        self.s=sock
+        # Called before every recv, e.g. to adjust the socket's timeout.
+        self.beforeRecv=beforeRecv
+        self.buf=bytearray(self.BUFFER_SIZE)
+        self.view=memoryview(self.buf)
+        self.start=0
+        self.end=0
+
+    def _recv_into(self, view):
+        if self.beforeRecv is not None:
+            self.beforeRecv()
+        n=self.s.recv_into(view)
+        if n == 0:
+            raise exceptions.EOFError("Got empty data (remote died?).")
+        return n
+
+    def _fill(self, want):
+        """Make sure at least want bytes are buffered."""
+        avail=self.end - self.start
+        if avail >= want:
+            return
+        if self.start + want > len(self.buf):
+            # Move the pending bytes to the front of the buffer.
+            self.buf[0:avail]=self.buf[self.start:self.end]
+            self.start=0
+            self.end=avail
+        while self.end - self.start < want:
+            self.end += self._recv_into(self.view[self.end:])
+
+    def readHeader(self):
+        """Read a response header, returning the unpacked RES_PKT_FMT fields."""
+        self._fill(MIN_RECV_PACKET)
+        rv=RES_PKT.unpack_from(self.buf, self.start)
+        self._consumed(MIN_RECV_PACKET)
+        return rv
+
+    def readBody(self, n):
+        """Read n bytes of body, returning them as a memoryview."""
+        if n <= self.BUFFER_SIZE:
+            self._fill(n)
+            rv=self.view[self.start:self.start + n]
+            self._consumed(n)
+            return rv
+        # Too large for the shared buffer:  give it a buffer of its own,
+        # copy whatever we already have and let recv_into fill in the rest.
+        body=bytearray(n)
+        rv=memoryview(body)
+        got=self.end - self.start
+        rv[:got]=self.view[self.start:self.end]
+        self.start=self.end=0
+        while got < n:
+            got += self._recv_into(rv[got:])
+        return rv
+
+    def hasPacket(self):
+        """Tell whether a whole packet is already buffered."""
+        avail=self.end - self.start
+        return avail >= MIN_RECV_PACKET and avail >= MIN_RECV_PACKET \
+            + RES_PKT.unpack_from(self.buf, self.start)[6]
+
+    def _consumed(self, n):
+        self.start += n
+        if self.start == self.end:
+            self.start=self.end=0
+
 class MemcachedError(exceptions.Exception):
     """Error raised when a command fails."""
 
@@ -32,70 +130,1022 @@ class MemcachedError(exceptions.Exception):
     def __repr__(self):
         return "<MemcachedError #%d ``%s''>" % (self.status, self.msg)
 
+class LazySequence(object):
+    """A read-only sequence whose items are computed when accessed."""
+
+    def __init__(self, length, getter):
+        self.length=length
+        self.getter=getter
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.getter(j) for j in xrange(*i.indices(self.length))]
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError(i)
+        return self.getter(i)
+
+    def __iter__(self):
+        for i in xrange(self.length):
+            yield self.getter(i)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "<LazySequence of %d>" % self.length
+
+class ElementView(object):
+    """Lazily decoded elements of a collection get response.
+
+    The raw response is kept and an element is only decoded when it's
+    indexed or iterated.  bkeys (b+trees only), lengths, values and views
+    are sequences decoded on demand; views gives each value as a memoryview
+    of the response, so large values are never copied unless asked for
+    through values.  Indexing the view itself gives values, or (bkey,
+    value) pairs for a b+tree.  decoder, given the collection flags, returns
+    the flags to report and a function decoding elements on their way to
+    values, or None; lengths and views always stay as stored."""
+
+    def __init__(self, data, hasBKeys, decoder=None):
+        if len(data) <= ResponseReader.BUFFER_SIZE:
+            # Small bodies are views of the reader's shared buffer.
+            data=memoryview(bytearray(data))
+        self.data=data
+        self.flags, self.count=\
+            memcacheConstants.COLL_GET_RES.unpack_from(data, 0)
+        self.lengthsOffset=8
+        self.bkeys=None
+        if hasBKeys:
+            self.lengthsOffset += 8 * self.count
+            self.bkeys=LazySequence(self.count, self.__bkey)
+        self.offsets=None
+        self.lengths=LazySequence(self.count, self.__length)
+        self.views=LazySequence(self.count, self.__view)
+        decode=None
+        if decoder is not None:
+            self.flags, decode=decoder(self.flags)
+        if decode is None:
+            self.values=LazySequence(self.count,
+                                     lambda i: self.__view(i).tobytes())
+        else:
+            self.values=LazySequence(self.count,
+                                     lambda i: decode(self.__view(i).tobytes()))
+
+    def __bkey(self, i):
+        return memcacheConstants.BKEY_RES.unpack_from(self.data, 8 + 8 * i)[0]
+
+    def __length(self, i):
+        return memcacheConstants.VLENG_RES.unpack_from(
+            self.data, self.lengthsOffset + 4 * i)[0]
+
+    def __view(self, i):
+        if self.offsets is None:
+            # Value offsets are a running sum of the lengths.
+            pos=self.lengthsOffset + 4 * self.count
+            offsets=[pos]
+            for n in struct.unpack_from('>%dL' % self.count, self.data,
+                                        self.lengthsOffset):
+                pos += n
+                offsets.append(pos)
+            self.offsets=offsets
+        return self.data[self.offsets[i]:self.offsets[i + 1]]
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if self.bkeys is None:
+            return self.values[i]
+        if isinstance(i, slice):
+            return zip(self.bkeys[i], self.values[i])
+        return self.bkeys[i], self.values[i]
+
+    def __iter__(self):
+        for i in xrange(self.count):
+            yield self[i]
+
+# The attributes of an item, as returned by getattrs.
+CollectionAttributes=collections.namedtuple('CollectionAttributes',
+    'flags exptime count maxcount maxbkeyrange type ovflaction')
+
+class PoolTimeoutError(exceptions.Exception):
+    """Error raised when no pooled connection became available in time."""
+
+class TimeoutError(socket.timeout):
+    """Error raised when a server didn't answer in time.
+
+    The connection is dropped, since the response may still arrive."""
+
+class ServerDownError(socket.error):
+    """Error raised instead of contacting a server marked down."""
+
+class Compressor(object):
+    """Compression of values of at least threshold bytes.
+
+        mc.compressor=Compressor(threshold=1024)
+
+    compress and decompress default to zlib's.  A value that doesn't shrink
+    is stored as it is.  Compressed items are marked with FLAG_COMPRESSED,
+    which reads strip again, so callers never see it; the client rejects
+    caller flags using that bit.  Clients without a compressor treat it as
+    an ordinary flag and get the stored bytes.  append and prepend
+    refuse to work on a client with a compressor.  With collections,
+    lists and b+trees created through the client are marked too and each
+    of their elements carries a header byte saying whether it's compressed;
+    such a client must only insert into collections it created.  A
+    Compressor may be shared by several clients."""
+
+    def __init__(self, threshold=1024, compress=None, decompress=None,
+                 level=6, collections=False):
+        self.threshold=threshold
+        self.compress=compress or (lambda data: zlib.compress(data, level))
+        self.decompress=decompress or zlib.decompress
+        self.collections=collections
+        self.lock=threading.Lock()
+        self.compressed=0
+        self.skipped=0
+        self.bytesIn=0
+        self.bytesOut=0
+
+    def encode(self, value):
+        """Returns (whether value got compressed, the bytes to store)."""
+        if len(value) < self.threshold:
+            return False, value
+        data=self.compress(value)
+        with self.lock:
+            if len(data) >= len(value):
+                self.skipped += 1
+                return False, value
+            self.compressed += 1
+            self.bytesIn += len(value)
+            self.bytesOut += len(data)
+        return True, data
+
+    def stats(self):
+        with self.lock:
+            return {'compressed': self.compressed, 'skipped': self.skipped,
+                    'bytes_in': self.bytesIn, 'bytes_out': self.bytesOut,
+                    'bytes_saved': self.bytesIn - self.bytesOut}
+
+class Serializer(object):
+    """A registry of codecs storing values of any type, tagged in the flags.
+
+        mc.serializer=Serializer()
+        mc.set('n', 0, 0, 42)
+        mc.get('n')  # (0, cas, 42)
+
+    str values are stored as they are, and ints and longs as their decimal
+    digits (so incr and decr still work on them), without any codec call.
+    unicode is stored as UTF-8 and any other type goes through the fallback
+    codec, pickle unless it's TYPE_MARSHAL.  register adds codecs for more
+    types.  The tag lives in the FLAG_TYPE_MASK bits of the flags, which
+    reads strip again; the client rejects caller flags using those bits or
+    FLAG_COMPRESSED.  append and prepend refuse to work on a client with
+    a serializer.  With collections, lists, sets and b+trees created
+    through the client are marked TYPE_TAGGED and each of their elements
+    starts with its tag byte; such a client must only insert into
+    collections it created.  Reads only decode when the client has a
+    serializer."""
+
+    def __init__(self, fallback=memcacheConstants.TYPE_PICKLE, collections=False):
+        self.fallback=fallback
+        self.collections=collections
+        # type -> (tag, encode)
+        self.encoders={
+            unicode: (memcacheConstants.TYPE_UNICODE,
+                      lambda v: v.encode('utf-8'))}
+        # tag -> decode
+        self.decoders={
+            memcacheConstants.TYPE_INT: int,
+            memcacheConstants.TYPE_UNICODE: lambda data: data.decode('utf-8'),
+            memcacheConstants.TYPE_MARSHAL: marshal.loads,
+            memcacheConstants.TYPE_PICKLE: cPickle.loads}
+        self.fallbacks={
+            memcacheConstants.TYPE_MARSHAL: marshal.dumps,
+            memcacheConstants.TYPE_PICKLE:
+                lambda v: cPickle.dumps(v, cPickle.HIGHEST_PROTOCOL)}
+
+    def register(self, type, tag, encode, decode):
+        """Store values of exactly type with encode, tagged with tag."""
+        assert 0 < tag < memcacheConstants.TYPE_TAGGED, "bad tag %d" % tag
+        self.encoders[type]=(tag, encode)
+        self.decoders[tag]=decode
+
+    def encode(self, value):
+        """Returns (type tag, the bytes to store)."""
+        t=type(value)
+        if t is str:
+            return memcacheConstants.TYPE_BYTES, value
+        if t is int or t is long:
+            return memcacheConstants.TYPE_INT, str(value)
+        e=self.encoders.get(t)
+        if e is None:
+            return self.fallback, self.fallbacks[self.fallback](value)
+        return e[0], e[1](value)
+
+    def decode(self, tag, data):
+        if tag == memcacheConstants.TYPE_BYTES:
+            return data
+        return self.decoders[tag](data)
+
+class NearCache(object):
+    """An in-process LRU cache of (flags, cas, value) get results.
+
+        mc.nearCache=NearCache(maxentries=1000, ttl=0.5)
+
+    The cache is bounded by both its number of entries and the total size
+    of their values.  An entry is fresh for at most ttl seconds, or less if
+    the item is known to expire sooner.  A stale entry is kept until the key
+    is fetched again; if the refetched CAS is unchanged the cached value is
+    handed out again, which is counted but saves no traffic.  Local
+    mutations invalidate their key.  A NearCache may be shared by several
+    clients of the same server."""
+
+    # memcached treats expirations beyond 30 days as absolute unix times.
+    MAX_RELATIVE_EXP = 30 * 24 * 3600
+
+    def __init__(self, maxentries=10000, maxbytes=16 * 1024 * 1024, ttl=1.0):
+        self.maxentries=maxentries
+        self.maxbytes=maxbytes
+        self.ttl=ttl
+        self.lock=threading.Lock()
+        # key -> [fresh until, (flags, cas, value), size, expiry]
+        self.entries=collections.OrderedDict()
+        # key -> expiry of items mutated locally but not cached yet
+        self.expiries=collections.OrderedDict()
+        self.bytes=0
+        self.hits=0
+        self.misses=0
+        self.evictions=0
+        self.invalidations=0
+        self.unchanged=0
+
+    def get(self, key):
+        """Get the fresh cached (flags, cas, value) of a key, or None."""
+        with self.lock:
+            e=self.entries.get(key)
+            if e is None or e[0] <= time.time():
+                self.misses += 1
+                return None
+            # Move it to the most recently used end.
+            del self.entries[key]
+            self.entries[key]=e
+            self.hits += 1
+            return e[1]
+
+    def put(self, key, value, size):
+        """Cache the (flags, cas, value) just fetched for a key.
+
+        size is the length of the value as it came over the wire, before
+        any decoding.  Returns the value to hand out, which is the cached
+        one if its CAS is unchanged."""
+        with self.lock:
+            expiry=self.expiries.pop(key, None)
+            e=self.entries.pop(key, None)
+            if e is not None:
+                self.bytes -= e[2]
+                expiry=e[3]
+                if e[1][1] == value[1]:
+                    value=e[1]
+                    self.unchanged += 1
+            if size <= self.maxbytes:
+                fresh=time.time() + self.ttl
+                if expiry:
+                    fresh=min(fresh, expiry)
+                self.entries[key]=[fresh, value, size, expiry]
+                self.bytes += size
+                self._evict()
+            return value
+
+    def invalidate(self, key, exp=0):
+        """Forget the cached value of a key.
+
+        exp is the item's new expiration, if known; it caps how long the
+        next value fetched for the key is cached.  Up to maxentries of them
+        are remembered apart from the entries."""
+        with self.lock:
+            e=self.entries.pop(key, None)
+            if e is not None:
+                self.bytes -= e[2]
+                self.invalidations += 1
+            self.expiries.pop(key, None)
+            if exp:
+                if exp <= self.MAX_RELATIVE_EXP:
+                    exp += time.time()
+                self.expiries[key]=exp
+                if len(self.expiries) > self.maxentries:
+                    self.expiries.popitem(last=False)
+
+    def clear(self):
+        """Forget everything."""
+        with self.lock:
+            self.entries.clear()
+            self.expiries.clear()
+            self.bytes=0
+
+    def _evict(self):
+        while len(self.entries) > self.maxentries or self.bytes > self.maxbytes:
+            key, e=self.entries.popitem(last=False)
+            self.bytes -= e[2]
+            self.evictions += 1
+
+    def stats(self):
+        """Get a dict of the cache's size and counters."""
+        with self.lock:
+            return {'entries': len(self.entries),
+                    'bytes': self.bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations,
+                    'unchanged': self.unchanged}
+
+class AttributeCache(object):
+    """A short-lived cache of the CollectionAttributes of items.
+
+        mc.attrCache=AttributeCache(ttl=0.1)
+
+    Cached attributes are used by getattr and getattrs for at most ttl
+    seconds, and are dropped by setattr or any other local command changing
+    the item.  The oldest entries are evicted beyond maxentries."""
+
+    def __init__(self, maxentries=10000, ttl=0.1):
+        self.maxentries=maxentries
+        self.ttl=ttl
+        self.lock=threading.Lock()
+        # key -> (fresh until, CollectionAttributes)
+        self.entries=collections.OrderedDict()
+        self.hits=0
+        self.misses=0
+
+    def get(self, key):
+        """Get the fresh cached attributes of a key, or None."""
+        with self.lock:
+            e=self.entries.get(key)
+            if e is None or e[0] <= time.time():
+                self.misses += 1
+                return None
+            self.hits += 1
+            return e[1]
+
+    def put(self, key, attrs):
+        """Cache the attributes just fetched for a key, and return them."""
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key]=(time.time() + self.ttl, attrs)
+            while len(self.entries) > self.maxentries:
+                self.entries.popitem(last=False)
+            return attrs
+
+    def invalidate(self, key):
+        """Forget the cached attributes of a key."""
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        """Forget everything."""
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """Get a dict of the cache's size and counters."""
+        with self.lock:
+            return {'entries': len(self.entries),
+                    'hits': self.hits,
+                    'misses': self.misses}
+
+class LatencyHistogram(object):
+    """A log-bucketed histogram of latencies, in the style of HDR histograms.
+
+    Latencies are counted in microseconds, exactly below 2**SUB_BITS and in
+    2**SUB_BITS buckets per power of two above that, so any percentile is
+    within about 1/2**SUB_BITS of the true value while the histogram stays a
+    few hundred buckets at most."""
+
+    SUB_BITS = 5
+
+    def __init__(self):
+        self.counts={}
+        self.count=0
+        self.total=0.0
+        self.min=None
+        self.max=None
+
+    def bucketOf(self, usec):
+        sub=1 << self.SUB_BITS
+        if usec < 2 * sub:
+            return usec
+        shift=usec.bit_length() - self.SUB_BITS - 1
+        return (shift + 1) * sub + (usec >> shift) - sub
+
+    def bucketRange(self, i):
+        """The [low, high) microseconds counted by bucket i."""
+        sub=1 << self.SUB_BITS
+        if i < 2 * sub:
+            return i, i + 1
+        shift=i // sub - 1
+        m=i % sub + sub
+        return m << shift, (m + 1) << shift
+
+    def record(self, seconds):
+        i=self.bucketOf(max(0, int(seconds * 1000000)))
+        self.counts[i]=self.counts.get(i, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min=seconds
+        if self.max is None or seconds > self.max:
+            self.max=seconds
+
+    def percentile(self, p):
+        """The latency in seconds that p percent of the records are within."""
+        if not self.count:
+            return None
+        want=max(1, int(math.ceil(self.count * p / 100.0)))
+        seen=0
+        for i in sorted(self.counts):
+            seen += self.counts[i]
+            if seen >= want:
+                # The highest value the bucket stands for, but no more
+                # than was actually seen.
+                return min(self.max, (self.bucketRange(i)[1] - 1) / 1e6)
+
+    def snapshot(self, percentiles=(50, 90, 99, 99.9)):
+        """Get a dict of the histogram's count, extremes and percentiles."""
+        rv={'count': self.count, 'min': self.min, 'max': self.max,
+            'mean': self.count and self.total / self.count or None}
+        for p in percentiles:
+            rv['p%s' % p]=self.percentile(p)
+        return rv
+
+class ClientStats(object):
+    """Latency, traffic and error counts recorded by instrumented clients.
+
+        stats=mc.enableStats()
+        ...
+        print stats.snapshot()['latency']['CMD_GET']['p99']
+
+    Latency histograms are kept per opcode of every single-response
+    command.  Bytes sent and received and error statuses are counted for
+    all traffic, including pipelines and multi-key commands.  A ClientStats
+    may be shared by several clients, such as those of a pool."""
+
+    def __init__(self):
+        self.lock=threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget everything recorded so far."""
+        with self.lock:
+            # opcode -> LatencyHistogram
+            self.latency={}
+            self.bytesSent=0
+            self.bytesReceived=0
+            # status -> count
+            self.errors={}
+
+    def recordLatency(self, cmd, seconds):
+        with self.lock:
+            h=self.latency.get(cmd)
+            if h is None:
+                h=self.latency[cmd]=LatencyHistogram()
+            h.record(seconds)
+
+    def recordSent(self, n):
+        with self.lock:
+            self.bytesSent += n
+
+    def recordReceived(self, n, status):
+        with self.lock:
+            self.bytesReceived += n
+            if status:
+                self.errors[status]=self.errors.get(status, 0) + 1
+
+    def percentiles(self, percentiles=(50, 90, 99, 99.9)):
+        """Get {command name: {percentile: seconds}} for every opcode seen."""
+        with self.lock:
+            return dict((memcacheConstants.COMMAND_NAMES.get(cmd, cmd),
+                         dict((p, h.percentile(p)) for p in percentiles))
+                        for cmd, h in self.latency.iteritems())
+
+    def snapshot(self):
+        """Get a dict of everything recorded, with commands by name."""
+        with self.lock:
+            return {'latency': dict(
+                        (memcacheConstants.COMMAND_NAMES.get(cmd, cmd),
+                         h.snapshot()) for cmd, h in self.latency.iteritems()),
+                    'bytes_sent': self.bytesSent,
+                    'bytes_received': self.bytesReceived,
+                    'errors': dict(self.errors)}
+
+class _StatsMixin(object):
+    """Records the commands of a MemcachedClient into its clientStats."""
+
+    def _doCmd(self, cmd, key, val, extraHeader='', cas=0, parse=None):
+        start=time.time()
+        try:
+            return super(_StatsMixin, self)._doCmd(cmd, key, val, extraHeader,
+                                                   cas, parse)
+        finally:
+            self.clientStats.recordLatency(cmd, time.time() - start)
+
+    def _doCmdView(self, cmd, key, val, extraHeader='', cas=0, parse=None):
+        start=time.time()
+        try:
+            return super(_StatsMixin, self)._doCmdView(cmd, key, val,
+                                                       extraHeader, cas, parse)
+        finally:
+            self.clientStats.recordLatency(cmd, time.time() - start)
+
+    def _send(self, data):
+        super(_StatsMixin, self)._send(data)
+        self.clientStats.recordSent(len(data))
+
+    def _readResponse(self):
+        rv=super(_StatsMixin, self)._readResponse()
+        self.clientStats.recordReceived(MIN_RECV_PACKET + len(rv[-1]), rv[1])
+        return rv
+
+class _AsyncStatsMixin(object):
+    """Records the commands of an AsyncMemcachedClient into its
+    clientStats, timing each from its request to its response."""
+
+    def _send(self, cmd, key, val, extraHeader, cas, handler):
+        stats=self.clientStats
+        start=time.time()
+        def f(errcode, opaque, cas, body):
+            stats.recordLatency(cmd, time.time() - start)
+            if errcode is not None:
+                stats.recordReceived(MIN_RECV_PACKET + len(body), errcode)
+            handler(errcode, opaque, cas, body)
+        super(_AsyncStatsMixin, self)._send(cmd, key, val, extraHeader, cas, f)
+        stats.recordSent(MIN_RECV_PACKET + len(extraHeader) + len(key)
+                         + len(val))
+
+# Client classes to their instrumented subclass
+_instrumentedClasses={}
+
+def _instrumented(cls):
+    """Get a subclass of the given client class recording into clientStats.
+
+    The recording is done by the class's _statsMixin.  Instrumenting a
+    client swaps its class for this one, so clients that aren't
+    instrumented don't pay anything for it."""
+    if cls not in _instrumentedClasses:
+        _instrumentedClasses[cls]=type('Instrumented' + cls.__name__,
+                                       (cls._statsMixin, cls), {})
+    return _instrumentedClasses[cls]
+
 class MemcachedClient(object):
     """Simple memcached client."""
 
     vbucketId = 0
-
-    def __init__(self, host='127.0.0.1', port=11211):
-        self.s=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.s.connect_ex((host, port))
+    # When set, requests are stamped with the vbucket of their key instead.
+    vbucketMap = None
+    # Cleared once the server turns out not to know CMD_SOP_EXIST_MULTI.
+    sopExistMulti = True
+    # An optional NearCache consulted by get and getMulti.
+    nearCache = None
+    # An optional AttributeCache consulted by getattr and getattrs.
+    attrCache = None
+    # Values at least this large are sent on their own, without a copy.
+    SEPARATE_VALUE_SIZE = 16384
+    # Quiet multi commands are sent in chunks of half this many, with at
+    # most two chunks outstanding.
+    quietWindow = 1024
+    # Batches are encoded into a send buffer kept by the client, which grows
+    # up to this size; larger batches get a buffer of their own.
+    MAX_SEND_BUFFER = 1024 * 1024
+    # After this many consecutive failures the server is marked down for
+    # backoff seconds, doubling with every further failure up to maxBackoff.
+    failureThreshold = 3
+    backoff = 0.1
+    maxBackoff = 10.0
+    # (mechanism, args) of the last successful SASL auth, replayed when
+    # reconnecting.
+    credentials = None
+    # The ClientStats being recorded into, set by enableStats.
+    clientStats = None
+    # What records into it, see _instrumented.
+    _statsMixin = _StatsMixin
+    # An optional Compressor applied to stored values.
+    compressor = None
+    # An optional Serializer for values that aren't strs.
+    serializer = None
+
+    def __init__(self, host='127.0.0.1', port=11211, timeout=None):
+        """Connect to a server.
+
+        timeout bounds every wait for the server (connecting, sending or
+        receiving) unless it's None.  A failed connection is retried by the
+        next command, until the server is marked down."""
+        self.host=host
+        self.port=port
+        self.timeout=timeout
         self.r=random.Random()
+        self.s=None
+        self.reader=None
+        self.wbuf=bytearray(ResponseReader.BUFFER_SIZE)
+        # Absolute time set by deadline()
+        self.deadlineAt=None
+        self.failures=0
+        self.downUntil=0
+        self.lastError=None
+        try:
+            self._connect()
+        except socket.error:
+            pass
 
     def close(self):
-        self.s.close()
+        if self.s is not None:
+            self.s.close()
+            self.s=None
+            self.reader=None
+
+    def _waitTime(self):
+        """How long the next socket operation may block, None for ever."""
+        t=self.timeout
+        if self.deadlineAt is not None:
+            left=self.deadlineAt - time.time()
+            if left <= 0:
+                raise TimeoutError("Deadline passed.")
+            if t is None or left < t:
+                t=left
+        return t
+
+    def _beforeRecv(self):
+        if self.deadlineAt is not None:
+            self.s.settimeout(self._waitTime())
+
+    def _connect(self):
+        if time.time() < self.downUntil:
+            raise ServerDownError("%s:%d is down after %d failures (%s)" % (
+                self.host, self.port, self.failures, self.lastError))
+        s=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Requests may go out in more than one send.
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            s.settimeout(self._waitTime())
+            s.connect((self.host, self.port))
+            s.settimeout(self.timeout)
+        except socket.error, e:
+            s.close()
+            raise self._failed(e)
+        self.s=s
+        self.reader=ResponseReader(s, self._beforeRecv)
+        if self.credentials is not None:
+            mech, args=self.credentials
+            if mech == 'PLAIN':
+                self.sasl_auth_plain(*args)
+            else:
+                self.sasl_auth_cram_md5(*args)
+
+    def _failed(self, e):
+        """Drop the connection after an I/O error.
+
+        Returns the exception to raise for it."""
+        self.close()
+        self.failures += 1
+        self.lastError=e
+        if self.failures >= self.failureThreshold:
+            delay=min(self.maxBackoff, self.backoff
+                      * 2 ** (self.failures - self.failureThreshold))
+            # Jitter keeps clients from all coming back at once.
+            self.downUntil=time.time() + delay * (0.5 + self.r.random() / 2)
+        if isinstance(e, socket.timeout) and not isinstance(e, TimeoutError):
+            e=TimeoutError("Timed out talking to %s:%d" % (self.host,
+                                                           self.port))
+        return e
+
+    def enableStats(self, stats=None):
+        """Start recording latencies, traffic and errors.
+
+        Records into the given ClientStats, or a new one, which is
+        returned."""
+        if self.clientStats is None:
+            self.__class__=_instrumented(self.__class__)
+        self.clientStats=stats or ClientStats()
+        return self.clientStats
+
+    def disableStats(self):
+        """Stop recording; the ClientStats is left as it was."""
+        if self.clientStats is not None:
+            self.__class__=self.__class__.__bases__[-1]
+            del self.clientStats
+
+    @contextlib.contextmanager
+    def deadline(self, seconds):
+        """Bound everything done within the with block to seconds in total.
+
+            with mc.deadline(0.05):
+                mc.get('a')
+
+        A TimeoutError is raised once it passes.  Nested deadlines can only
+        shorten the outer one."""
+        outer=self.deadlineAt
+        self.deadlineAt=time.time() + seconds
+        if outer is not None:
+            self.deadlineAt=min(self.deadlineAt, outer)
+        try:
+            yield self
+        finally:
+            self.deadlineAt=outer
+            if self.s is not None:
+                self.s.settimeout(self.timeout)
+
+    @contextlib.contextmanager
+    def serializing(self, serializer):
+        """Use serializer for everything done within the with block.
+
+            with mc.serializing(Serializer(memcacheConstants.TYPE_MARSHAL)):
+                mc.set('a', 0, 0, {'x': 1})
+        """
+        outer=self.serializer
+        self.serializer=serializer
+        try:
+            yield self
+        finally:
+            self.serializer=outer
+
+    def _send(self, data):
+        if self.s is None:
+            self._connect()
+        try:
+            if self.deadlineAt is not None:
+                self.s.settimeout(self._waitTime())
+            self.s.sendall(data)
+        except socket.error, e:
+            raise self._failed(e)
 
     def __del__(self):
         self.close()
 
-    def _sendCmd(self, cmd, key, val, opaque, extraHeader='', cas=0):
+    def _vbucketOf(self, key):
+        if self.vbucketMap is not None:
+            return self.vbucketMap.vbucketOf(key)
+        return self.vbucketId
+
+    def _encodeHeader(self, cmd, key, vallen, opaque, extraHeader='', cas=0):
+        """Encode a request with a vallen byte value, up to the value."""
         dtype=0
-        msg=struct.pack(REQ_PKT_FMT, REQ_MAGIC_BYTE,
-            cmd, len(key), len(extraHeader), dtype, self.vbucketId,
-                len(key) + len(extraHeader) + len(val), opaque, cas)
-        self.s.send(msg + extraHeader + key + val)
+        msg=REQ_PKT.pack(REQ_MAGIC_BYTE,
+            cmd, len(key), len(extraHeader), dtype, self._vbucketOf(key),
+                len(key) + len(extraHeader) + vallen, opaque, cas)
+        return msg + extraHeader + key
+
+    def _encodeCmd(self, cmd, key, val, opaque, extraHeader='', cas=0):
+        return self._encodeHeader(cmd, key, len(val), opaque, extraHeader,
+                                  cas) + val
+
+    def _encodeCmds(self, msgs):
+        """Encode a batch of requests into a single buffer.
+
+        msgs is a list of (cmd, key, val, opaque, extraHeader, cas) tuples.
+        Every request is packed in place, so each value is copied once.
+        Returns a memoryview of the client's send buffer, which is only
+        valid until the next batch is encoded."""
+        size=0
+        for cmd, key, val, opaque, extraHeader, cas in msgs:
+            size += MIN_RECV_PACKET + len(extraHeader) + len(key) + len(val)
+        buf=self.wbuf
+        if size > len(buf):
+            buf=bytearray(max(size, 2 * len(buf)))
+            if len(buf) <= self.MAX_SEND_BUFFER:
+                self.wbuf=buf
+        pos=0
+        for cmd, key, val, opaque, extraHeader, cas in msgs:
+            bodylen=len(extraHeader) + len(key) + len(val)
+            REQ_PKT.pack_into(buf, pos, REQ_MAGIC_BYTE, cmd, len(key),
+                              len(extraHeader), 0, self._vbucketOf(key),
+                              bodylen, opaque, cas)
+            pos += MIN_RECV_PACKET
+            for part in (extraHeader, key, val):
+                buf[pos:pos + len(part)]=part
+                pos += len(part)
+        return memoryview(buf)[:size]
 
-    def _handleKeyedResponse(self, myopaque):
-        response = ""
-        while len(response) < MIN_RECV_PACKET:
-            data = self.s.recv(MIN_RECV_PACKET - len(response))
-            if data == '':
-                raise exceptions.EOFError("Got empty data (remote died?).")
-            response += data
-        assert len(response) == MIN_RECV_PACKET
-        magic, cmd, keylen, extralen, dtype, errcode, remaining, opaque, cas=\
-            struct.unpack(RES_PKT_FMT, response)
-
-        rv = ""
-        while remaining > 0:
-            data = self.s.recv(remaining)
-            if data == '':
-                raise exceptions.EOFError("Got empty data (remote died?).")
-            rv += data
-            remaining -= len(data)
+    def _sendCmd(self, cmd, key, val, opaque, extraHeader='', cas=0):
+        if len(val) < self.SEPARATE_VALUE_SIZE:
+            self._send(self._encodeCmd(cmd, key, val, opaque, extraHeader,
+                                       cas))
+        else:
+            # Send large values as they are rather than copying them in
+            # behind the header.
+            self._send(self._encodeHeader(cmd, key, len(val), opaque,
+                                          extraHeader, cas))
+            self._send(val)
 
+    def _readResponse(self):
+        """Read the next response without looking at its status.
+
+        Returns (cmd, errcode, opaque, cas, keylen, extralen, body) where body
+        is a memoryview that is only valid until the next response is read."""
+        try:
+            magic, cmd, keylen, extralen, dtype, errcode, remaining, opaque, \
+                cas=self.reader.readHeader()
+            body=self.reader.readBody(remaining)
+        except (socket.error, exceptions.EOFError), e:
+            raise self._failed(e)
         assert (magic in (RES_MAGIC_BYTE, REQ_MAGIC_BYTE)), "Got magic: %d" % magic
+        self.failures=0
+        return cmd, errcode, opaque, cas, keylen, extralen, body
+
+    def _recvResponse(self, myopaque):
+        """Read the next response, returning its body as a memoryview.
+
+        The body is only valid until the next response is read."""
+        cmd, errcode, opaque, cas, keylen, extralen, rv=self._readResponse()
         assert myopaque is None or opaque == myopaque, \
             "expected opaque %x, got %x" % (myopaque, opaque)
         if errcode != 0:
-            raise MemcachedError(errcode,  rv)
+            raise MemcachedError(errcode,  rv.tobytes())
         return cmd, opaque, cas, keylen, extralen, rv
 
+    def _handleKeyedResponse(self, myopaque):
+        cmd, opaque, cas, keylen, extralen, rv = self._recvResponse(myopaque)
+        return cmd, opaque, cas, keylen, extralen, rv.tobytes()
+
     def _handleSingleResponse(self, myopaque):
         cmd, opaque, cas, keylen, extralen, data = self._handleKeyedResponse(myopaque)
         return opaque, cas, data
 
-    def _doCmd(self, cmd, key, val, extraHeader='', cas=0):
-        """Send a command and await its response."""
+    def _doCmd(self, cmd, key, val, extraHeader='', cas=0, parse=None):
+        """Send a command and await its response.
+
+        If given, parse is applied to the (opaque, cas, data) response."""
+        opaque=self.r.randint(0, 2**32)
+        self._sendCmd(cmd, key, val, opaque, extraHeader, cas)
+        rv=self._handleSingleResponse(opaque)
+        if parse:
+            rv=parse(rv)
+        return rv
+
+    def _doCmdView(self, cmd, key, val, extraHeader='', cas=0, parse=None):
+        """Send a command and return its response body as a memoryview.
+
+        If given, parse is applied to the body before it's returned."""
         opaque=self.r.randint(0, 2**32)
         self._sendCmd(cmd, key, val, opaque, extraHeader, cas)
-        return self._handleSingleResponse(opaque)
+        rv=self._recvResponse(opaque)[-1]
+        if parse:
+            rv=parse(rv)
+        return rv
+
+    def _pipelined(self, requests, window=None):
+        """Send a batch of requests without waiting for each response.
+
+        requests is a sequence of (cmd, key, val, extraHeader, cas, handler)
+        tuples, where handler is called with the (opaque, cas, body) of a
+        successful response.  At most window requests are in flight at any
+        time (all of them if window is None).
+
+        Returns a list holding, in request order, either the handler's
+        result or the MemcachedError the request failed with.  If a handler
+        raises, every response is still read before the first such
+        exception is raised again."""
+        n=len(requests)
+        rv=[None] * n
+        window=window or n
+        base=self.r.randint(0, 2**32)
+        inflight={}
+        sent=0
+        errors=[]
+        while sent < n or inflight:
+            if sent < n and len(inflight) <= window // 2:
+                msgs=[]
+                for i in xrange(sent, min(n, sent + window - len(inflight))):
+                    cmd, key, val, extraHeader, cas, handler=requests[i]
+                    opaque=(base + i) & 0xffffffff
+                    inflight[opaque]=i
+                    msgs.append((cmd, key, val, opaque, extraHeader, cas))
+                self._send(self._encodeCmds(msgs))
+                sent += len(msgs)
+            cmd, errcode, opaque, cas, keylen, extralen, body=\
+                self._readResponse()
+            assert opaque in inflight, "unexpected opaque %x" % opaque
+            i=inflight.pop(opaque)
+            if errcode != 0:
+                rv[i]=MemcachedError(errcode, body.tobytes())
+            elif not errors:
+                try:
+                    rv[i]=requests[i][-1](opaque, cas, body)
+                except:
+                    # Keep the connection in step with the requests.
+                    errors.append(sys.exc_info())
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return rv
+
+    def pipeline(self, window=None):
+        """Get a Pipeline that batches commands over this connection."""
+        return Pipeline(self, window)
+
+    def _invalidate(self, key, exp=0):
+        if self.nearCache is not None:
+            self.nearCache.invalidate(key, exp)
+        if self.attrCache is not None:
+            self.attrCache.invalidate(key)
 
     def _mutate(self, cmd, key, exp, flags, cas, val):
-        return self._doCmd(cmd, key, val, struct.pack(SET_PKT_FMT, flags, exp),
+        self._invalidate(key, exp)
+        if self.serializer is not None or self.compressor is not None:
+            flags, val=self._encodeValue(flags, val)
+        return self._doCmd(cmd, key, val, SET_PKT.pack(flags, exp),
             cas)
 
+    def _encodeValue(self, flags, val):
+        """Serialize then compress val, marking both in flags."""
+        self._checkFlags(flags)
+        if self.serializer is not None and type(val) is not str:
+            tag, val=self.serializer.encode(val)
+            flags |= tag << memcacheConstants.FLAG_TYPE_SHIFT
+        if self.compressor is not None:
+            compressed, val=self.compressor.encode(val)
+            if compressed:
+                flags |= memcacheConstants.FLAG_COMPRESSED
+        return flags, val
+
+    def _checkFlags(self, flags):
+        """Refuse caller flags using bits reads on this client interpret."""
+        reserved=0
+        if self.serializer is not None:
+            reserved |= (memcacheConstants.FLAG_TYPE_MASK
+                         | memcacheConstants.FLAG_COMPRESSED)
+        if self.compressor is not None:
+            reserved |= memcacheConstants.FLAG_COMPRESSED
+        if flags & reserved:
+            raise exceptions.ValueError(
+                "Flags 0x%x use bits 0x%x reserved by the client's "
+                "serializer or compressor." % (flags, flags & reserved))
+
+    def _collectionFlags(self, flags, compress=True):
+        """The flags to create a collection with."""
+        self._checkFlags(flags)
+        if self.serializer is not None and self.serializer.collections:
+            flags |= (memcacheConstants.TYPE_TAGGED
+                      << memcacheConstants.FLAG_TYPE_SHIFT)
+        if compress and self.compressor is not None and self.compressor.collections:
+            flags |= memcacheConstants.FLAG_COMPRESSED
+        return flags
+
+    def _encodeElement(self, val, compress=True):
+        """Serialize then compress a collection element, each behind a
+        header byte."""
+        if self.serializer is not None and self.serializer.collections:
+            tag, val=self.serializer.encode(val)
+            val=chr(tag) + val
+        if not compress or self.compressor is None or not self.compressor.collections:
+            return val
+        compressed, val=self.compressor.encode(val)
+        if compressed:
+            return memcacheConstants.ELEM_COMPRESSED + val
+        return memcacheConstants.ELEM_RAW + val
+
+    def _decompressElement(self, data):
+        if data[:1] == memcacheConstants.ELEM_COMPRESSED:
+            return self.compressor.decompress(data[1:])
+        return data[1:]
+
+    def _deserializeElement(self, data):
+        return self.serializer.decode(ord(data[0]), data[1:])
+
+    def _elementDecoder(self, flags):
+        """Returns the flags to report for a collection and the function
+        decoding its elements, or None if they're returned as stored."""
+        decoders=[]
+        if self.compressor is not None and flags & memcacheConstants.FLAG_COMPRESSED:
+            flags &= ~memcacheConstants.FLAG_COMPRESSED
+            decoders.append(self._decompressElement)
+        if (self.serializer is not None and
+            flags & memcacheConstants.FLAG_TYPE_MASK ==
+                memcacheConstants.TYPE_TAGGED << memcacheConstants.FLAG_TYPE_SHIFT):
+            flags &= ~memcacheConstants.FLAG_TYPE_MASK
+            decoders.append(self._deserializeElement)
+        if len(decoders) == 2:
+            return flags, lambda data: decoders[1](decoders[0](data))
+        return flags, decoders and decoders[0] or None
+
+    def _decodeElements(self, flags, vals):
+        flags, decode=self._elementDecoder(flags)
+        if decode is not None:
+            vals=[decode(v) for v in vals]
+        return flags, vals
+
     def _cat(self, cmd, key, cas, val):
+        if self.compressor is not None or self.serializer is not None:
+            # The stored value may be compressed or serialized, and raw
+            # bytes added to it would corrupt it.
+            raise exceptions.NotImplementedError(
+                "Not available with a compressor or serializer.")
+        self._invalidate(key)
         return self._doCmd(cmd, key, val, '', cas)
 
     def append(self, key, value, cas=0):
@@ -104,10 +1154,14 @@ class MemcachedClient(object):
     def prepend(self, key, value, cas=0):
         return self._cat(memcacheConstants.CMD_PREPEND, key, cas, value)
 
+    def __parseIncrDecr(self, data):
+        return INCRDECR_RES.unpack(data[-1])[0], data[1]
+
     def __incrdecr(self, cmd, key, amt, init, exp):
-        something, cas, val=self._doCmd(cmd, key, '',
-            struct.pack(memcacheConstants.INCRDECR_PKT_FMT, amt, init, exp))
-        return struct.unpack(INCRDECR_RES_FMT, val)[0], cas
+        self._invalidate(key)
+        return self._doCmd(cmd, key, '',
+            memcacheConstants.INCRDECR_PKT.pack(amt, init, exp),
+            parse=self.__parseIncrDecr)
 
     def incr(self, key, amt=1, init=0, exp=0):
         """Increment or create the named counter."""
@@ -131,46 +1185,109 @@ class MemcachedClient(object):
             val)
 
     def __parseGet(self, data):
-        flags=struct.unpack(memcacheConstants.GET_RES_FMT, data[-1][:4])[0]
-        return flags, data[1], data[-1][4:]
+        flags=memcacheConstants.GET_RES.unpack(data[-1][:4])[0]
+        val=data[-1][4:]
+        if flags & memcacheConstants.FLAG_COMPRESSED and self.compressor is not None:
+            flags &= ~memcacheConstants.FLAG_COMPRESSED
+            val=self.compressor.decompress(val)
+        if flags & memcacheConstants.FLAG_TYPE_MASK and self.serializer is not None:
+            val=self.serializer.decode((flags & memcacheConstants.FLAG_TYPE_MASK)
+                                       >> memcacheConstants.FLAG_TYPE_SHIFT, val)
+            flags &= ~memcacheConstants.FLAG_TYPE_MASK
+        return flags, data[1], val
+
+    def __parseGetSized(self, data):
+        # The near cache is bounded by the size of the values as stored.
+        return self.__parseGet(data), len(data[-1]) - 4
 
     def get(self, key):
         """Get the value for a given key within the memcached server."""
-        parts=self._doCmd(memcacheConstants.CMD_GET, key, '')
-        return self.__parseGet(parts)
+        if self.nearCache is not None:
+            rv=self.nearCache.get(key)
+            if rv is None:
+                rv, size=self._doCmd(memcacheConstants.CMD_GET, key, '',
+                                     parse=self.__parseGetSized)
+                rv=self.nearCache.put(key, rv, size)
+            return rv
+        return self._doCmd(memcacheConstants.CMD_GET, key, '',
+                           parse=self.__parseGet)
 
     def cas(self, key, exp, flags, oldVal, val):
         """CAS in a new value for the given key and comparison value."""
-        self._mutate(memcacheConstants.CMD_SET, key, exp, flags,
+        return self._mutate(memcacheConstants.CMD_SET, key, exp, flags,
             oldVal, val)
 
 # COLLECTION: ATTR begin
+    # Attribute ids to their index in CollectionAttributes.
+    _ATTR_INDEXES={memcacheConstants.ATTR_FLAGS: 0,
+                   memcacheConstants.ATTR_EXPIRETIME: 1,
+                   memcacheConstants.ATTR_COUNT: 2,
+                   memcacheConstants.ATTR_MAXCOUNT: 3,
+                   memcacheConstants.ATTR_MAXBKEYRANGE: 4,
+                   memcacheConstants.ATTR_TYPE: 5,
+                   memcacheConstants.ATTR_OVFLACTION: 6}
+
     def getattr(self, key, attrid):
-        """get all attributes for the given key """
-        data = self._doCmd(memcacheConstants.CMD_GETATTR, key, '')[-1]
-        flags, exptime, count, maxcount, maxbkeyrange, type, ovflaction, reserved1, reserved2 = \
-               struct.unpack(memcacheConstants.GETATTR_RES_FMT, data)
-        if attrid == memcacheConstants.ATTR_FLAGS:
-           return flags
-        elif attrid == memcacheConstants.ATTR_EXPIRETIME:
-           return exptime
-        elif attrid == memcacheConstants.ATTR_COUNT:
-           return count
-        elif attrid == memcacheConstants.ATTR_MAXCOUNT:
-           return maxcount
-        elif attrid == memcacheConstants.ATTR_MAXBKEYRANGE:
-           return maxbkeyrange
-        elif attrid == memcacheConstants.ATTR_TYPE:
-           return type
-        elif attrid == memcacheConstants.ATTR_OVFLACTION:
-           return ovflaction
-        else:
-           return -1
+        """get one attribute for the given key """
+        def pick(attrs):
+            i=self._ATTR_INDEXES.get(attrid)
+            if i is None:
+                return -1
+            return attrs[i]
+        if self.attrCache is not None:
+            return pick(self.getattrs(key))
+        return self._doCmdView(memcacheConstants.CMD_GETATTR, key, '',
+                               parse=lambda data: pick(self.__parseGetAttrs(data)))
+
+    def getattrs(self, key):
+        """get all attributes for the given key as CollectionAttributes """
+        if self.attrCache is not None:
+            rv=self.attrCache.get(key)
+            if rv is None:
+                rv=self.attrCache.put(key, self._doCmdView(
+                    memcacheConstants.CMD_GETATTR, key, '',
+                    parse=self.__parseGetAttrs))
+            return rv
+        return self._doCmdView(memcacheConstants.CMD_GETATTR, key, '',
+                               parse=self.__parseGetAttrs)
+
+    def getattrs_multi(self, keys, window=256):
+        """Get the attributes of many keys at once.
+
+        Every lookup is pipelined, at most window of them in flight.
+        Returns a dict of each key to its CollectionAttributes or the
+        MemcachedError the lookup failed with."""
+        keys=list(keys)
+        rv={}
+        missing=keys
+        if self.attrCache is not None:
+            missing=[]
+            for k in keys:
+                attrs=self.attrCache.get(k)
+                if attrs is None:
+                    missing.append(k)
+                else:
+                    rv[k]=attrs
+        def handler(opaque, cas, body):
+            return self.__parseGetAttrs(body)
+        results=self._pipelined([(memcacheConstants.CMD_GETATTR, k, '', '', 0,
+                                  handler) for k in missing], window)
+        for k, attrs in zip(missing, results):
+            if self.attrCache is not None \
+                    and isinstance(attrs, CollectionAttributes):
+                self.attrCache.put(k, attrs)
+            rv[k]=attrs
+        return rv
+
+    def __parseGetAttrs(self, data):
+        return CollectionAttributes._make(
+            memcacheConstants.GETATTR_RES.unpack_from(data)[:7])
 
     def setattr(self, key, exptime_f, exptime, maxcount_f, maxcount, maxbkeyrange_f, maxbkeyrange, ovflaction):
         """Set some attributes for the given key """
+        self._invalidate(key)
         return self._doCmd(memcacheConstants.CMD_SETATTR, key, '',
-                           struct.pack(memcacheConstants.SETATTR_PKT_FMT,
+                           memcacheConstants.SETATTR_PKT.pack(
                                        exptime, maxcount, maxbkeyrange, ovflaction,
                                        exptime_f, maxcount_f, maxbkeyrange_f))
 # COLLECTION: ATTR end
@@ -178,144 +1295,346 @@ class MemcachedClient(object):
 # COLLECTION: LOP begin
     def lop_create(self, key, flags=0, exptime=0, maxcount=0, ovflaction=0):
         """Create an empty list """
+        self._invalidate(key)
         return self._doCmd(memcacheConstants.CMD_LOP_CREATE, key, '',
-                           struct.pack(memcacheConstants.LOP_CRT_PKT_FMT,
-                                       flags, exptime, maxcount, ovflaction, 0, 0, 0))
+                           memcacheConstants.LOP_CRT_PKT.pack(
+                                       self._collectionFlags(flags), exptime, maxcount,
+                                       ovflaction, 0, 0, 0))
 
     def lop_insert(self, key, index, val, create=0, flags=0, exptime=0, maxcount=0):
         """Insert an element into the given list """
-        return self._doCmd(memcacheConstants.CMD_LOP_INSERT, key, val,
-                           struct.pack(memcacheConstants.LOP_INS_PKT_FMT,
-                                       index, flags, exptime, maxcount, create, 0, 0, 0))
+        self._invalidate(key)
+        return self._doCmd(memcacheConstants.CMD_LOP_INSERT, key, self._encodeElement(val),
+                           memcacheConstants.LOP_INS_PKT.pack(
+                                       index, self._collectionFlags(flags), exptime,
+                                       maxcount, create, 0, 0, 0))
 
     def lop_delete(self, key, from_index, to_index, drop_if_empty=0):
         """Delete some elements from the given list """
+        self._invalidate(key)
         return self._doCmd(memcacheConstants.CMD_LOP_DELETE, key, '',
-                           struct.pack(memcacheConstants.LOP_DEL_PKT_FMT,
+                           memcacheConstants.LOP_DEL_PKT.pack(
                                        from_index, to_index, drop_if_empty, 0, 0, 0))
 
+    def __parseValues(self, data, offset, count):
+        """ parse count value lengths at offset and the values after them """
+        # one unpack for the whole array of VLENG_RES_FMT lengths
+        vlen = struct.unpack_from('>%dL' % count, data, offset)
+        offset += 4 * count
+        blob = data[offset:offset+sum(vlen)].tobytes()
+        vals = []
+        end = 0
+        for n in vlen:
+            vals.append(blob[end:end+n])
+            end += n
+        return vals
+
     def __parseLOPGet(self, data):
         """ parse LOP GET result """
-        flags = struct.unpack(memcacheConstants.VLENG_RES_FMT, data[:4])[0]
-        count = struct.unpack(memcacheConstants.COUNT_RES_FMT, data[4:8])[0]
-        offset = 8
-        vlen = []
-        for n in range(count):
-            vlen.append(struct.unpack(memcacheConstants.VLENG_RES_FMT, data[offset:offset+4])[0])
-            offset += 4
-        vals = []
-        for n in range(count):
-            vals.append(data[offset:offset+vlen[n]])
-            offset += vlen[n]
+        flags, count = memcacheConstants.COLL_GET_RES.unpack_from(data, 0)
+        flags, vals = self._decodeElements(flags, self.__parseValues(data, 8, count))
         return flags, count, vals
 
-    def lop_get(self, key, from_index, to_index, delete=0, drop_if_empty=0):
-        """Get(with delete) some elements from the given list """
-        data = self._doCmd(memcacheConstants.CMD_LOP_GET, key, '',
-                           struct.pack(memcacheConstants.LOP_GET_PKT_FMT,
-                                       from_index, to_index, delete, drop_if_empty, 0, 0))[-1]
-        return self.__parseLOPGet(data)
+    def lop_get(self, key, from_index, to_index, delete=0, drop_if_empty=0,
+                lazy=False):
+        """Get(with delete) some elements from the given list
+
+        With lazy, an ElementView of the elements is returned instead."""
+        if delete:
+            self._invalidate(key)
+        parse = self.__parseLOPGet
+        if lazy:
+            parse = lambda data: ElementView(data, False, self._elementDecoder)
+        return self._doCmdView(memcacheConstants.CMD_LOP_GET, key, '',
+                               memcacheConstants.LOP_GET_PKT.pack(
+                                           from_index, to_index, delete, drop_if_empty, 0, 0),
+                               parse=parse)
+
+    def lop_push_bulk(self, key, values, index=-1, create=0, flags=0, exptime=0, maxcount=0,
+                      window=256):
+        """Insert many elements into the given list, keeping their order
+
+        The values go in starting at index (the tail by default).  The
+        inserts are pipelined with at most window of them in flight, and
+        create only applies to the first element.  A failing element doesn't
+        stop the batch; returns a list of (position in values,
+        MemcachedError) for the failures.  Each value is sent with the index
+        it would have if every insert succeeded, so with index >= 0 the
+        values after a failure land one slot further from the head than
+        the run they belong to, or fail too past the tail.  A negative
+        index counts from the tail and isn't affected."""
+        self._invalidate(key)
+        flags = self._collectionFlags(flags)
+        failed = []
+        values = iter(values)
+        chunksize = 16 * window
+        n = 0
+        while True:
+            requests = []
+            for val in itertools.islice(values, chunksize):
+                requests.append((memcacheConstants.CMD_LOP_INSERT, key,
+                                 self._encodeElement(val),
+                                 memcacheConstants.LOP_INS_PKT.pack(
+                                             index, flags, exptime, maxcount, create, 0, 0, 0),
+                                 0, lambda opaque, cas, body: None))
+                create = 0
+                # A negative index counts from the tail, so it stays put.
+                if index >= 0:
+                    index += 1
+            if not requests:
+                break
+            for i, rv in enumerate(self._pipelined(requests, window)):
+                if rv is not None:
+                    failed.append((n + i, rv))
+            n += len(requests)
+        return failed
+
+    def lop_pop_batch(self, key, count, from_tail=False):
+        """Remove and return up to count elements from the given list
+
+        Elements come from the head, or the tail with from_tail, in the
+        order they're popped.  The list is dropped once it's empty, and an
+        empty or missing list, or a count of 0, gives an empty result."""
+        if count < 0:
+            raise exceptions.ValueError("Negative count %d" % count)
+        if count == 0:
+            return []
+        if from_tail:
+            from_index, to_index = -1, -count
+        else:
+            from_index, to_index = 0, count - 1
+        try:
+            return self.lop_get(key, from_index, to_index, 1, 1)[2]
+        except MemcachedError, e:
+            if e.status not in (memcacheConstants.ERR_NOT_FOUND,
+                                memcacheConstants.ERR_ELEM_NOENT,
+                                memcacheConstants.ERR_INDEXOOR):
+                raise
+            return []
 # COLLECTION : LOP end
 
 # COLLECTION : SOP begin
     def sop_create(self, key, flags=0, exptime=0, maxcount=0):
         """Create an empty set """
+        self._invalidate(key)
         return self._doCmd(memcacheConstants.CMD_SOP_CREATE, key, '',
-                           struct.pack(memcacheConstants.SOP_CRT_PKT_FMT,
-                                       flags, exptime, maxcount))
+                           memcacheConstants.SOP_CRT_PKT.pack(
+                                       self._collectionFlags(flags, False), exptime, maxcount))
 
     def sop_insert(self, key, val, create=0, flags=0, exptime=0, maxcount=0):
         """Insert an element into the given set """
-        return self._doCmd(memcacheConstants.CMD_SOP_INSERT, key, val,
-                           struct.pack(memcacheConstants.SOP_INS_PKT_FMT,
-                                       flags, exptime, maxcount, create, 0, 0, 0))
+        self._invalidate(key)
+        return self._doCmd(memcacheConstants.CMD_SOP_INSERT, key, self._encodeElement(val, False),
+                           memcacheConstants.SOP_INS_PKT.pack(
+                                       self._collectionFlags(flags, False), exptime,
+                                       maxcount, create, 0, 0, 0))
 
     def sop_delete(self, key, val, drop_if_empty=0):
         """Delete an element from the given set """
-        return self._doCmd(memcacheConstants.CMD_SOP_DELETE, key, val,
-                           struct.pack(memcacheConstants.SOP_DEL_PKT_FMT,
+        self._invalidate(key)
+        return self._doCmd(memcacheConstants.CMD_SOP_DELETE, key, self._encodeElement(val, False),
+                           memcacheConstants.SOP_DEL_PKT.pack(
                                        drop_if_empty, 0, 0, 0))
 
     def sop_exist(self, key, val):
         """Check if the given value exists in the given set """
-        data = self._doCmd(memcacheConstants.CMD_SOP_EXIST, key, val)[-1]
-        return struct.unpack(memcacheConstants.EXIST_RES_FMT, data)[0]
+        return self._doCmdView(memcacheConstants.CMD_SOP_EXIST, key,
+                               self._encodeElement(val, False),
+                               parse=self.__parseSOPExist)
+
+    def __parseSOPExist(self, data):
+        return memcacheConstants.EXIST_RES.unpack_from(data)[0]
+
+    def sop_exist_multi(self, key, values, window=256):
+        """Check which of the given values are in the given set
+
+        Returns a dict of each value to 1 or 0.  Servers supporting
+        CMD_SOP_EXIST_MULTI answer in a single request, otherwise the
+        checks are sent as pipelined CMD_SOP_EXIST requests."""
+        values = list(values)
+        encoded = [self._encodeElement(v, False) for v in values]
+        if self.sopExistMulti:
+            try:
+                return self._doCmdView(memcacheConstants.CMD_SOP_EXIST_MULTI, key,
+                                       ''.join([memcacheConstants.VLENG_RES.pack(len(v)) + v
+                                                for v in encoded]),
+                                       parse=lambda data: dict(zip(values, bytearray(data))))
+            except MemcachedError, e:
+                if e.status != memcacheConstants.ERR_UNKNOWN_CMD:
+                    raise
+                self.sopExistMulti = False
+        results = self._pipelined([(memcacheConstants.CMD_SOP_EXIST, key, v, '', 0,
+                                    lambda opaque, cas, body: self.__parseSOPExist(body))
+                                   for v in encoded], window)
+        for rv in results:
+            if isinstance(rv, MemcachedError):
+                raise rv
+        return dict(zip(values, results))
 
     def __parseSOPGet(self, data):
         """ parse SOP GET result """
-        flags = struct.unpack(memcacheConstants.VLENG_RES_FMT, data[:4])[0]
-        count = struct.unpack(memcacheConstants.COUNT_RES_FMT, data[4:8])[0]
-        offset = 8
-        vlen = []
-        for n in range(count):
-            vlen.append(struct.unpack(memcacheConstants.VLENG_RES_FMT, data[offset:offset+4])[0])
-            offset += 4
-        vals = []
-        for n in range(count):
-            vals.append(data[offset:offset+vlen[n]])
-            offset += vlen[n]
-        return flags, count, set(vals)
-
-    def sop_get(self, key, count, delete=0, drop_if_empty=0):
-        """Get(with delete) some elements from the given set """
-        data = self._doCmd(memcacheConstants.CMD_SOP_GET, key, '',
-                           struct.pack(memcacheConstants.SOP_GET_PKT_FMT,
-                                       count, delete, drop_if_empty, 0, 0))[-1]
-        return self.__parseSOPGet(data)
+        flags, count = memcacheConstants.COLL_GET_RES.unpack_from(data, 0)
+        flags, decode = self._elementDecoder(flags)
+        vals = self.__parseValues(data, 8, count)
+        if decode is None:
+            return flags, count, set(vals)
+        # Decoded elements may be unhashable.
+        return flags, count, [decode(v) for v in vals]
+
+    def sop_get(self, key, count, delete=0, drop_if_empty=0, lazy=False):
+        """Get(with delete) some elements from the given set
+
+        The elements are returned as a set, or as a list if they had to be
+        decoded.  With lazy, an ElementView of them is returned instead."""
+        if delete:
+            self._invalidate(key)
+        parse = self.__parseSOPGet
+        if lazy:
+            parse = lambda data: ElementView(data, False, self._elementDecoder)
+        return self._doCmdView(memcacheConstants.CMD_SOP_GET, key, '',
+                               memcacheConstants.SOP_GET_PKT.pack(
+                                           count, delete, drop_if_empty, 0, 0),
+                               parse=parse)
 # COLLECTION : SOP end
 
 # COLLECTION : BOP begin
     def bop_create(self, key, flags=0, exptime=0, maxcount=0, ovflaction=0):
         """Create an empty b+tree """
+        self._invalidate(key)
         return self._doCmd(memcacheConstants.CMD_BOP_CREATE, key, '',
-                           struct.pack(memcacheConstants.BOP_CRT_PKT_FMT,
-                                       flags, exptime, maxcount, ovflaction, 0, 0, 0))
+                           memcacheConstants.BOP_CRT_PKT.pack(
+                                       self._collectionFlags(flags), exptime, maxcount,
+                                       ovflaction, 0, 0, 0))
 
     def bop_insert(self, key, bkey, val, create=0, flags=0, exptime=0, maxcount=0):
         """Insert an element into the given b+tree """
-        return self._doCmd(memcacheConstants.CMD_BOP_INSERT, key, val,
-                           struct.pack(memcacheConstants.BOP_INS_PKT_FMT,
-                                       bkey, flags, exptime, maxcount, create, 0, 0, 0))
+        self._invalidate(key)
+        return self._doCmd(memcacheConstants.CMD_BOP_INSERT, key, self._encodeElement(val),
+                           memcacheConstants.BOP_INS_PKT.pack(
+                                       bkey, self._collectionFlags(flags), exptime,
+                                       maxcount, create, 0, 0, 0))
+
+    def bop_insert_bulk(self, key, elements, create=0, flags=0, exptime=0, maxcount=0,
+                        window=256):
+        """Insert many elements into the given b+tree
+
+        elements is an iterable of (bkey, value) pairs.  The inserts are
+        pipelined with at most window of them in flight, and create only
+        applies to the first element.  A failing element doesn't stop the
+        batch; returns a list of (bkey, MemcachedError) for the failures."""
+        self._invalidate(key)
+        flags = self._collectionFlags(flags)
+        failed = []
+        elements = iter(elements)
+        chunksize = 16 * window
+        while True:
+            requests = []
+            bkeys = []
+            for bkey, val in itertools.islice(elements, chunksize):
+                requests.append((memcacheConstants.CMD_BOP_INSERT, key,
+                                 self._encodeElement(val),
+                                 memcacheConstants.BOP_INS_PKT.pack(
+                                             bkey, flags, exptime, maxcount, create, 0, 0, 0),
+                                 0, lambda opaque, cas, body: None))
+                bkeys.append(bkey)
+                create = 0
+            if not requests:
+                break
+            for bkey, rv in zip(bkeys, self._pipelined(requests, window)):
+                if rv is not None:
+                    failed.append((bkey, rv))
+        return failed
 
     def bop_delete(self, key, from_bkey, to_bkey, count=0, drop_if_empty=0):
         """Delete some elements from the given b+tree """
+        self._invalidate(key)
         return self._doCmd(memcacheConstants.CMD_BOP_DELETE, key, '',
-                           struct.pack(memcacheConstants.BOP_DEL_PKT_FMT,
+                           memcacheConstants.BOP_DEL_PKT.pack(
                                        from_bkey, to_bkey, count, drop_if_empty, 0, 0, 0))
 
-    def __parseBOPGet(self, data):
+    def __parseBOPGet(self, data, asarray=False):
         """ parse BOP GET result """
-        flags = struct.unpack(memcacheConstants.VLENG_RES_FMT, data[:4])[0]
-        count = struct.unpack(memcacheConstants.COUNT_RES_FMT, data[4:8])[0]
-        offset = 8
-        bkey = []
-        for n in range(count):
-            bkey.append(struct.unpack(memcacheConstants.BKEY_RES_FMT, data[offset:offset+8])[0])
-            offset += 8
-        vlen = []
-        for n in range(count):
-            vlen.append(struct.unpack(memcacheConstants.VLENG_RES_FMT, data[offset:offset+4])[0])
-            offset += 4
-        vals = []
-        for n in range(count):
-            vals.append(data[offset:offset+vlen[n]])
-            offset += vlen[n]
+        flags, count = memcacheConstants.COLL_GET_RES.unpack_from(data, 0)
+        if asarray:
+            bkey = numpy.frombuffer(data[8:8+8*count].tobytes(), '>u8')
+            bkey = bkey.astype(numpy.uint64)
+        else:
+            # one unpack for the whole array of BKEY_RES_FMT bkeys
+            bkey = list(struct.unpack_from('>%dQ' % count, data, 8))
+        flags, vals = self._decodeElements(flags,
+                                           self.__parseValues(data, 8+8*count, count))
         return flags, count, bkey, vals
 
-    def bop_get(self, key, from_bkey, to_bkey, offset=0, count=0, delete=0, drop_if_empty=0):
-        """Get(with delete) some elements from the given b+tree """
-        data = self._doCmd(memcacheConstants.CMD_BOP_GET, key, '',
-                           struct.pack(memcacheConstants.BOP_GET_PKT_FMT,
-                                       from_bkey, to_bkey, offset, count, delete, drop_if_empty, 0, 0))[-1]
-        return self.__parseBOPGet(data)
+    def bop_get(self, key, from_bkey, to_bkey, offset=0, count=0, delete=0, drop_if_empty=0,
+                asarray=False, lazy=False):
+        """Get(with delete) some elements from the given b+tree
+
+        With asarray, the bkeys are returned as a numpy uint64 array.  With
+        lazy, an ElementView of the elements is returned instead."""
+        if delete:
+            self._invalidate(key)
+        assert not asarray or numpy is not None, "asarray needs numpy"
+        parse = lambda data: self.__parseBOPGet(data, asarray)
+        if lazy:
+            parse = lambda data: ElementView(data, True, self._elementDecoder)
+        return self._doCmdView(memcacheConstants.CMD_BOP_GET, key, '',
+                               memcacheConstants.BOP_GET_PKT.pack(
+                                           from_bkey, to_bkey, offset, count, delete, drop_if_empty, 0, 0),
+                               parse=parse)
+
+    def bop_scan(self, key, from_bkey, to_bkey, page_size=100):
+        """Walk a bkey range of the given b+tree a page at a time
+
+        Yields (bkey, value) pairs in bkey order, descending if from_bkey >
+        to_bkey as with bop_get.  Each page starts right after the last bkey
+        of the previous one, and the next page is requested while the caller
+        consumes the current one, so the connection must not be used for
+        anything else until the scan is over."""
+        step = from_bkey <= to_bkey and 1 or -1
+        def request(start):
+            opaque = self.r.randint(0, 2**32)
+            self._sendCmd(memcacheConstants.CMD_BOP_GET, key, '', opaque,
+                          memcacheConstants.BOP_GET_PKT.pack(
+                                      start, to_bkey, 0, page_size, 0, 0, 0, 0))
+            return opaque
+        def response(opaque):
+            try:
+                return self.__parseBOPGet(self._recvResponse(opaque)[-1])
+            except MemcachedError, e:
+                if e.status != memcacheConstants.ERR_ELEM_NOENT:
+                    raise
+                return None
+        pending = request(from_bkey)
+        try:
+            while pending is not None:
+                # Cleared first so the drain below never reads it twice.
+                opaque, pending = pending, None
+                page = response(opaque)
+                if page is None:
+                    break
+                flags, count, bkeys, vals = page
+                # Stop at to_bkey or at either end of the bkey space.
+                if count == page_size and bkeys[-1] != to_bkey \
+                        and 0 <= bkeys[-1] + step < 2**64:
+                    # Prefetch the next page before handing this one out.
+                    pending = request(bkeys[-1] + step)
+                for pair in zip(bkeys, vals):
+                    yield pair
+        finally:
+            # Drain the prefetched page if we're abandoned mid-scan.
+            if pending is not None and self.s is not None:
+                response(pending)
 
     def bop_count(self, key, from_bkey, to_bkey):
         """Count elements of given bkey range in the given b+tree """
-        data = self._doCmd(memcacheConstants.CMD_BOP_COUNT, key, '',
-                           struct.pack(memcacheConstants.BOP_CNT_PKT_FMT,
-                                       from_bkey, to_bkey))[-1]
-        flags = struct.unpack(memcacheConstants.VLENG_RES_FMT, data[:4])[0]
-        count = struct.unpack(memcacheConstants.COUNT_RES_FMT, data[4:8])[0]
+        return self._doCmdView(memcacheConstants.CMD_BOP_COUNT, key, '',
+                               memcacheConstants.BOP_CNT_PKT.pack(
+                                           from_bkey, to_bkey),
+                               parse=self.__parseBOPCount)
+
+    def __parseBOPCount(self, data):
+        flags = memcacheConstants.VLENG_RES.unpack_from(data, 0)[0]
+        count = memcacheConstants.COUNT_RES.unpack_from(data, 4)[0]
         return flags, count
 
 # COLLECTION : BOP end
@@ -326,8 +1645,8 @@ class MemcachedClient(object):
 
     def sasl_mechanisms(self):
         """Get the supported SASL methods."""
-        return set(self._doCmd(memcacheConstants.CMD_SASL_LIST_MECHS,
-                               '', '')[2].split(' '))
+        return self._doCmd(memcacheConstants.CMD_SASL_LIST_MECHS, '', '',
+                           parse=lambda data: set(data[2].split(' ')))
 
     def sasl_auth_start(self, mech, data):
         """Start a sasl auth session."""
@@ -335,7 +1654,9 @@ class MemcachedClient(object):
 
     def sasl_auth_plain(self, user, password, foruser=''):
         """Perform plain auth."""
-        return self.sasl_auth_start('PLAIN', '\0'.join([foruser, user, password]))
+        rv=self.sasl_auth_start('PLAIN', '\0'.join([foruser, user, password]))
+        self.credentials=('PLAIN', (user, password, foruser))
+        return rv
 
     def sasl_auth_cram_md5(self, user, password):
         """Start a plan auth session."""
@@ -347,8 +1668,10 @@ class MemcachedClient(object):
             challenge = e.msg
 
         dig = hmac.HMAC(password, challenge).hexdigest()
-        return self._doCmd(memcacheConstants.CMD_SASL_STEP, 'CRAM-MD5',
-                           user + ' ' + dig)
+        rv = self._doCmd(memcacheConstants.CMD_SASL_STEP, 'CRAM-MD5',
+                         user + ' ' + dig)
+        self.credentials = ('CRAM-MD5', (user, password))
+        return rv
 
     def set_vbucket_state(self, vbucket, state):
         return self._doCmd(memcacheConstants.CMD_SET_VBUCKET_STATE,
@@ -357,30 +1680,202 @@ class MemcachedClient(object):
     def delete_vbucket(self, vbucket):
         return self._doCmd(memcacheConstants.CMD_DELETE_VBUCKET, str(vbucket), '')
 
-    def getMulti(self, keys):
+    def getMulti(self, keys, window=1024):
         """Get values for any available keys in the given iterable.
 
         Returns a dict of matched keys to their values."""
-        opaqued=dict(enumerate(keys))
-        terminal=len(opaqued)+10
-        # Send all of the keys in quiet
-        for k,v in opaqued.iteritems():
-            self._sendCmd(memcacheConstants.CMD_GETQ, v, '', k)
-
-        self._sendCmd(memcacheConstants.CMD_NOOP, '', '', terminal)
-
-        # Handle the response
+        if self.nearCache is None:
+            return dict(self.iterGetMulti(keys, window))
         rv={}
-        done=False
-        while not done:
-            opaque, cas, data=self._handleSingleResponse(None)
-            if opaque != terminal:
-                rv[opaqued[opaque]]=self.__parseGet((opaque, cas, data))
+        missing=[]
+        for k in keys:
+            v=self.nearCache.get(k)
+            if v is None:
+                missing.append(k)
             else:
-                done=True
+                rv[k]=v
+        for k, (v, size) in self._iterGetMulti(missing, window,
+                                               self.__parseGetSized):
+            rv[k]=self.nearCache.put(k, v, size)
+        return rv
+
+    def iterGetMulti(self, keys, window=1024):
+        """Stream values for any available keys in the given iterable.
 
+        Yields (key, (flags, cas, value)) for matched keys as the responses
+        arrive.  Keys are sent as quiet gets in chunks of window / 2, each
+        terminated by a noop, and at most two chunks are outstanding at a
+        time, so keys may be an arbitrarily long iterable."""
+        return self._iterGetMulti(keys, window, self.__parseGet)
+
+    def _iterGetMulti(self, keys, window, parse):
+        keys=iter(keys)
+        chunksize=max(1, window // 2)
+        opaque=self.r.randint(0, 2**32)
+        # (terminal opaque, {opaque: key}) for each chunk in flight
+        chunks=collections.deque()
+        more=True
+        error=None
+        try:
+            while True:
+                while more and error is None and len(chunks) < 2:
+                    pending={}
+                    msgs=[]
+                    for key in itertools.islice(keys, chunksize):
+                        opaque=(opaque + 1) & 0xffffffff
+                        pending[opaque]=key
+                        msgs.append((memcacheConstants.CMD_GETQ, key, '',
+                                     opaque, '', 0))
+                    more=len(msgs) == chunksize
+                    if not msgs:
+                        break
+                    opaque=(opaque + 1) & 0xffffffff
+                    msgs.append((memcacheConstants.CMD_NOOP, '', '', opaque,
+                                 '', 0))
+                    chunks.append((opaque, pending))
+                    self._send(self._encodeCmds(msgs))
+
+                if not chunks:
+                    break
+
+                cmd, errcode, rop, cas, keylen, extralen, data=\
+                    self._readResponse()
+                terminal, pending=chunks[0]
+                if rop == terminal:
+                    chunks.popleft()
+                elif errcode != 0:
+                    # Finish reading what's in flight before giving up.
+                    error=error or MemcachedError(errcode, data.tobytes())
+                elif error is None:
+                    key=pending.pop(rop)
+                    yield key, parse((rop, cas, data.tobytes()))
+        finally:
+            # Drain the connection if we're abandoned mid-stream.
+            while chunks and self.s is not None:
+                if self._readResponse()[2] == chunks[0][0]:
+                    chunks.popleft()
+        if error is not None:
+            raise error
+
+    def _doQuietMulti(self, cmd, requests):
+        """Send quiet commands and collect the failures.
+
+        requests is an iterable of (key, val, extraHeader, cas) tuples.
+        They're sent in chunks of quietWindow / 2, each terminated by a
+        noop, and at most two chunks are outstanding at a time, so failures
+        are read while the rest is still being sent.  Returns a dict of
+        keys to the MemcachedError they failed with."""
+        requests=iter(requests)
+        chunksize=max(1, self.quietWindow // 2)
+        opaque=self.r.randint(0, 2**32)
+        # (terminal opaque, {opaque: key}) for each chunk in flight
+        chunks=collections.deque()
+        more=True
+        rv={}
+        try:
+            while True:
+                while more and len(chunks) < 2:
+                    pending={}
+                    msgs=[]
+                    for key, val, extraHeader, cas in itertools.islice(
+                            requests, chunksize):
+                        opaque=(opaque + 1) & 0xffffffff
+                        pending[opaque]=key
+                        msgs.append((cmd, key, val, opaque, extraHeader, cas))
+                    more=len(msgs) == chunksize
+                    if not msgs:
+                        break
+                    opaque=(opaque + 1) & 0xffffffff
+                    msgs.append((memcacheConstants.CMD_NOOP, '', '', opaque,
+                                 '', 0))
+                    chunks.append((opaque, pending))
+                    self._send(self._encodeCmds(msgs))
+
+                if not chunks:
+                    break
+
+                rcmd, errcode, rop, cas, keylen, extralen, data=\
+                    self._readResponse()
+                terminal, pending=chunks[0]
+                if rop == terminal:
+                    chunks.popleft()
+                elif errcode != 0:
+                    rv[pending.pop(rop)]=MemcachedError(errcode,
+                                                        data.tobytes())
+        finally:
+            # Drain the connection if a request couldn't be built.
+            while chunks and self.s is not None:
+                if self._readResponse()[2] == chunks[0][0]:
+                    chunks.popleft()
         return rv
 
+    def _mutateMulti(self, cmd, exp, flags, items):
+        if hasattr(items, 'iteritems'):
+            items=items.iteritems()
+        extraHeader=SET_PKT.pack(flags, exp)
+        def requests():
+            for k, v in items:
+                self._invalidate(k, exp)
+                if self.serializer is not None or self.compressor is not None:
+                    f, v=self._encodeValue(flags, v)
+                    if f != flags:
+                        yield k, v, SET_PKT.pack(f, exp), 0
+                        continue
+                yield k, v, extraHeader, 0
+        return self._doQuietMulti(cmd, requests())
+
+    def setMulti(self, exp, flags, items):
+        """Set many values at once using quiet sets.
+
+        items is a dict or an iterable of (key, value) pairs.  Returns a
+        dict of the keys that failed to their MemcachedError."""
+        return self._mutateMulti(memcacheConstants.CMD_SETQ, exp, flags, items)
+
+    def addMulti(self, exp, flags, items):
+        """Add many values at once using quiet adds.
+
+        Returns a dict of the keys that failed to their MemcachedError."""
+        return self._mutateMulti(memcacheConstants.CMD_ADDQ, exp, flags, items)
+
+    def replaceMulti(self, exp, flags, items):
+        """Replace many values at once using quiet replaces.
+
+        Returns a dict of the keys that failed to their MemcachedError."""
+        return self._mutateMulti(memcacheConstants.CMD_REPLACEQ, exp, flags,
+                                 items)
+
+    def deleteMulti(self, keys):
+        """Delete many keys at once using quiet deletes.
+
+        Returns a dict of the keys that failed to their MemcachedError."""
+        def requests():
+            for k in keys:
+                self._invalidate(k)
+                yield k, '', '', 0
+        return self._doQuietMulti(memcacheConstants.CMD_DELETEQ, requests())
+
+    def __incrdecrMulti(self, cmd, keys, amt, init, exp):
+        extraHeader=memcacheConstants.INCRDECR_PKT.pack(amt, init, exp)
+        def requests():
+            for k in keys:
+                self._invalidate(k)
+                yield k, '', extraHeader, 0
+        return self._doQuietMulti(cmd, requests())
+
+    def incrMulti(self, keys, amt=1, init=0, exp=0):
+        """Increment or create many counters at once.
+
+        Returns a dict of the keys that failed to their MemcachedError."""
+        return self.__incrdecrMulti(memcacheConstants.CMD_INCRQ, keys,
+                                    amt, init, exp)
+
+    def decrMulti(self, keys, amt=1, init=0, exp=0):
+        """Decrement or create many counters at once.
+
+        Returns a dict of the keys that failed to their MemcachedError."""
+        return self.__incrdecrMulti(memcacheConstants.CMD_DECRQ, keys,
+                                    amt, init, exp)
+
     def stats(self, sub=''):
         """Get stats."""
         opaque=self.r.randint(0, 2**32)
@@ -401,9 +1896,1336 @@ class MemcachedClient(object):
 
     def delete(self, key, cas=0):
         """Delete the value for a given key within the memcached server."""
+        self._invalidate(key)
         return self._doCmd(memcacheConstants.CMD_DELETE, key, '', '', cas)
 
     def flush(self, timebomb=0):
         """Flush all storage in a memcached instance."""
+        if self.nearCache is not None:
+            self.nearCache.clear()
+        if self.attrCache is not None:
+            self.attrCache.clear()
         return self._doCmd(memcacheConstants.CMD_FLUSH, '', '',
-            struct.pack(memcacheConstants.FLUSH_PKT_FMT, timebomb))
+            memcacheConstants.FLUSH_PKT.pack(timebomb))
+
+class Pipeline(MemcachedClient):
+    """Batch commands over a MemcachedClient's connection.
+
+    Every single-response command of MemcachedClient is available.  Instead
+    of waiting for its response, each call is queued; execute() sends the
+    whole batch and returns, in order, the result of each command or the
+    MemcachedError it failed with.
+
+        with mc.pipeline() as p:
+            p.set('a', 0, 0, 'x')
+            p.bop_insert('b', 1, 'y', create=1)
+        print p.results
+    """
+
+    def __init__(self, client, window=None):
+        # The connection belongs to the client, so MemcachedClient.__init__
+        # is deliberately not called.
+        self.client=client
+        self.compressor=client.compressor
+        self.serializer=client.serializer
+        self.window=window
+        self.queue=[]
+        self.results=None
+
+    def close(self):
+        pass
+
+    def _invalidate(self, key, exp=0):
+        # Queued mutations still invalidate the client's near cache, but
+        # pipelined gets never use it.
+        self.client._invalidate(key, exp)
+
+    def _doCmd(self, cmd, key, val, extraHeader='', cas=0, parse=None):
+        def handler(opaque, cas, body):
+            rv=opaque, cas, body.tobytes()
+            if parse:
+                rv=parse(rv)
+            return rv
+        self.queue.append((cmd, key, val, extraHeader, cas, handler))
+
+    def _doCmdView(self, cmd, key, val, extraHeader='', cas=0, parse=None):
+        def handler(opaque, cas, body):
+            if parse:
+                return parse(body)
+            return body.tobytes()
+        self.queue.append((cmd, key, val, extraHeader, cas, handler))
+
+    def _unsupported(self, *args, **kwargs):
+        raise exceptions.NotImplementedError(
+            "Multi-response commands can't be pipelined.")
+
+    getMulti = iterGetMulti = stats = sasl_auth_cram_md5 = _unsupported
+    pipeline = bop_insert_bulk = lop_push_bulk = lop_pop_batch = _unsupported
+    sop_exist_multi = bop_scan = getattrs_multi = _unsupported
+    setMulti = addMulti = replaceMulti = deleteMulti = _unsupported
+    incrMulti = decrMulti = _unsupported
+
+    def execute(self):
+        """Send all queued commands and collect their results."""
+        queue, self.queue = self.queue, []
+        self.results=self.client._pipelined(queue, self.window)
+        return self.results
+
+    def __len__(self):
+        return len(self.queue)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.execute()
+        else:
+            self.queue=[]
+
+class MemcachedClientPool(object):
+    """A thread-safe pool of MemcachedClient connections to one server.
+
+        pool=MemcachedClientPool('127.0.0.1', 11211, maxsize=8)
+        with pool.connection() as mc:
+            mc.set('a', 0, 0, 'x')
+
+    Connections idle for longer than idle_timeout are closed (down to
+    minsize), and connections idle for longer than check_interval are
+    checked with a noop before they're handed out.  If user is given, every
+    new connection authenticates once with SASL PLAIN."""
+
+    def __init__(self, host='127.0.0.1', port=11211, minsize=0, maxsize=10,
+                 idle_timeout=60, check_interval=5, user=None, password=''):
+        assert 0 <= minsize <= maxsize and maxsize > 0
+        self.host=host
+        self.port=port
+        self.minsize=minsize
+        self.maxsize=maxsize
+        self.idle_timeout=idle_timeout
+        self.check_interval=check_interval
+        self.user=user
+        self.password=password
+
+        self.cond=threading.Condition()
+        # (client, time of checkin), most recently used last
+        self.idle=[]
+        self.size=0
+        self.in_use=0
+        self.closed=False
+
+        self.checkouts=0
+        self.waits=0
+        self.wait_time=0.0
+        self.max_wait_time=0.0
+        self.timeouts=0
+        self.peak_in_use=0
+        self.created=0
+        self.reaped=0
+        self.failed_checks=0
+
+        for i in range(minsize):
+            self.idle.append((self._connect(), time.time()))
+            self.size += 1
+            self.created += 1
+
+    def _connect(self):
+        mc=MemcachedClient(self.host, self.port)
+        if self.user is not None:
+            mc.sasl_auth_plain(self.user, self.password)
+        return mc
+
+    def _reap(self, now):
+        """Close connections that sat idle too long.  Call with the lock."""
+        while self.idle and self.size > self.minsize \
+                and now - self.idle[0][1] > self.idle_timeout:
+            self.idle.pop(0)[0].close()
+            self.size -= 1
+            self.reaped += 1
+
+    def checkout(self, timeout=None):
+        """Take a connection out of the pool.
+
+        If maxsize connections are already checked out, wait up to timeout
+        seconds (forever if None) for one to be checked in."""
+        start=time.time()
+        self.cond.acquire()
+        try:
+            assert not self.closed, "Pool is closed."
+            self._reap(start)
+            waited=False
+            while not self.idle and self.size >= self.maxsize:
+                waited=True
+                if timeout is None:
+                    self.cond.wait()
+                else:
+                    remaining=start + timeout - time.time()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        self._recordWait(time.time() - start)
+                        raise PoolTimeoutError(
+                            "No connection available after %.3fs" % timeout)
+                    self.cond.wait(remaining)
+            if self.idle:
+                mc, last=self.idle.pop()
+            else:
+                # Reserve the slot, connect outside the lock.
+                mc, last=None, None
+                self.size += 1
+            self.in_use += 1
+            self.peak_in_use=max(self.peak_in_use, self.in_use)
+            self.checkouts += 1
+            if waited:
+                self._recordWait(time.time() - start)
+        finally:
+            self.cond.release()
+
+        failed=created=False
+        try:
+            if mc is not None and time.time() - last > self.check_interval:
+                try:
+                    mc.noop()
+                except (socket.error, exceptions.EOFError, MemcachedError):
+                    failed=True
+                    mc.close()
+                    mc=None
+            if mc is None:
+                mc=self._connect()
+                created=True
+        except:
+            self._release(None, failed)
+            raise
+        if failed or created:
+            self._recordConnect(failed, created)
+        return mc
+
+    def _recordConnect(self, failed, created):
+        self.cond.acquire()
+        try:
+            self.failed_checks += failed
+            self.created += created
+        finally:
+            self.cond.release()
+
+    def _recordWait(self, waittime):
+        self.waits += 1
+        self.wait_time += waittime
+        self.max_wait_time=max(self.max_wait_time, waittime)
+
+    def checkin(self, mc, broken=False):
+        """Return a connection to the pool.
+
+        Pass broken=True if the connection may be in an unknown state (e.g.
+        a response was only partially read), and it will be closed."""
+        if broken:
+            mc.close()
+            mc=None
+        self._release(mc)
+
+    def _release(self, mc, failed=False):
+        self.cond.acquire()
+        try:
+            self.failed_checks += failed
+            self.in_use -= 1
+            if mc is None or self.closed:
+                if mc is not None:
+                    mc.close()
+                self.size -= 1
+            else:
+                self.idle.append((mc, time.time()))
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        """Context manager checking a connection out and back in."""
+        mc=self.checkout(timeout)
+        try:
+            yield mc
+        except MemcachedError:
+            # The server answered, so the connection is fine.
+            self.checkin(mc)
+            raise
+        except:
+            self.checkin(mc, broken=True)
+            raise
+        else:
+            self.checkin(mc)
+
+    def stats(self):
+        """Get a dict of pool counters."""
+        self.cond.acquire()
+        try:
+            return {'size': self.size,
+                    'idle': len(self.idle),
+                    'in_use': self.in_use,
+                    'peak_in_use': self.peak_in_use,
+                    'utilization': float(self.in_use) / self.maxsize,
+                    'checkouts': self.checkouts,
+                    'waits': self.waits,
+                    'wait_time': self.wait_time,
+                    'max_wait_time': self.max_wait_time,
+                    'timeouts': self.timeouts,
+                    'created': self.created,
+                    'reaped': self.reaped,
+                    'failed_checks': self.failed_checks}
+        finally:
+            self.cond.release()
+
+    def close(self):
+        """Close all idle connections; busy ones are closed on checkin."""
+        self.cond.acquire()
+        try:
+            self.closed=True
+            for mc, last in self.idle:
+                mc.close()
+            self.size -= len(self.idle)
+            self.idle=[]
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+class HashRing(object):
+    """A ketama-style consistent hash ring.
+
+    Every node gets points * weight virtual nodes on a ring of 32-bit
+    hashes, four per md5 digest of "node-i", and a key belongs to the
+    first virtual node at or after the hash of the key.  Adding or
+    removing a node only moves the keys of that node's virtual nodes."""
+
+    def __init__(self, nodes=(), points=160):
+        self.points=points
+        self.weights={}
+        self.hashes=[]
+        self.owners=[]
+        for node in nodes:
+            self.weights[node]=1
+        self._build()
+
+    def _build(self):
+        ring=[]
+        for node, weight in self.weights.iteritems():
+            for i in range(max(1, int(self.points * weight) // 4)):
+                digest=hashlib.md5("%s-%d" % (node, i)).digest()
+                for h in struct.unpack('<4I', digest):
+                    ring.append((h, node))
+        ring.sort()
+        self.hashes=[h for h, node in ring]
+        self.owners=[node for h, node in ring]
+
+    def add(self, node, weight=1):
+        self.weights[node]=weight
+        self._build()
+
+    def remove(self, node):
+        del self.weights[node]
+        self._build()
+
+    def hash(self, key):
+        return struct.unpack('<I', hashlib.md5(key).digest()[:4])[0]
+
+    def get(self, key):
+        """Get the node owning the given key."""
+        assert self.hashes, "No nodes in the ring."
+        i=bisect.bisect_left(self.hashes, self.hash(key))
+        if i == len(self.hashes):
+            i=0
+        return self.owners[i]
+
+    def __len__(self):
+        return len(self.weights)
+
+class MemcachedCluster(object):
+    """Spread keys over several servers with a consistent hash ring.
+
+        mcc=MemcachedCluster(['10.0.0.1:11211', ('10.0.0.2', 11211, 2)])
+        mcc.set('a', 0, 0, 'x')
+        mcc.getMulti(['a', 'b', 'c'])
+
+    A server is given as "host:port" or a (host, port[, weight]) tuple.
+    Single-key commands go to the server owning the key.  Multi-key calls
+    group the keys by server and talk to all the servers involved in
+    parallel.  Like MemcachedClient, a cluster must not be shared between
+    threads."""
+
+    def __init__(self, servers=(), points=160):
+        self.ring=HashRing(points=points)
+        self.clients={}
+        for server in servers:
+            self.addServer(server)
+
+    @staticmethod
+    def _parseServer(server):
+        if isinstance(server, basestring):
+            host, port=server.rsplit(':', 1)
+            return host, int(port), 1
+        if len(server) == 2:
+            return server[0], server[1], 1
+        return tuple(server)
+
+    def _connect(self, host, port):
+        return MemcachedClient(host, port)
+
+    def addServer(self, server):
+        """Add a server; only about 1/N of the keys move to it."""
+        host, port, weight=self._parseServer(server)
+        name="%s:%d" % (host, port)
+        self.clients[name]=self._connect(host, port)
+        self.ring.add(name, weight)
+        return name
+
+    def removeServer(self, server):
+        """Remove a server; only the keys it owned move elsewhere."""
+        host, port, weight=self._parseServer(server)
+        name="%s:%d" % (host, port)
+        self.ring.remove(name)
+        self.clients.pop(name).close()
+
+    def close(self):
+        for mc in self.clients.values():
+            mc.close()
+
+    def _serverOf(self, key):
+        return self.ring.get(key)
+
+    def clientFor(self, key):
+        """Get the client for the server owning the given key."""
+        return self.clients[self._serverOf(key)]
+
+    def _call(self, name, key, args, kwargs):
+        return getattr(self.clientFor(key), name)(key, *args, **kwargs)
+
+    def _groupByServer(self, keys):
+        groups={}
+        for key in keys:
+            groups.setdefault(self._serverOf(key), []).append(key)
+        return groups
+
+    def _scatter(self, f, groups):
+        """Call f(client, keys) for every server's group of keys in parallel.
+
+        Returns a list of the results."""
+        items=groups.items()
+        results=[None] * len(items)
+        errors=[]
+        def run(i):
+            name, keys=items[i]
+            try:
+                results[i]=f(self.clients[name], keys)
+            except:
+                errors.append(sys.exc_info())
+        threads=[threading.Thread(target=run, args=(i,))
+                 for i in range(1, len(items))]
+        for t in threads:
+            t.start()
+        if items:
+            run(0)
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return results
+
+    def getMulti(self, keys):
+        """Get values for any available keys in the given iterable.
+
+        Returns a dict of matched keys to their values."""
+        rv={}
+        for d in self._scatter(lambda mc, keys: mc.getMulti(keys),
+                               self._groupByServer(keys)):
+            rv.update(d)
+        return rv
+
+    def __scatterFailures(self, f, keys):
+        rv={}
+        for d in self._scatter(f, self._groupByServer(keys)):
+            rv.update(d)
+        return rv
+
+    def setMulti(self, exp, flags, items):
+        """Set many values; returns the failed keys and their errors."""
+        items=dict(items)
+        return self.__scatterFailures(
+            lambda mc, keys: mc.setMulti(exp, flags,
+                                         [(k, items[k]) for k in keys]),
+            items)
+
+    def deleteMulti(self, keys):
+        """Delete many keys; returns the failed keys and their errors."""
+        return self.__scatterFailures(lambda mc, keys: mc.deleteMulti(keys),
+                                      keys)
+
+    def callMulti(self, method, keys, *args, **kwargs):
+        """Run the named single-key command for each of the given keys.
+
+        Every server's share of the keys is sent as one pipeline and the
+        servers are talked to in parallel.  Returns a dict of keys to the
+        command's result or the MemcachedError it failed with.
+
+            mcc.callMulti('bop_get', keys, 0, 100)
+        """
+        def f(mc, keys):
+            p=mc.pipeline()
+            for key in keys:
+                getattr(p, method)(key, *args, **kwargs)
+            return zip(keys, p.execute())
+        rv={}
+        for pairs in self._scatter(f, self._groupByServer(keys)):
+            rv.update(pairs)
+        return rv
+
+    def _broadcast(self, method, *args):
+        names=self.clients.keys()
+        results=self._scatter(lambda mc, keys: getattr(mc, method)(*args),
+                              dict((name, ()) for name in names))
+        return dict(zip(names, results))
+
+    def flush(self, timebomb=0):
+        """Flush every server; returns a dict of server to result."""
+        return self._broadcast('flush', timebomb)
+
+    def noop(self):
+        return self._broadcast('noop')
+
+    def version(self):
+        return self._broadcast('version')
+
+    def stats(self, sub=''):
+        """Get a dict of server to its stats."""
+        return self._broadcast('stats', sub)
+
+def _keyedCommand(name):
+    def f(self, key, *args, **kwargs):
+        return self._call(name, key, args, kwargs)
+    f.__name__=name
+    f.__doc__=getattr(MemcachedClient, name).__doc__
+    return f
+
+for _name in ('get', 'set', 'add', 'replace', 'cas', 'delete', 'append',
+              'prepend', 'incr', 'decr', 'getattr', 'getattrs', 'setattr',
+              'lop_create', 'lop_insert', 'lop_delete', 'lop_get',
+              'sop_create', 'sop_insert', 'sop_delete', 'sop_exist', 'sop_get',
+              'bop_create', 'bop_insert', 'bop_delete', 'bop_get', 'bop_count'):
+    setattr(MemcachedCluster, _name, _keyedCommand(_name))
+del _name
+
+class ShardedBTree(object):
+    """A logical b+tree spread over several b+tree items.
+
+        tree=ShardedBTree(mc, 'events', shards=16)
+        tree.insert(1000, 'x')
+        tree.get(0, 2000, count=10)
+
+    Shard i is the b+tree item "key:i", created with flags, exptime and
+    maxcount by the first insert into it, so maxcount applies per shard.
+    By default a bkey goes to shard bkey % shards.  With bounds, a sorted
+    list of bkeys, the shards are ranges instead: shard i holds the bkeys
+    from bounds[i - 1] up to (but not including) bounds[i], and only the
+    shards overlapping a range are asked about it.  client is a
+    MemcachedClient or a MemcachedCluster; a range request is pipelined to
+    every shard involved, in parallel over the servers of a cluster, and
+    their results are merged in bkey order."""
+
+    # Errors of shards that don't hold anything of a range.
+    EMPTY=(memcacheConstants.ERR_NOT_FOUND, memcacheConstants.ERR_ELEM_NOENT)
+
+    def __init__(self, client, key, shards=16, bounds=None, flags=0,
+                 exptime=0, maxcount=0):
+        self.client=client
+        self.key=key
+        self.bounds=bounds
+        if bounds is not None:
+            assert list(bounds) == sorted(bounds), "bounds must be sorted"
+            shards=len(bounds) + 1
+        self.shards=shards
+        self.flags=flags
+        self.exptime=exptime
+        self.maxcount=maxcount
+
+    def shardOf(self, bkey):
+        if self.bounds is None:
+            return bkey % self.shards
+        return bisect.bisect_right(self.bounds, bkey)
+
+    def keyOf(self, shard):
+        return "%s:%d" % (self.key, shard)
+
+    def keysFor(self, from_bkey, to_bkey):
+        """Get the keys of the shards that may hold bkeys of a range."""
+        if self.bounds is None:
+            shards=xrange(self.shards)
+        else:
+            shards=xrange(self.shardOf(min(from_bkey, to_bkey)),
+                          self.shardOf(max(from_bkey, to_bkey)) + 1)
+        return [self.keyOf(i) for i in shards]
+
+    def __fanOut(self, keys, call):
+        """Pipeline call(pipeline, key) for every shard key.
+
+        Returns a dict of the keys to their result or MemcachedError."""
+        def run(mc, keys):
+            p=mc.pipeline()
+            for k in keys:
+                call(p, k)
+            return dict(zip(keys, p.execute()))
+        if not isinstance(self.client, MemcachedCluster):
+            return run(self.client, keys)
+        rv={}
+        for d in self.client._scatter(run, self.client._groupByServer(keys)):
+            rv.update(d)
+        return rv
+
+    def __results(self, results):
+        """The results of the shards holding something, raising any
+        other error."""
+        rv=[]
+        for r in results:
+            if isinstance(r, MemcachedError):
+                if r.status not in self.EMPTY:
+                    raise r
+            else:
+                rv.append(r)
+        return rv
+
+    def insert(self, bkey, val):
+        """Insert an element into its shard."""
+        return self.client.bop_insert(self.keyOf(self.shardOf(bkey)), bkey,
+                                      val, 1, self.flags, self.exptime,
+                                      self.maxcount)
+
+    def insert_bulk(self, elements, window=256):
+        """Insert many (bkey, value) pairs with bop_insert_bulk per shard.
+
+        Returns a list of (bkey, MemcachedError) for the failures."""
+        groups=collections.defaultdict(list)
+        for bkey, val in elements:
+            groups[self.keyOf(self.shardOf(bkey))].append((bkey, val))
+        failed=[]
+        for k, elems in sorted(groups.items()):
+            mc=self.client
+            if isinstance(mc, MemcachedCluster):
+                mc=mc.clientFor(k)
+            failed.extend(mc.bop_insert_bulk(k, elems, 1, self.flags,
+                                             self.exptime, self.maxcount,
+                                             window))
+        return failed
+
+    def get(self, from_bkey, to_bkey, offset=0, count=0):
+        """Get the elements of a bkey range as a list of (bkey, value).
+
+        As with bop_get, the elements are in descending bkey order if
+        from_bkey > to_bkey, and offset and count (0 for all) apply to the
+        whole range.  Every shard is asked for offset + count elements."""
+        n=count and offset + count or 0
+        results=self.__fanOut(self.keysFor(from_bkey, to_bkey),
+            lambda p, k: p.bop_get(k, from_bkey, to_bkey, 0, n))
+        descending=from_bkey > to_bkey
+        streams=[]
+        for flags, size, bkeys, vals in self.__results(results.values()):
+            if descending:
+                bkeys=[-b for b in bkeys]
+            streams.append(zip(bkeys, vals))
+        # bkeys are unique over the shards, so values are never compared.
+        merged=heapq.merge(*streams)
+        if descending:
+            merged=((-b, v) for b, v in merged)
+        return list(itertools.islice(merged, offset,
+                                     count and offset + count or None))
+
+    def count(self, from_bkey, to_bkey):
+        """Count the elements of a bkey range over the shards."""
+        results=self.__fanOut(self.keysFor(from_bkey, to_bkey),
+            lambda p, k: p.bop_count(k, from_bkey, to_bkey))
+        return sum(n for flags, n in self.__results(results.values()))
+
+    def delete(self, from_bkey, to_bkey, count=0, drop_if_empty=0):
+        """Delete the elements of a bkey range.
+
+        With count, only the first count elements from from_bkey are
+        deleted.  When that spans shards, their bkeys are looked up first,
+        so elements inserted into the range meanwhile may go too.  Raises
+        ERR_ELEM_NOENT if there was nothing to delete."""
+        keys=self.keysFor(from_bkey, to_bkey)
+        if count and len(keys) > 1:
+            bkeys=[b for b, v in self.get(from_bkey, to_bkey, 0, count)]
+            if not bkeys:
+                raise MemcachedError(memcacheConstants.ERR_ELEM_NOENT,
+                                     'No elements in range')
+            to_bkey=bkeys[-1]
+            keys=self.keysFor(from_bkey, to_bkey)
+            count=0
+        results=self.__fanOut(keys,
+            lambda p, k: p.bop_delete(k, from_bkey, to_bkey, count,
+                                      drop_if_empty))
+        if not self.__results(results.values()):
+            raise MemcachedError(memcacheConstants.ERR_ELEM_NOENT,
+                                 'No elements in range')
+
+    def drop(self):
+        """Delete every shard item."""
+        for i in xrange(self.shards):
+            try:
+                self.client.delete(self.keyOf(i))
+            except MemcachedError, e:
+                if e.status != memcacheConstants.ERR_NOT_FOUND:
+                    raise
+
+class VBucketMap(object):
+    """Map keys to vbuckets and vbuckets to servers.
+
+    servers is a list of "host:port" names and vbmap has, for every
+    vbucket, the index of the server holding it.  The number of vbuckets
+    must be a power of two."""
+
+    def __init__(self, servers, vbmap):
+        n=len(vbmap)
+        assert n and not n & (n - 1), "vbucket count must be a power of two"
+        self.servers=list(servers)
+        self.vbmap=list(vbmap)
+        self.mask=n - 1
+        # vbucket -> server name, so routing a key is two list lookups
+        self.table=[self.servers[i] for i in self.vbmap]
+
+    def vbucketOf(self, key):
+        return ((zlib.crc32(key) & 0xffffffff) >> 16 & 0x7fff) & self.mask
+
+    def serverOf(self, key):
+        return self.table[self.vbucketOf(key)]
+
+    def __len__(self):
+        return len(self.vbmap)
+
+class VBucketCluster(MemcachedCluster):
+    """Route keys over servers through a vbucket map.
+
+        mcc=VBucketCluster(['10.0.0.1:11211', '10.0.0.2:11211'],
+                           [i % 2 for i in range(1024)])
+
+    Keys hash (crc32) to one of a fixed number of vbuckets and every request
+    is stamped with its key's vbucket, so moving a vbucket to another server
+    only takes a new map.  When a server answers ERR_NOT_MY_VBUCKET, the map
+    is reloaded from configProvider (a callable returning (servers, vbmap))
+    and the request is retried up to maxRetries times."""
+
+    def __init__(self, servers, vbmap, configProvider=None, maxRetries=3):
+        self.clients={}
+        self.vbmap=None
+        self.configProvider=configProvider
+        self.maxRetries=maxRetries
+        self.setMap(servers, vbmap)
+
+    def setMap(self, servers, vbmap):
+        """Install a new vbucket map, connecting to any new servers."""
+        names=[]
+        for server in servers:
+            host, port, weight=self._parseServer(server)
+            name="%s:%d" % (host, port)
+            if name not in self.clients:
+                self.clients[name]=self._connect(host, port)
+            names.append(name)
+        self.vbmap=VBucketMap(names, vbmap)
+        for name in self.clients.keys():
+            if name not in names:
+                self.clients.pop(name).close()
+        for mc in self.clients.values():
+            mc.vbucketMap=self.vbmap
+
+    def refresh(self):
+        """Reload the vbucket map from the config provider."""
+        servers, vbmap=self.configProvider()
+        self.setMap(servers, vbmap)
+
+    def addServer(self, server):
+        raise exceptions.NotImplementedError("Use setMap() to add servers.")
+
+    removeServer = addServer
+
+    def _serverOf(self, key):
+        return self.vbmap.serverOf(key)
+
+    def _canRetry(self, e, attempt):
+        return isinstance(e, MemcachedError) \
+            and e.status == memcacheConstants.ERR_NOT_MY_VBUCKET \
+            and self.configProvider is not None \
+            and attempt < self.maxRetries
+
+    def _retry(self, f):
+        """Call f, refreshing the map and retrying on ERR_NOT_MY_VBUCKET."""
+        attempt=0
+        while True:
+            try:
+                return f()
+            except MemcachedError, e:
+                if not self._canRetry(e, attempt):
+                    raise
+            attempt += 1
+            self.refresh()
+
+    def _retryFailed(self, f, keys):
+        """Call f(keys) for a dict of results, retrying the keys that got
+        ERR_NOT_MY_VBUCKET with a refreshed map."""
+        rv={}
+        attempt=0
+        while True:
+            results=f(keys)
+            rv.update(results)
+            keys=[k for k, v in results.iteritems()
+                  if self._canRetry(v, attempt)]
+            if not keys:
+                return rv
+            for k in keys:
+                del rv[k]
+            attempt += 1
+            self.refresh()
+
+    def _call(self, name, key, args, kwargs):
+        return self._retry(
+            lambda: MemcachedCluster._call(self, name, key, args, kwargs))
+
+    def getMulti(self, keys):
+        keys=list(keys)
+        return self._retry(lambda: MemcachedCluster.getMulti(self, keys))
+
+    def setMulti(self, exp, flags, items):
+        items=dict(items)
+        return self._retryFailed(
+            lambda keys: MemcachedCluster.setMulti(
+                self, exp, flags, [(k, items[k]) for k in keys]),
+            items.keys())
+
+    def deleteMulti(self, keys):
+        return self._retryFailed(
+            lambda keys: MemcachedCluster.deleteMulti(self, keys), list(keys))
+
+    def callMulti(self, method, keys, *args, **kwargs):
+        return self._retryFailed(
+            lambda keys: MemcachedCluster.callMulti(self, method, keys,
+                                                    *args, **kwargs),
+            list(keys))
+
+class MemcachedFuture(object):
+    """The pending result of a command sent by AsyncMemcachedClient."""
+
+    def __init__(self, client):
+        self.client=client
+        self.done=False
+        self.value=None
+        self.error=None
+        self.callbacks=[]
+
+    def addCallback(self, f):
+        """Call f(future) once the command completes."""
+        if self.done:
+            f(self)
+        else:
+            self.callbacks.append(f)
+
+    def _resolve(self, value=None, error=None):
+        self.done=True
+        self.value=value
+        self.error=error
+        callbacks, self.callbacks = self.callbacks, []
+        for f in callbacks:
+            f(self)
+
+    def result(self, timeout=None):
+        """Get the result, running the client's event loop until it's in.
+
+        Raises the error the command failed with, if any."""
+        if not self.done:
+            self.client.wait(self, timeout)
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+class MemcachedClientChannel(asyncore.dispatcher):
+    """The asyncore side of an AsyncMemcachedClient connection."""
+
+    # Receive buffer size
+    BUFFER_SIZE = 65536
+
+    def __init__(self, client, addr, map):
+        asyncore.dispatcher.__init__(self, map=map)
+        self.client=client
+        self.wbuf=[]
+        self.rbuf=bytearray()
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(addr)
+
+    def push(self, data):
+        self.wbuf.append(data)
+
+    def handle_connect(self):
+        pass
+
+    def writable(self):
+        return bool(self.wbuf) or not self.connected
+
+    def handle_write(self):
+        data=''.join(self.wbuf)
+        sent=self.send(data)
+        self.wbuf=sent < len(data) and [data[sent:]] or []
+
+    def handle_read(self):
+        data=self.recv(self.BUFFER_SIZE)
+        if data:
+            self.rbuf.extend(data)
+            consumed=self.client._processResponses(self.rbuf)
+            del self.rbuf[:consumed]
+
+    def handle_close(self):
+        self.close()
+        self.client._connectionLost()
+
+class AsyncMemcachedClient(MemcachedClient):
+    """Non-blocking memcached client built on asyncore.
+
+        mc=AsyncMemcachedClient()
+        f=mc.bop_get('tree', 0, 100)
+        f.addCallback(lambda f: handle(f.value))
+        mc.set('a', 0, 0, 'x').result()
+
+    Command methods send their request and return a MemcachedFuture right
+    away.  Responses are matched to requests by opaque, so any number of
+    callers can have commands outstanding on the one connection.  Run the
+    loop with asyncore.loop(map=mc.map) (pass a shared map to run it
+    alongside other dispatchers), or wait on a future's result()."""
+
+    _statsMixin = _AsyncStatsMixin
+
+    def __init__(self, host='127.0.0.1', port=11211, map=None):
+        if map is None:
+            map={}
+        self.map=map
+        self.r=random.Random()
+        self.opaque=self.r.randint(0, 2**32)
+        # opaque -> handler(errcode, opaque, cas, body)
+        self.inflight={}
+        self.closed=False
+        self.channel=MemcachedClientChannel(self, (host, port), map)
+
+    def close(self):
+        if not self.closed:
+            self.channel.close()
+            self._connectionLost()
+
+    def _connectionLost(self):
+        self.closed=True
+        inflight, self.inflight = self.inflight, {}
+        for opaque, handler in sorted(inflight.items()):
+            handler(None, opaque, 0, None)
+
+    def _processResponses(self, buf):
+        """Dispatch every complete response in buf, returning the number
+        of bytes consumed."""
+        offset=0
+        while len(buf) - offset >= MIN_RECV_PACKET:
+            magic, cmd, keylen, extralen, dtype, errcode, remaining, \
+                opaque, cas=RES_PKT.unpack_from(buf, offset)
+            end=offset + MIN_RECV_PACKET + remaining
+            if len(buf) < end:
+                break
+            assert (magic in (RES_MAGIC_BYTE, REQ_MAGIC_BYTE)), \
+                "Got magic: %d" % magic
+            body=memoryview(buf[offset + MIN_RECV_PACKET:end])
+            offset=end
+            handler=self.inflight.pop(opaque, None)
+            assert handler, "unexpected opaque %x" % opaque
+            handler(errcode, opaque, cas, body)
+        return offset
+
+    def _send(self, cmd, key, val, extraHeader, cas, handler):
+        if self.closed:
+            raise exceptions.EOFError("Connection is closed.")
+        self.opaque=(self.opaque + 1) & 0xffffffff
+        self.inflight[self.opaque]=handler
+        self.channel.push(self._encodeCmd(cmd, key, val, self.opaque,
+                                          extraHeader, cas))
+
+    def __sendForFuture(self, cmd, key, val, extraHeader, cas, parse):
+        future=MemcachedFuture(self)
+        def handler(errcode, opaque, cas, body):
+            if errcode is None:
+                future._resolve(error=exceptions.EOFError(
+                    "Got empty data (remote died?)."))
+            elif errcode != 0:
+                future._resolve(error=MemcachedError(errcode, body.tobytes()))
+            else:
+                try:
+                    rv=parse(opaque, cas, body)
+                except Exception, e:
+                    future._resolve(error=e)
+                else:
+                    future._resolve(rv)
+        self._send(cmd, key, val, extraHeader, cas, handler)
+        return future
+
+    def _doCmd(self, cmd, key, val, extraHeader='', cas=0, parse=None):
+        def f(opaque, cas, body):
+            rv=opaque, cas, body.tobytes()
+            if parse:
+                rv=parse(rv)
+            return rv
+        return self.__sendForFuture(cmd, key, val, extraHeader, cas, f)
+
+    def _doCmdView(self, cmd, key, val, extraHeader='', cas=0, parse=None):
+        def f(opaque, cas, body):
+            if parse:
+                return parse(body)
+            return body.tobytes()
+        return self.__sendForFuture(cmd, key, val, extraHeader, cas, f)
+
+    def getMulti(self, keys):
+        """Get values for any available keys in the given iterable.
+
+        Returns a MemcachedFuture for the dict of matched keys to their
+        values."""
+        future=MemcachedFuture(self)
+        rv={}
+        errors=[]
+        pending=[0]
+        def collect(key):
+            def f(g):
+                if g.error is None:
+                    rv[key]=g.value
+                elif not (isinstance(g.error, MemcachedError)
+                          and g.error.status == memcacheConstants.ERR_NOT_FOUND):
+                    errors.append(g.error)
+                pending[0] -= 1
+                if pending[0] == 0:
+                    future._resolve(rv, errors and errors[0] or None)
+            return f
+        for key in keys:
+            pending[0] += 1
+            self.get(key).addCallback(collect(key))
+        if pending[0] == 0:
+            future._resolve(rv)
+        return future
+
+    def _unsupported(self, *args, **kwargs):
+        raise exceptions.NotImplementedError(
+            "Not available on the asynchronous client.")
+
+    iterGetMulti = stats = sasl_auth_cram_md5 = pipeline = _unsupported
+    bop_insert_bulk = lop_push_bulk = lop_pop_batch = sop_exist_multi = _unsupported
+    bop_scan = getattrs_multi = _unsupported
+    setMulti = addMulti = replaceMulti = deleteMulti = _unsupported
+    incrMulti = decrMulti = _unsupported
+
+    def wait(self, future, timeout=None):
+        """Run the event loop until the given future is done."""
+        deadline=timeout is not None and time.time() + timeout
+        while not future.done:
+            wait=1.0
+            if deadline:
+                wait=deadline - time.time()
+                if wait <= 0:
+                    raise socket.timeout("Timed out waiting for a response.")
+            asyncore.loop(timeout=wait, count=1, map=self.map)
+
+# A message of a TAP stream.  cmd is its CMD_TAP_* opcode; flags and exp
+# are only set for mutations.
+TapEvent=collections.namedtuple('TapEvent',
+    'cmd vbucket key value flags exp cas')
+
+class TapClient(object):
+    """Consume the TAP stream of a server as TapEvents.
+
+        tap=TapClient(name='warmer', dump=True)
+        for event in tap:
+            if event.cmd == memcacheConstants.CMD_TAP_MUTATION:
+                cache[event.key]=event.value
+
+    backfill streams the changes since the given timestamp (0 for
+    everything) before the live ones, dump ends the stream once the existing
+    items have been sent, vbuckets limits the stream to the given vbuckets
+    and keysOnly leaves the values out.
+
+    When the server asks for acknowledgements they're sent once the
+    consumer has moved past the event, batched ackBatch at a time or
+    whenever the next event isn't already buffered."""
+
+    def __init__(self, host='127.0.0.1', port=11211, name='', backfill=None,
+                 dump=False, vbuckets=None, takeover=False, keysOnly=False,
+                 ackBatch=64):
+        self.client=MemcachedClient(host, port)
+        self.ackBatch=ackBatch
+        self.acks=[]
+        flags=memcacheConstants.TAP_FLAG_SUPPORT_ACK
+        body=''
+        if backfill is not None:
+            flags |= memcacheConstants.TAP_FLAG_BACKFILL
+            body += struct.pack(memcacheConstants.TAP_FLAG_TYPES[
+                memcacheConstants.TAP_FLAG_BACKFILL], backfill)
+        if dump:
+            flags |= memcacheConstants.TAP_FLAG_DUMP
+        if vbuckets is not None:
+            flags |= memcacheConstants.TAP_FLAG_LIST_VBUCKETS
+            body += struct.pack('>H%dH' % len(vbuckets), len(vbuckets),
+                                *vbuckets)
+        if takeover:
+            flags |= memcacheConstants.TAP_FLAG_TAKEOVER_VBUCKETS
+        if keysOnly:
+            flags |= memcacheConstants.TAP_FLAG_KEYS_ONLY
+        self.client._sendCmd(memcacheConstants.CMD_TAP_CONNECT, name, body, 0,
+                             memcacheConstants.TAP_CONNECT_PKT.pack(flags))
+
+    def close(self):
+        self.client.close()
+
+    def flushAcks(self):
+        """Send the pending acknowledgements."""
+        acks, self.acks = self.acks, []
+        self.client._send(''.join([RES_PKT.pack(RES_MAGIC_BYTE, cmd, 0, 0,
+                                                    0, 0, 0, opaque, 0)
+                                       for cmd, opaque in acks]))
+
+    def __decode(self, cmd, keylen, extralen, vbucket, cas, body):
+        flags=exp=0
+        if cmd == memcacheConstants.CMD_TAP_MUTATION:
+            enginelen, tapflags, ttl, flags, exp=\
+                memcacheConstants.TAP_MUTATION_PKT.unpack_from(body)
+        elif extralen >= memcacheConstants.TAP_GENERAL_PKT.size:
+            enginelen, tapflags, ttl=\
+                memcacheConstants.TAP_GENERAL_PKT.unpack_from(body)
+        else:
+            enginelen=tapflags=0
+        # The engine specific data sits between the extras and the key.
+        pos=extralen + enginelen
+        key=body[pos:pos + keylen].tobytes()
+        value=body[pos + keylen:].tobytes()
+        return tapflags, TapEvent(cmd, vbucket, key, value, flags, exp, cas)
+
+    def __iter__(self):
+        reader=self.client.reader
+        while True:
+            if self.acks and (len(self.acks) >= self.ackBatch
+                              or not reader.hasPacket()):
+                self.flushAcks()
+            try:
+                magic, cmd, keylen, extralen, dtype, vbucket, remaining, \
+                    opaque, cas=reader.readHeader()
+            except exceptions.EOFError:
+                if reader.start != reader.end:
+                    raise
+                # The server ended the stream.
+                return
+            body=reader.readBody(remaining)
+            if magic == RES_MAGIC_BYTE:
+                if vbucket != 0:
+                    # For a response, that's the status.
+                    raise MemcachedError(vbucket, body.tobytes())
+                continue
+            if cmd == memcacheConstants.CMD_NOOP:
+                continue
+            tapflags, event=self.__decode(cmd, keylen, extralen, vbucket,
+                                          cas, body)
+            yield event
+            if tapflags & memcacheConstants.TAP_MSG_FLAG_ACK:
+                self.acks.append((cmd, opaque))
+
+class StatsSampler(object):
+    """Poll the stats of one or more servers in a background thread.
+
+        sampler=StatsSampler(['10.0.0.1:11211', '10.0.0.2:11211'],
+                             interval=10, textfile='/var/lib/prom/mc.prom')
+        sampler.start()
+        sampler.latest()['10.0.0.1:11211']['rates']['cmd_get']
+
+    servers are given as for MemcachedCluster, or as a MemcachedCluster.
+    The sampler has connections of its own, so it never holds up the
+    application's.  Every interval each server's stats, and those of the
+    subs groups (keyed "sub:name"), are fetched and the numbers parsed.  A
+    sample is a dict of its time, the server, the stats, and the deltas and
+    per-second rates of the counters since the server's previous sample, or
+    of the error polling it failed with.  The last history samples of each
+    server are kept.  After every round the latest samples are written to
+    textfile in the Prometheus text format (replacing it atomically) and
+    appended to jsonfile as JSON lines, if given.  A round the sampling
+    thread fails (e.g. with an IOError writing a file) is counted in
+    failedRounds, its exception kept as lastError, and sampling goes on."""
+
+    # Stats that only ever grow, besides those matched below.
+    COUNTERS=frozenset(['evictions', 'reclaimed', 'bytes_read',
+                        'bytes_written', 'rusage_user', 'rusage_system',
+                        'expired_unfetched', 'evicted_unfetched',
+                        'auth_cmds', 'auth_errors', 'conn_yields'])
+    COUNTER_PREFIXES=('cmd_', 'total_')
+    COUNTER_SUFFIXES=('_hits', '_misses', ':evicted')
+
+    def __init__(self, servers, interval=10.0, subs=(), history=360,
+                 textfile=None, jsonfile=None, timeout=1.0):
+        if isinstance(servers, MemcachedCluster):
+            servers=servers.clients.keys()
+        self.interval=interval
+        self.subs=subs
+        self.textfile=textfile
+        self.jsonfile=jsonfile
+        self.clients=collections.OrderedDict()
+        self.samples={}
+        for server in servers:
+            host, port, weight=MemcachedCluster._parseServer(server)
+            name="%s:%d" % (host, port)
+            self.clients[name]=MemcachedClient(host, port, timeout)
+            self.samples[name]=collections.deque(maxlen=history)
+        self.lock=threading.Lock()
+        # Held while polling, since the connections can't be shared.
+        self.polling=threading.Lock()
+        self.stopped=threading.Event()
+        self.thread=None
+        self.errors=0
+        self.failedRounds=0
+        self.lastError=None
+
+    def start(self):
+        """Start sampling in a daemon thread."""
+        assert self.thread is None, "already started"
+        self.stopped.clear()
+        self.thread=threading.Thread(target=self.__run,
+                                     name='StatsSampler')
+        self.thread.daemon=True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop the sampling thread and close the connections."""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread=None
+        for mc in self.clients.values():
+            mc.close()
+
+    def __run(self):
+        next=time.time()
+        while not self.stopped.is_set():
+            try:
+                self.sample()
+            except exceptions.Exception, e:
+                self.failedRounds += 1
+                self.lastError=e
+            # Keep to the schedule, skipping rounds we're too late for.
+            next += self.interval
+            now=time.time()
+            if next < now:
+                next=now
+            self.stopped.wait(next - now)
+
+    @classmethod
+    def isCounter(cls, name):
+        return (name in cls.COUNTERS or name.startswith(cls.COUNTER_PREFIXES)
+                or name.endswith(cls.COUNTER_SUFFIXES))
+
+    @staticmethod
+    def parse(stats, prefix=''):
+        """Turn the numbers of a stats dict into ints or floats."""
+        rv={}
+        for k, v in stats.iteritems():
+            try:
+                v=int(v)
+            except ValueError:
+                try:
+                    v=float(v)
+                except ValueError:
+                    pass
+            rv[prefix + k]=v
+        return rv
+
+    def __poll(self, mc):
+        stats=self.parse(mc.stats())
+        for sub in self.subs:
+            stats.update(self.parse(mc.stats(sub), sub + ':'))
+        return stats
+
+    def sample(self):
+        """Poll every server once; returns a dict of server to sample."""
+        with self.polling:
+            return self.__sample()
+
+    def __sample(self):
+        rv={}
+        for name, mc in self.clients.iteritems():
+            now=time.time()
+            try:
+                stats=self.__poll(mc)
+            except (MemcachedError, socket.error, exceptions.EOFError), e:
+                self.errors += 1
+                rv[name]={'time': now, 'server': name, 'error': str(e)}
+                continue
+            deltas={}
+            rates={}
+            prev=self.__previous(name)
+            if prev is not None:
+                elapsed=now - prev['time']
+                for k, v in stats.iteritems():
+                    old=prev['stats'].get(k)
+                    if (self.isCounter(k) and isinstance(v, (int, long, float))
+                        and isinstance(old, (int, long, float))):
+                        deltas[k]=v - old
+                        if deltas[k] < 0:
+                            # The server restarted.
+                            deltas[k]=v
+                        rates[k]=elapsed > 0 and deltas[k] / elapsed or 0.0
+            rv[name]={'time': now, 'server': name, 'stats': stats,
+                      'deltas': deltas, 'rates': rates}
+        with self.lock:
+            for name, sample in rv.iteritems():
+                self.samples[name].append(sample)
+        if self.textfile:
+            self.writeTextfile(self.textfile, rv)
+        if self.jsonfile:
+            with open(self.jsonfile, 'a') as f:
+                for name in self.clients:
+                    f.write(json.dumps(rv[name], sort_keys=True) + '\n')
+        return rv
+
+    def __previous(self, name):
+        """The last successful sample of a server, or None."""
+        with self.lock:
+            for sample in reversed(self.samples[name]):
+                if 'stats' in sample:
+                    return sample
+        return None
+
+    def latest(self):
+        """Get a dict of server to its most recent sample."""
+        with self.lock:
+            return dict((name, samples[-1])
+                        for name, samples in self.samples.iteritems()
+                        if samples)
+
+    def history(self, server):
+        """Get the kept samples of a server, oldest first."""
+        with self.lock:
+            return list(self.samples[server])
+
+    def writeTextfile(self, path, samples):
+        """Write samples in the Prometheus text format, atomically."""
+        # metric -> (type, [(server, value)])
+        metrics=collections.OrderedDict()
+        def add(metric, type, server, value):
+            metrics.setdefault(metric, (type, []))[1].append((server, value))
+        for name in self.clients:
+            sample=samples[name]
+            add('memcached_up', 'gauge', name, int('stats' in sample))
+            for k, v in sorted(sample.get('stats', {}).iteritems()):
+                if not isinstance(v, (int, long, float)):
+                    continue
+                metric='memcached_' + re.sub('[^a-zA-Z0-9_]', '_', k)
+                if self.isCounter(k):
+                    add(metric + '_total', 'counter', name, v)
+                    if k in sample['rates']:
+                        add(metric + '_rate', 'gauge', name,
+                            sample['rates'][k])
+                else:
+                    add(metric, 'gauge', name, v)
+        lines=[]
+        for metric, (type, values) in metrics.iteritems():
+            lines.append('# TYPE %s %s' % (metric, type))
+            for server, value in values:
+                lines.append('%s{server="%s"} %r' % (metric, server, value))
+        tmp=path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(tmp, path)
@@ -23,6 +23,18 @@ CMD_STAT = 0x10
 CMD_APPEND = 0x0e
 CMD_PREPEND = 0x0f
 
+# Quiet commands (no response unless something goes wrong)
+CMD_SETQ = 0x11
+CMD_ADDQ = 0x12
+CMD_REPLACEQ = 0x13
+CMD_DELETEQ = 0x14
+CMD_INCRQ = 0x15
+CMD_DECRQ = 0x16
+CMD_QUITQ = 0x17
+CMD_FLUSHQ = 0x18
+CMD_APPENDQ = 0x19
+CMD_PREPENDQ = 0x1a
+
 # SASL stuff
 CMD_SASL_LIST_MECHS = 0x20
 CMD_SASL_AUTH = 0x21
@@ -52,6 +64,7 @@ CMD_SOP_INSERT = 0x71
 CMD_SOP_DELETE = 0x72
 CMD_SOP_EXIST  = 0x73
 CMD_SOP_GET    = 0x74
+CMD_SOP_EXIST_MULTI = 0x75
 
 # COLLECTION: B+Tree stuff
 CMD_BOP_CREATE = 0x80
@@ -95,6 +108,8 @@ COUNT_RES_FMT=">L"
 VLENG_RES_FMT=">L"
 EXIST_RES_FMT=">L"
 BKEY_RES_FMT=">Q"
+# flags, element count; heads every collection get response
+COLL_GET_RES_FMT=">LL"
 LOP_CRT_PKT_FMT=">LllBBBB"
 LOP_INS_PKT_FMT=">lLIIBBBB"
 LOP_DEL_PKT_FMT=">llBBBB"
@@ -103,6 +118,7 @@ SOP_CRT_PKT_FMT=">LII"
 SOP_INS_PKT_FMT=">LIIBBBB"
 SOP_DEL_PKT_FMT=">BBBB"
 SOP_GET_PKT_FMT=">LBBBB"
+# SOP_EXIST_MULTI sends VLENG_RES_FMT-prefixed values and gets a byte per value
 BOP_CRT_PKT_FMT=">LIIBBBB"
 BOP_INS_PKT_FMT=">QLIIBBBB"
 BOP_DEL_PKT_FMT=">QQLBBBB"
@@ -116,6 +132,8 @@ TAP_FLAG_BACKFILL          = 0x01
 TAP_FLAG_DUMP              = 0x02
 TAP_FLAG_LIST_VBUCKETS     = 0x04
 TAP_FLAG_TAKEOVER_VBUCKETS = 0x08
+TAP_FLAG_SUPPORT_ACK       = 0x10
+TAP_FLAG_KEYS_ONLY         = 0x20
 
 TAP_FLAG_TYPES = {TAP_FLAG_BACKFILL: ">Q"}
 
@@ -125,13 +143,35 @@ SET_PKT_FMT=">II"
 # flags
 GET_RES_FMT=">I"
 
+# Item flags bit the client sets on values it compressed; on a collection
+# it means each element starts with one of the ELEM_* header bytes.
+FLAG_COMPRESSED=0x80000000
+ELEM_RAW='\x00'
+ELEM_COMPRESSED='\x01'
+
+# Item flags bits holding the tag of the type a value was serialized from.
+# On a collection, TYPE_TAGGED means each element starts with its tag byte.
+FLAG_TYPE_MASK=0x0f000000
+FLAG_TYPE_SHIFT=24
+TYPE_BYTES=0
+TYPE_INT=1
+TYPE_UNICODE=2
+TYPE_MARSHAL=3
+TYPE_PICKLE=4
+TYPE_TAGGED=15
+
 # How long until the deletion takes effect.
 DEL_PKT_FMT=""
 
 ## TAP stuff
+# connect flags
+TAP_CONNECT_PKT_FMT = ">I"
+# Flags of a TAP message
+TAP_MSG_FLAG_ACK      = 0x01
+TAP_MSG_FLAG_NO_VALUE = 0x02
 # eng-specific length, flags, ttl, [res, res, res]; item flags, exp
-TAP_MUTATION_PKT_FMT = "HHbxxxII"
-TAP_GENERAL_PKT_FMT = "HHbxxx"
+TAP_MUTATION_PKT_FMT = ">HHBxxxII"
+TAP_GENERAL_PKT_FMT = ">HHBxxx"
 
 # amount, initial value, expiration
 INCRDECR_PKT_FMT=">QQI"
@@ -163,6 +203,19 @@ EXTRA_HDR_FMTS={
     CMD_DECR: INCRDECR_PKT_FMT,
     CMD_DELETE: DEL_PKT_FMT,
     CMD_FLUSH: FLUSH_PKT_FMT,
+    CMD_SETQ: SET_PKT_FMT,
+    CMD_ADDQ: SET_PKT_FMT,
+    CMD_REPLACEQ: SET_PKT_FMT,
+    CMD_INCRQ: INCRDECR_PKT_FMT,
+    CMD_DECRQ: INCRDECR_PKT_FMT,
+    CMD_DELETEQ: DEL_PKT_FMT,
+    CMD_FLUSHQ: FLUSH_PKT_FMT,
+    CMD_SOP_CREATE: SOP_CRT_PKT_FMT,
+    CMD_SOP_INSERT: SOP_INS_PKT_FMT,
+    CMD_SOP_DELETE: SOP_DEL_PKT_FMT,
+    CMD_SOP_GET: SOP_GET_PKT_FMT,
+    CMD_SETATTR: SETATTR_PKT_FMT,
+    CMD_TAP_CONNECT: TAP_CONNECT_PKT_FMT,
     CMD_TAP_MUTATION: TAP_MUTATION_PKT_FMT,
     CMD_TAP_DELETE: TAP_GENERAL_PKT_FMT,
     CMD_TAP_FLUSH: TAP_GENERAL_PKT_FMT,
@@ -173,9 +226,46 @@ EXTRA_HDR_FMTS={
 EXTRA_HDR_SIZES=dict(
     [(k, struct.calcsize(v)) for (k,v) in EXTRA_HDR_FMTS.items()])
 
+# Every format compiled once.  Each is named after its format without the
+# _FMT suffix, e.g. REQ_PKT for REQ_PKT_FMT.
+REQ_PKT=struct.Struct(REQ_PKT_FMT)
+RES_PKT=struct.Struct(RES_PKT_FMT)
+SET_PKT=struct.Struct(SET_PKT_FMT)
+GET_RES=struct.Struct(GET_RES_FMT)
+INCRDECR_PKT=struct.Struct(INCRDECR_PKT_FMT)
+INCRDECR_RES=struct.Struct(INCRDECR_RES_FMT)
+FLUSH_PKT=struct.Struct(FLUSH_PKT_FMT)
+COUNT_RES=struct.Struct(COUNT_RES_FMT)
+VLENG_RES=struct.Struct(VLENG_RES_FMT)
+EXIST_RES=struct.Struct(EXIST_RES_FMT)
+BKEY_RES=struct.Struct(BKEY_RES_FMT)
+COLL_GET_RES=struct.Struct(COLL_GET_RES_FMT)
+LOP_CRT_PKT=struct.Struct(LOP_CRT_PKT_FMT)
+LOP_INS_PKT=struct.Struct(LOP_INS_PKT_FMT)
+LOP_DEL_PKT=struct.Struct(LOP_DEL_PKT_FMT)
+LOP_GET_PKT=struct.Struct(LOP_GET_PKT_FMT)
+SOP_CRT_PKT=struct.Struct(SOP_CRT_PKT_FMT)
+SOP_INS_PKT=struct.Struct(SOP_INS_PKT_FMT)
+SOP_DEL_PKT=struct.Struct(SOP_DEL_PKT_FMT)
+SOP_GET_PKT=struct.Struct(SOP_GET_PKT_FMT)
+BOP_CRT_PKT=struct.Struct(BOP_CRT_PKT_FMT)
+BOP_INS_PKT=struct.Struct(BOP_INS_PKT_FMT)
+BOP_DEL_PKT=struct.Struct(BOP_DEL_PKT_FMT)
+BOP_GET_PKT=struct.Struct(BOP_GET_PKT_FMT)
+BOP_CNT_PKT=struct.Struct(BOP_CNT_PKT_FMT)
+GETATTR_RES=struct.Struct(GETATTR_RES_FMT)
+SETATTR_PKT=struct.Struct(SETATTR_PKT_FMT)
+TAP_CONNECT_PKT=struct.Struct(TAP_CONNECT_PKT_FMT)
+TAP_MUTATION_PKT=struct.Struct(TAP_MUTATION_PKT_FMT)
+TAP_GENERAL_PKT=struct.Struct(TAP_GENERAL_PKT_FMT)
+
+EXTRA_HDR_STRUCTS=dict(
+    [(k, struct.Struct(v)) for (k,v) in EXTRA_HDR_FMTS.items()])
+
 ERR_UNKNOWN_CMD = 0x81
 ERR_NOT_FOUND = 0x1
 ERR_EXISTS = 0x2
+ERR_NOT_MY_VBUCKET = 0x7
 ERR_AUTH = 0x20
 ERR_AUTH_CONTINUE = 0x21
 
@@ -51,11 +51,8 @@ class ComplianceTest(unittest.TestCase):
         print "BOP prepare begin"  
         for x in range(0, key_cnt_ini):
             bkey = "bkey" + str(x)
-            for y in range(0, dat_cnt):
-                data = self.getData(bkey, y)
-                if y == 0: create = 1
-                else:      create = 0
-                self.mc.bop_insert(bkey, y, data, create, 11, 0, 0)
+            elements = ((y, self.getData(bkey, y)) for y in range(0, dat_cnt))
+            self.assertEquals([], self.mc.bop_insert_bulk(bkey, elements, 1, 11, 0, 0))
             if x % 10 == 9:
                print "  " + str(x+1) + " b+trees created"
         print "BOP prepare end"  
@@ -64,11 +61,8 @@ class ComplianceTest(unittest.TestCase):
             """ BOP insert """
             kidx = x + key_cnt_ini
             bkey = "bkey" + str(kidx)
-            for y in range(0, dat_cnt):
-                data = self.getData(bkey, y)
-                if y == 0: create = 1
-                else:      create = 0
-                self.mc.bop_insert(bkey, y, data, create, 11, 0, 0)
+            elements = ((y, self.getData(bkey, y)) for y in range(0, dat_cnt))
+            self.assertEquals([], self.mc.bop_insert_bulk(bkey, elements, 1, 11, 0, 0))
             """ BOP get """
             """ rcnt: run count """
             """ dcnt: data count """
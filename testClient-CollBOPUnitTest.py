@@ -16,7 +16,8 @@ import exceptions
 import unittest
 
 import memcacheConstants
-from mc_bin_client import MemcachedClient, MemcachedError
+from mc_bin_client import MemcachedClient, MemcachedError, Compressor, Serializer
+from mc_bin_client import ShardedBTree
 
 class ComplianceTest(unittest.TestCase):
 
@@ -575,6 +576,125 @@ class ComplianceTest(unittest.TestCase):
         except MemcachedError, e:
             self.assertEquals(memcacheConstants.ERR_NOT_FOUND, e.status)
         self.assertNotExists("bkey")
+
+    def testBOPGetAsArray(self):
+        """ Test bop get returning bkeys as a numpy array. """
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("numpy is not installed")
+        self.bulkBOPInsert("bkey", 0, 990, 10, 1, 11, 0, 0)
+        flags, count, bkeys, vals = self.mc.bop_get("bkey", 990, 0, asarray=True)
+        self.assertEquals((11, 100), (flags, count))
+        self.assertEquals(numpy.uint64, bkeys.dtype)
+        self.assertEquals(range(990, -1, -10), bkeys.tolist())
+        self.assertEquals(["bkey_data_" + str(x) for x in range(990, -1, -10)], vals)
+        self.mc.delete("bkey")
+
+    def testBOPGetLazy(self):
+        """ Test bop get returning a lazy element view. """
+        self.bulkBOPInsert("bkey", 0, 990, 10, 1, 11, 0, 0)
+        view = self.mc.bop_get("bkey", 0, 990, lazy=True)
+        self.assertEquals((11, 100), (view.flags, view.count))
+        self.assertEquals(100, len(view))
+        self.assertEquals(range(0, 1000, 10), view.bkeys)
+        self.assertEquals(len("bkey_data_500"), view.lengths[50])
+        self.assertEquals((500, "bkey_data_500"), view[50])
+        self.assertEquals("bkey_data_990", view.views[-1].tobytes())
+        self.assertEquals([(0, "bkey_data_0"), (10, "bkey_data_10")], view[:2])
+        self.assertEquals(self.mc.bop_get("bkey", 0, 990)[3], list(view.values))
+        self.mc.delete("bkey")
+
+    def testBOPInsertBulk(self):
+        """ Test bop bulk insert reports failed elements. """
+        self.assertNotExists("bkey")
+        elements = [(x, "bkey_data_" + str(x)) for x in range(0, 1000, 10)]
+        self.assertEquals([], self.mc.bop_insert_bulk("bkey", elements, 1, 11, 0, 0, window=16))
+        self.assertBOPGet("bkey", 10, 11, 0, 990)
+        failed = self.mc.bop_insert_bulk("bkey", [(5, "new"), (10, "dup"), (15, "new")])
+        self.assertEquals([10], [bkey for bkey, e in failed])
+        self.assertEquals(memcacheConstants.ERR_ELEM_EXISTS, failed[0][1].status)
+        self.assertEquals(102, self.mc.getattr("bkey", memcacheConstants.ATTR_COUNT))
+        self.mc.delete("bkey")
+        self.assertNotExists("bkey")
+
+    def testBOPScan(self):
+        """ Test bop paged range scan. """
+        self.bulkBOPInsert("bkey", 10, 1000, 10, 1, 11, 0, 0)
+        flags, count, bkeys, vals = self.mc.bop_get("bkey", 0, 2000)
+        self.assertEquals(zip(bkeys, vals), list(self.mc.bop_scan("bkey", 0, 2000, 7)))
+        self.assertEquals(zip(bkeys, vals)[::-1], list(self.mc.bop_scan("bkey", 2000, 0, 7)))
+        self.assertEquals(zip(bkeys, vals)[4:9], list(self.mc.bop_scan("bkey", 45, 90, 5)))
+        self.assertEquals([], list(self.mc.bop_scan("bkey", 1001, 2000)))
+        scan = self.mc.bop_scan("bkey", 0, 2000, 10)
+        scan.next()
+        scan.close()
+        self.assertEquals((11, 100), self.mc.bop_count("bkey", 0, 2000))
+        self.assertEquals(zip(bkeys, vals)[:2][::-1], list(self.mc.bop_scan("bkey", 20, 0, 1)))
+        self.mc.delete("bkey")
+
+    def testBOPScanErrors(self):
+        """ Test bop scan of a missing key leaves the connection usable. """
+        try:
+            list(self.mc.bop_scan("bkey", 0, 2000, 10))
+            self.fail("expected not found error.")
+        except MemcachedError, e:
+            self.assertEquals(memcacheConstants.ERR_NOT_FOUND, e.status)
+        self.mc.bop_insert("bkey", 0, "bkey_data_0", 1, 11, 0, 0)
+        self.assertEquals([(0, "bkey_data_0")], list(self.mc.bop_scan("bkey", 5, 0, 1)))
+        self.mc.delete("bkey")
+
+    def testBOPCompressed(self):
+        """ Test bop elements compressed one by one. """
+        big = "bkey_data_" * 500
+        self.mc.compressor = Compressor(threshold=100, collections=True)
+        self.mc.bop_insert("bkey", 10, big, 1, 11, 0, 0)
+        self.assertEquals([], self.mc.bop_insert_bulk("bkey", [(20, "small"), (30, big)]))
+        self.assertEquals((11, 3, [10, 20, 30], [big, "small", big]),
+                          self.mc.bop_get("bkey", 0, 100))
+        view = self.mc.bop_get("bkey", 0, 100, lazy=True)
+        self.assertEquals(11, view.flags)
+        self.assertEquals([(10, big), (20, "small"), (30, big)], list(view))
+        self.assertTrue(view.lengths[0] < 100)
+        self.assertEquals(2, self.mc.compressor.stats()["compressed"])
+        self.mc.delete("bkey")
+
+    def testBOPSerialized(self):
+        """ Test bop elements of mixed types, serialized then compressed. """
+        elements = [(10, 7), (20, u"datum"), (30, "datum"), (40, range(100))]
+        self.mc.serializer = Serializer(collections=True)
+        self.mc.compressor = Compressor(threshold=100, collections=True)
+        self.assertEquals([], self.mc.bop_insert_bulk("bkey", elements, 1, 11, 0, 0))
+        flags, count, bkeys, vals = self.mc.bop_get("bkey", 0, 100)
+        self.assertEquals((11, elements), (flags, zip(bkeys, vals)))
+        self.assertEquals(elements, list(self.mc.bop_get("bkey", 0, 100, lazy=True)))
+        self.assertEquals(elements, list(self.mc.bop_scan("bkey", 0, 100, 3)))
+        self.mc.delete("bkey")
+
+    def testShardedBTree(self):
+        """ Test a b+tree sharded by hash and by range. """
+        bkeys = range(0, 1000, 7)
+        for tree in (ShardedBTree(self.mc, "bkey", shards=4, flags=11),
+                     ShardedBTree(self.mc, "bkey", bounds=[100, 500], flags=11)):
+            tree.insert(0, "bkey_data_0")
+            self.assertEquals([], tree.insert_bulk([(x, "bkey_data_" + str(x)) for x in bkeys[1:]]))
+            self.assertEquals(11, self.mc.getattr("bkey:1", memcacheConstants.ATTR_FLAGS))
+            self.assertEquals(len(bkeys), tree.count(0, 2000))
+            self.assertEquals([(x, "bkey_data_" + str(x)) for x in bkeys], tree.get(0, 2000))
+            self.assertEquals(bkeys[::-1][3:8], [b for b, v in tree.get(2000, 0, 3, 5)])
+            self.assertEquals([x for x in bkeys if 50 <= x <= 600][2:6],
+                              [b for b, v in tree.get(50, 600, 2, 4)])
+            tree.delete(0, 2000, 10)
+            self.assertEquals(bkeys[10:], [b for b, v in tree.get(0, 2000)])
+            tree.delete(0, 2000)
+            try:
+                tree.delete(0, 2000)
+                self.fail("expected element not found error.")
+            except MemcachedError, e:
+                self.assertEquals(memcacheConstants.ERR_ELEM_NOENT, e.status)
+            self.assertEquals(0, tree.count(0, 2000))
+            tree.drop()
+            self.assertNotExists("bkey:0")
 # JHPARK: BOP test end
 
 if __name__ == '__main__':
@@ -16,7 +16,7 @@ import exceptions
 import unittest
 
 import memcacheConstants
-from mc_bin_client import MemcachedClient, MemcachedError
+from mc_bin_client import MemcachedClient, MemcachedError, Compressor
 
 class ComplianceTest(unittest.TestCase):
 
@@ -422,6 +422,67 @@ class ComplianceTest(unittest.TestCase):
         except MemcachedError, e:
             self.assertEquals(memcacheConstants.ERR_NOT_FOUND, e.status)
         self.assertNotExists("lkey")
+
+    def testLOPGetLazy(self):
+        """ Test lop get returning a lazy element view. """
+        create = 1
+        self.mc.lop_insert("lkey", 0, "datum0", create, 17, 0, 0)
+        self.mc.lop_insert("lkey", 1, "datum1")
+        self.mc.lop_insert("lkey", 2, "datum2")
+        view = self.mc.lop_get("lkey", 0, -1, lazy=True)
+        self.assertEquals((17, 3), (view.flags, view.count))
+        self.assertEquals(None, view.bkeys)
+        self.assertEquals(["datum0", "datum1", "datum2"], list(view))
+        self.assertEquals("datum2", view[-1])
+        self.assertEquals([6, 6, 6], list(view.lengths))
+        self.mc.delete("lkey")
+
+    def testLOPPushBulkPopBatch(self):
+        """ Test lop bulk push and batched pop. """
+        self.assertNotExists("lkey")
+        values = ["datum" + str(x) for x in range(100)]
+        self.assertEquals([], self.mc.lop_push_bulk("lkey", values, -1, 1, 17, 0, 0, window=8))
+        self.assertEquals([], self.mc.lop_push_bulk("lkey", ["head0", "head1"], 0))
+        self.assertEquals(102, self.mc.getattr("lkey", memcacheConstants.ATTR_COUNT))
+        self.assertEquals([], self.mc.lop_pop_batch("lkey", 0))
+        self.assertEquals([], self.mc.lop_pop_batch("lkey", 0, from_tail=True))
+        self.assertRaises(exceptions.ValueError, self.mc.lop_pop_batch, "lkey", -1)
+        self.assertEquals(102, self.mc.getattr("lkey", memcacheConstants.ATTR_COUNT))
+        self.assertEquals(["head0", "head1"] + values[:8], self.mc.lop_pop_batch("lkey", 10))
+        self.assertEquals(["datum99", "datum98"], self.mc.lop_pop_batch("lkey", 2, from_tail=True))
+        self.assertEquals(values[8:98], self.mc.lop_pop_batch("lkey", 1000))
+        self.assertNotExists("lkey")
+        self.assertEquals([], self.mc.lop_pop_batch("lkey", 10))
+
+    def testLOPPushBulkFailure(self):
+        """ Test lop bulk push reports failed elements and keeps going. """
+        self.assertEquals([], self.mc.lop_push_bulk("lkey", ["datum0", "datum1"], -1, 1, 17, 0, 0))
+        self.mc.setattr("lkey", 0, 0, 1, 4, 0, 0, memcacheConstants.OVFL_NONE)
+        self.mc.setattr("lkey", 0, 0, 0, 0, 0, 0, memcacheConstants.OVFL_ERROR)
+        failed = self.mc.lop_push_bulk("lkey", ["datum2", "datum3", "datum4", "datum5"], 1)
+        self.assertEquals([2, 3], [i for i, e in failed])
+        self.assertEquals(memcacheConstants.ERR_OVERFLOW, failed[0][1].status)
+        self.assertEquals((17, 4, ["datum0", "datum2", "datum3", "datum1"]),
+                          self.mc.lop_get("lkey", 0, -1))
+        # Past the tail, the values after a failure fail as well.
+        self.mc.lop_delete("lkey", 1, 2)
+        failed = self.mc.lop_push_bulk("lkey", ["datum6", "datum7"], 3)
+        self.assertEquals([0, 1], [i for i, e in failed])
+        self.assertEquals(memcacheConstants.ERR_INDEXOOR, failed[1][1].status)
+        self.assertEquals(["datum0", "datum1"], self.mc.lop_get("lkey", 0, -1)[2])
+        self.mc.delete("lkey")
+
+    def testLOPCompressed(self):
+        """ Test lop elements compressed one by one. """
+        big = "datum" * 1000
+        self.mc.compressor = Compressor(threshold=100, collections=True)
+        self.mc.lop_create("lkey", 17, 0, 0)
+        self.assertEquals([], self.mc.lop_push_bulk("lkey", [big, "datum1"]))
+        self.assertEquals((17, 2, [big, "datum1"]), self.mc.lop_get("lkey", 0, -1))
+        # Reading only needs a compressor, not one compressing collections.
+        self.mc.compressor = Compressor()
+        self.assertEquals([big, "datum1"], list(self.mc.lop_get("lkey", 0, -1, lazy=True)))
+        self.mc.delete("lkey")
 # JHPARK: LOP test end
 
 if __name__ == '__main__':
@@ -16,7 +16,7 @@ import exceptions
 import unittest
 
 import memcacheConstants
-from mc_bin_client import MemcachedClient, MemcachedError
+from mc_bin_client import MemcachedClient, MemcachedError, Serializer
 
 class ComplianceTest(unittest.TestCase):
 
@@ -374,6 +374,43 @@ class ComplianceTest(unittest.TestCase):
         except MemcachedError, e:
             self.assertEquals(memcacheConstants.ERR_NOT_FOUND, e.status)
         self.assertNotExists("skey")
+
+    def testSOPExistMulti(self):
+        """ Test sop multi-value existence check. """
+        create = 1
+        self.assertNotExists("skey")
+        for x in range(0, 100, 2):
+            self.mc.sop_insert("skey", "datum" + str(x), create, 13, 0, 0)
+        values = ["datum" + str(x) for x in range(100)]
+        expected = dict((v, 1 - x % 2) for x, v in enumerate(values))
+        self.assertEquals(expected, self.mc.sop_exist_multi("skey", values))
+        self.mc.sopExistMulti = False
+        self.assertEquals(expected, self.mc.sop_exist_multi("skey", values))
+        try:
+            self.mc.sop_exist_multi("nokey", values)
+            self.fail("expected not found error.")
+        except MemcachedError, e:
+            self.assertEquals(memcacheConstants.ERR_NOT_FOUND, e.status)
+        self.mc.delete("skey")
+        self.assertNotExists("skey")
+
+    def testSOPSerialized(self):
+        """ Test sop elements of mixed types. """
+        values = set([7, 2 ** 70, u"\uc548", "datum", (1, "x")])
+        self.mc.serializer = Serializer(collections=True)
+        for v in values:
+            self.mc.sop_insert("skey", v, 1, 13, 0, 0)
+        flags, count, vals = self.mc.sop_get("skey", 0)
+        self.assertEquals((13, 5, values), (flags, count, set(vals)))
+        self.assertEquals(values, set(self.mc.sop_get("skey", 0, lazy=True)))
+        # Decoded elements needn't be hashable.
+        self.mc.sop_insert("skey", [1, 2])
+        self.assertTrue([1, 2] in self.mc.sop_get("skey", 0)[2])
+        self.assertEquals(1, self.mc.sop_exist("skey", 7))
+        self.assertEquals({7: 1, "7": 0}, self.mc.sop_exist_multi("skey", [7, "7"]))
+        self.mc.sop_delete("skey", (1, "x"))
+        self.assertEquals(0, self.mc.sop_exist("skey", (1, "x")))
+        self.mc.delete("skey")
 # JHPARK: SOP test end
 
 if __name__ == '__main__':
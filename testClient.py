@@ -5,18 +5,31 @@ Binary memcached test client.
 Copyright (c) 2007  Dustin Sallings <dustin@spy.net>
 """
 
+import os
 import sys
+import json
 import time
 import hmac
 import socket
 import random
+import shutil
 import struct
+import tempfile
+import zlib
+import threading
 import exceptions
 
 import unittest
 
 import memcacheConstants
 from mc_bin_client import MemcachedClient, MemcachedError
+from mc_bin_client import MemcachedClientPool, PoolTimeoutError, NearCache
+from mc_bin_client import AttributeCache, TimeoutError, ServerDownError
+from mc_bin_client import LatencyHistogram, Compressor
+from mc_bin_client import Serializer, StatsSampler
+from mc_bin_client import HashRing, MemcachedCluster
+from mc_bin_client import VBucketMap, VBucketCluster
+from mc_bin_client import AsyncMemcachedClient, TapClient
 
 class ComplianceTest(unittest.TestCase):
 
@@ -38,6 +51,15 @@ class ComplianceTest(unittest.TestCase):
         self.mc.set("x", 5, 19, "somevalue")
         self.assertGet((19, "somevalue"), self.mc.get("x"))
 
+    def testLargeSetGet(self):
+        """Test values larger than the client's receive buffer."""
+        big="x" * (3 * 1024 * 1024 + 17)
+        self.mc.set("x", 5, 19, big)
+        self.mc.set("y", 5, 17, "small")
+        self.assertGet((19, big), self.mc.get("x"))
+        self.assertGet((17, "small"), self.mc.get("y"))
+        self.assertGet((19, big), self.mc.get("x"))
+
     def testZeroExpiration(self):
         """Ensure zero-expiration sets work properly."""
         self.mc.set("x", 0, 19, "somevalue")
@@ -110,6 +132,145 @@ class ComplianceTest(unittest.TestCase):
         self.assertGet((2, 'why'), vals['y'])
         self.assertEquals(2, len(vals))
 
+    def testIterGetMulti(self):
+        """Testing streaming multiget with a small window."""
+        self.mc.setMulti(5, 3, (('k' + str(i), 'v' + str(i))
+                                for i in range(0, 1000, 2)))
+        keys=('k' + str(i) for i in xrange(1000))
+        vals=dict(self.mc.iterGetMulti(keys, window=16))
+        self.assertEquals(500, len(vals))
+        for i in range(0, 1000, 2):
+            self.assertGet((3, 'v' + str(i)), vals['k' + str(i)])
+
+    def testIterGetMultiAbandoned(self):
+        """Test the connection is usable after abandoning a multiget."""
+        self.mc.setMulti(5, 3, (('k' + str(i), 'v') for i in range(100)))
+        for key, val in self.mc.iterGetMulti(
+                ('k' + str(i) for i in range(100)), window=10):
+            break
+        self.mc.set("x", 5, 19, "somevalue")
+        self.assertGet((19, "somevalue"), self.mc.get("x"))
+
+    def testPipeline(self):
+        """Test pipelined commands return results and errors in order."""
+        self.mc.set("x", 5, 19, "ex")
+        with self.mc.pipeline() as p:
+            p.get("x")
+            p.add("x", 5, 19, "ex2")
+            p.set("y", 5, 17, "why")
+            p.incr("z", init=7)
+            p.get("nothere")
+            p.append("y", "not")
+        self.assertEquals(6, len(p.results))
+        self.assertGet((19, "ex"), p.results[0])
+        self.assertEquals(memcacheConstants.ERR_EXISTS, p.results[1].status)
+        self.assertEquals(7, p.results[3][0])
+        self.assertEquals(memcacheConstants.ERR_NOT_FOUND,
+                          p.results[4].status)
+        self.assertValidCas("y", p.results[5][1])
+        self.assertGet((17, "whynot"), self.mc.get("y"))
+
+    def testPipelineWindow(self):
+        """Test a pipeline with more commands than its window."""
+        p=self.mc.pipeline(window=8)
+        for i in range(100):
+            p.set("k" + str(i), 5, i, "v" + str(i))
+        for i in range(100):
+            p.get("k" + str(i))
+        results=p.execute()
+        self.assertEquals(200, len(results))
+        for i in range(100):
+            self.assertGet((i, "v" + str(i)), results[100 + i])
+        self.assertEquals([], p.execute())
+
+    def testPipelineHandlerError(self):
+        """Test the connection is usable after a pipelined handler raises."""
+        self.mc.set("x", 5, 19, "ex")
+        def handler(opaque, cas, body):
+            raise ValueError(body.tobytes())
+        requests=[(memcacheConstants.CMD_GET, "x", '', '', 0, handler)] * 20
+        self.assertRaises(ValueError, self.mc._pipelined, requests, 4)
+        self.assertGet((19, "ex"), self.mc.get("x"))
+
+    def testSetMulti(self):
+        """Test quiet multi-set."""
+        failed=self.mc.setMulti(5, 19, {'x': 'ex', 'y': 'why'})
+        self.assertEquals({}, failed)
+        self.assertGet((19, 'ex'), self.mc.get('x'))
+        self.assertGet((19, 'why'), self.mc.get('y'))
+
+    def testSetMultiLarge(self):
+        """Test a batch mixing large and empty values."""
+        big="x" * (256 * 1024 + 3)
+        failed=self.mc.setMulti(0, 3, {'x': big, 'y': '', 'z': 'zed'})
+        self.assertEquals({}, failed)
+        self.assertEquals({'x': big, 'y': '', 'z': 'zed'},
+                          dict((k, v[2]) for k, v in
+                               self.mc.getMulti('xyz').items()))
+
+    def testQuietMultiWindow(self):
+        """Test quiet multi commands spanning many chunks."""
+        self.mc.quietWindow=8
+        items=dict(('k' + str(i), 'v' + str(i)) for i in range(100))
+        self.assertEquals({}, self.mc.setMulti(0, 3, items))
+        failed=self.mc.addMulti(0, 3, items)
+        self.assertEquals(sorted(items), sorted(failed))
+        self.assertEquals(memcacheConstants.ERR_EXISTS, failed['k7'].status)
+        self.assertEquals({}, self.mc.deleteMulti(items))
+        self.assertEquals(100, len(self.mc.deleteMulti(items)))
+
+    def testQuietMultiAbandoned(self):
+        """Test the connection is usable after a request fails to build."""
+        self.mc.quietWindow=8
+        def items():
+            for i in range(20):
+                yield 'k' + str(i), 'v'
+            raise ValueError("boom")
+        self.assertRaises(ValueError, self.mc.setMulti, 0, 3, items())
+        self.mc.set("x", 5, 19, "somevalue")
+        self.assertGet((19, "somevalue"), self.mc.get("x"))
+        self.assertGet((3, "v"), self.mc.get("k19"))
+
+    def testSendBufferReused(self):
+        """Test batches are encoded into the client's send buffer."""
+        wbuf=self.mc.wbuf
+        self.mc.setMulti(0, 3, {'x': 'ex', 'y': 'why'})
+        self.mc.getMulti('xyz')
+        self.assertTrue(self.mc.wbuf is wbuf)
+        self.mc.setMulti(0, 3, {'x': 'x' * len(wbuf)})
+        self.assertTrue(len(self.mc.wbuf) > len(wbuf))
+        self.assertGet((3, 'x' * len(wbuf)), self.mc.get('x'))
+
+    def testAddMulti(self):
+        """Test quiet multi-add only reports the failures."""
+        self.mc.set('x', 5, 19, 'ex')
+        failed=self.mc.addMulti(5, 17, [('x', 'ex2'), ('y', 'why')])
+        self.assertEquals(['x'], failed.keys())
+        self.assertEquals(memcacheConstants.ERR_EXISTS, failed['x'].status)
+        self.assertGet((19, 'ex'), self.mc.get('x'))
+        self.assertGet((17, 'why'), self.mc.get('y'))
+
+    def testDeleteMulti(self):
+        """Test quiet multi-delete only reports the failures."""
+        self.mc.set('x', 5, 19, 'ex')
+        self.mc.set('y', 5, 19, 'why')
+        failed=self.mc.deleteMulti('xyz')
+        self.assertEquals(['z'], failed.keys())
+        self.assertEquals(memcacheConstants.ERR_NOT_FOUND, failed['z'].status)
+        self.assertNotExists('x')
+        self.assertNotExists('y')
+
+    def testIncrMulti(self):
+        """Test quiet multi-incr."""
+        self.assertEquals({}, self.mc.incrMulti('xy', init=5))
+        self.assertEquals({}, self.mc.incrMulti('xy', 3))
+        self.assertEquals(8, self.mc.incr('x', 0)[0])
+        self.assertEquals(8, self.mc.incr('y', 0)[0])
+        failed=self.mc.decrMulti(['x', 'z'],
+                                 exp=memcacheConstants.INCRDECR_SPECIAL)
+        self.assertEquals(['z'], failed.keys())
+        self.assertEquals(7, self.mc.incr('x', 0)[0])
+
     def testIncrDoesntExistNoCreate(self):
         """Testing incr when a value doesn't exist (and not creating)."""
         try:
@@ -277,5 +438,865 @@ class ComplianceTest(unittest.TestCase):
         time.sleep(2.1)
         self.assertNotExists('x')
 
+class NearCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mc=MemcachedClient()
+        self.mc.flush()
+        self.mc.nearCache=NearCache(maxentries=3, ttl=60)
+        # A second connection changes items behind the near cache's back.
+        self.other=MemcachedClient()
+
+    def tearDown(self):
+        self.mc.flush()
+        self.mc.close()
+        self.other.close()
+
+    def testHitsAndInvalidation(self):
+        """Test cached gets and their invalidation by local mutations."""
+        self.mc.set('a', 0, 5, 'x')
+        self.assertEquals('x', self.mc.get('a')[2])
+        self.other.set('a', 0, 5, 'y')
+        self.assertEquals('x', self.mc.get('a')[2])
+        self.mc.append('a', 'z')
+        self.assertEquals('yz', self.mc.get('a')[2])
+        self.mc.delete('a')
+        try:
+            self.mc.get('a')
+            self.fail("Found a deleted key")
+        except MemcachedError, e:
+            self.assertEquals(memcacheConstants.ERR_NOT_FOUND, e.status)
+        with self.mc.pipeline() as p:
+            p.set('a', 0, 0, 'p')
+        self.assertEquals('p', self.mc.get('a')[2])
+        stats=self.mc.nearCache.stats()
+        self.assertEquals(1, stats['hits'])
+        self.assertEquals(4, stats['misses'])
+
+    def testEviction(self):
+        """Test the near cache is bounded by entries and bytes."""
+        for k in 'abcd':
+            self.mc.set(k, 0, 0, k * 10)
+            self.mc.get(k)
+        self.mc.get('b')
+        self.mc.set('e', 0, 0, 'e')
+        self.mc.get('e')
+        self.assertEquals(['d', 'b', 'e'], list(self.mc.nearCache.entries))
+        self.assertEquals(2, self.mc.nearCache.stats()['evictions'])
+        self.mc.nearCache.maxbytes=15
+        self.mc.get('c')
+        self.assertEquals(['e', 'c'], list(self.mc.nearCache.entries))
+        self.assertEquals(11, self.mc.nearCache.bytes)
+        # Expiries of uncached items don't take the entries' places.
+        for k in 'fghi':
+            self.mc.set(k, 100, 0, k)
+        self.assertEquals(['e', 'c'], list(self.mc.nearCache.entries))
+        self.assertEquals(['g', 'h', 'i'], list(self.mc.nearCache.expiries))
+
+    def testExpiryAndRefetch(self):
+        """Test stale entries are refetched and reused if unchanged."""
+        self.mc.nearCache.ttl=0.1
+        self.mc.set('a', 0, 0, 'x')
+        first=self.mc.get('a')
+        time.sleep(0.15)
+        self.assertTrue(first is self.mc.get('a'))
+        self.assertEquals(1, self.mc.nearCache.unchanged)
+        time.sleep(0.15)
+        self.other.set('a', 0, 0, 'y')
+        self.assertEquals('y', self.mc.get('a')[2])
+        self.assertEquals(1, self.mc.nearCache.unchanged)
+        # An item's own expiry caps how long it's cached.
+        self.mc.nearCache.ttl=60
+        self.mc.set('b', 1, 0, 'x')
+        self.mc.get('b')
+        time.sleep(1.1)
+        self.assertEquals(None, self.mc.nearCache.get('b'))
+
+    def testGetMulti(self):
+        """Test getMulti goes to the server only for uncached keys."""
+        self.mc.setMulti(0, 0, {'a': '1', 'b': '2'})
+        self.mc.get('a')
+        self.other.set('a', 0, 0, 'changed')
+        rv=self.mc.getMulti(['a', 'b', 'c'])
+        self.assertEquals(['a', 'b'], sorted(rv))
+        self.assertEquals('1', rv['a'][2])
+        self.assertEquals('2', self.mc.get('b')[2])
+        self.mc.setMulti(0, 0, {'a': '3'})
+        self.assertEquals('3', self.mc.getMulti(['a'])['a'][2])
+
+    def testSerialized(self):
+        """Test entries are sized by their stored bytes, not their values."""
+        self.mc.serializer=Serializer()
+        self.mc.set('i', 0, 0, 12345)
+        self.mc.setMulti(0, 0, {'l': range(10)})
+        self.assertEquals(12345, self.mc.get('i')[2])
+        self.assertEquals(range(10), self.mc.getMulti(['l'])['l'][2])
+        self.assertEquals(5 + len(self.other.get('l')[2]),
+                          self.mc.nearCache.bytes)
+
+class AttributeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mc=MemcachedClient()
+        self.mc.flush()
+
+    def tearDown(self):
+        self.mc.flush()
+        self.mc.close()
+
+    def testGetAttrs(self):
+        """Test all attributes come back from one lookup."""
+        self.mc.sop_create('s', 7, 0, 100)
+        self.mc.sop_insert('s', 'a')
+        attrs=self.mc.getattrs('s')
+        self.assertEquals((7, 0, 1, 100), attrs[:4])
+        self.assertEquals(memcacheConstants.ITEM_TYPE_SET, attrs.type)
+        self.assertEquals(1, self.mc.getattr('s', memcacheConstants.ATTR_COUNT))
+        self.assertEquals(-1, self.mc.getattr('s', 99))
+
+    def testCreateByInsert(self):
+        """Test a set created by its first insert keeps the given flags."""
+        self.mc.sop_insert('s', 'a', 1, 9, 0, 50)
+        self.assertEquals((9, 1, set(['a'])), self.mc.sop_get('s', 0))
+        attrs=self.mc.getattrs('s')
+        self.assertEquals((9, 1, 50), (attrs.flags, attrs.count, attrs.maxcount))
+
+    def testGetAttrsMulti(self):
+        """Test pipelined attribute lookups of many keys."""
+        self.mc.sop_create('s', 0, 0, 100)
+        self.mc.set('k', 0, 3, 'x')
+        rv=self.mc.getattrs_multi(['s', 'k', 'missing'])
+        self.assertEquals(100, rv['s'].maxcount)
+        self.assertEquals((3, memcacheConstants.ITEM_TYPE_KV),
+                          (rv['k'].flags, rv['k'].type))
+        self.assertEquals(memcacheConstants.ERR_NOT_FOUND, rv['missing'].status)
+
+    def testAttributeCache(self):
+        """Test cached attributes and their invalidation."""
+        self.mc.attrCache=AttributeCache(ttl=60)
+        other=MemcachedClient()
+        try:
+            self.mc.sop_create('s', 0, 0, 100)
+            self.assertEquals(0, self.mc.getattrs('s').count)
+            other.sop_insert('s', 'a')
+            self.assertEquals(0, self.mc.getattr('s',
+                                                 memcacheConstants.ATTR_COUNT))
+            self.mc.sop_insert('s', 'b')
+            self.assertEquals(2, self.mc.getattrs_multi(['s'])['s'].count)
+            self.mc.setattr('s', 0, 0, 1, 200, 0, 0, 0)
+            self.assertEquals(200, self.mc.getattrs('s').maxcount)
+            self.assertEquals({'entries': 1, 'hits': 1, 'misses': 3},
+                              self.mc.attrCache.stats())
+        finally:
+            other.close()
+
+class FailoverTest(unittest.TestCase):
+
+    def setUp(self):
+        # A server that accepts connections but never answers.
+        self.stalled=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.stalled.bind(('127.0.0.1', 0))
+        self.stalled.listen(5)
+        self.stalledPort=self.stalled.getsockname()[1]
+
+    def tearDown(self):
+        self.stalled.close()
+
+    def testTimeout(self):
+        """Test the client timeout bounds waiting for a response."""
+        mc=MemcachedClient(port=self.stalledPort, timeout=0.1)
+        start=time.time()
+        self.assertRaises(TimeoutError, mc.get, 'x')
+        self.assertTrue(time.time() - start < 1)
+        self.assertEquals(None, mc.s)
+
+    def testDeadline(self):
+        """Test a deadline bounds a call on a client without a timeout."""
+        mc=MemcachedClient(port=self.stalledPort)
+        start=time.time()
+        try:
+            with mc.deadline(0.1):
+                mc.get('x')
+            self.fail("Expected a timeout")
+        except TimeoutError:
+            pass
+        self.assertTrue(time.time() - start < 1)
+        self.assertEquals(None, mc.deadlineAt)
+
+    def testReconnect(self):
+        """Test a broken connection is replaced by the next command."""
+        mc=MemcachedClient()
+        mc.set('x', 0, 0, 'ex')
+        mc.s.close()
+        self.assertRaises(socket.error, mc.get, 'x')
+        self.assertEquals('ex', mc.get('x')[2])
+        self.assertEquals(0, mc.failures)
+        mc.delete('x')
+        mc.close()
+
+    def testCircuitBreaker(self):
+        """Test consecutive failures mark a server down for a while."""
+        port=self.stalledPort
+        self.stalled.close()
+        mc=MemcachedClient(port=port)
+        mc.backoff=0.2
+        self.assertEquals(1, mc.failures)
+        for i in range(mc.failureThreshold - 1):
+            try:
+                mc.noop()
+                self.fail("Expected a connection failure")
+            except socket.error, e:
+                self.assertFalse(isinstance(e, ServerDownError))
+        self.assertRaises(ServerDownError, mc.noop)
+        time.sleep(0.25)
+        try:
+            mc.noop()
+            self.fail("Expected a connection failure")
+        except socket.error, e:
+            self.assertFalse(isinstance(e, ServerDownError))
+        self.assertEquals(mc.failureThreshold + 1, mc.failures)
+
+class InstrumentationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mc=MemcachedClient()
+        self.mc.flush()
+
+    def tearDown(self):
+        self.mc.flush()
+        self.mc.close()
+
+    def testHistogram(self):
+        """Test percentiles are within the histogram's precision."""
+        h=LatencyHistogram()
+        for ms in range(1, 1001):
+            h.record(ms / 1000.0)
+        for p in (50, 90, 99):
+            self.assertAlmostEquals(p / 100.0, h.percentile(p),
+                                    delta=p / 100.0 / 2 ** h.SUB_BITS)
+        self.assertEquals(1.0, h.percentile(100))
+        self.assertEquals(None, LatencyHistogram().percentile(50))
+
+    def testClientStats(self):
+        """Test latencies, traffic and errors are recorded once enabled."""
+        self.mc.set('x', 0, 0, 'ex')
+        stats=self.mc.enableStats()
+        self.mc.set('x', 0, 0, 'ex')
+        for i in range(10):
+            self.mc.get('x')
+        self.assertRaises(MemcachedError, self.mc.get, 'missing')
+        self.mc.setMulti(0, 0, {'a': '1', 'b': '2'})
+        snap=stats.snapshot()
+        self.assertEquals(11, snap['latency']['CMD_GET']['count'])
+        self.assertEquals(1, snap['latency']['CMD_SET']['count'])
+        self.assertTrue(snap['latency']['CMD_GET']['p99'] > 0)
+        self.assertEquals({memcacheConstants.ERR_NOT_FOUND: 1}, snap['errors'])
+        self.assertTrue(snap['bytes_sent'] > 12 * 24)
+        self.assertTrue(snap['bytes_received'] >= 14 * 24)
+        self.assertEquals(set([50, 90, 99, 99.9]),
+                          set(stats.percentiles()['CMD_SET']))
+
+        self.mc.disableStats()
+        self.assertTrue(type(self.mc) is MemcachedClient)
+        self.mc.get('x')
+        self.assertEquals(11, stats.snapshot()['latency']['CMD_GET']['count'])
+        stats.reset()
+        self.assertEquals({'latency': {}, 'bytes_sent': 0,
+                           'bytes_received': 0, 'errors': {}},
+                          stats.snapshot())
+
+class CompressionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mc=MemcachedClient()
+        self.mc.flush()
+        self.mc.compressor=Compressor(threshold=100)
+        self.plain=MemcachedClient()
+
+    def tearDown(self):
+        self.mc.flush()
+        self.mc.close()
+        self.plain.close()
+
+    def testKV(self):
+        """Test large values are stored compressed and read back as set."""
+        big='x' * 10000
+        self.mc.set('big', 0, 7, big)
+        self.mc.set('small', 0, 7, 'tiny')
+        self.mc.setMulti(0, 3, {'m1': big, 'm2': 'tiny'})
+        self.assertEquals((7, big), self.mc.get('big')[::2])
+        self.assertEquals((7, 'tiny'), self.mc.get('small')[::2])
+        self.assertEquals((3, big), self.mc.getMulti(['m1'])['m1'][::2])
+        # Clients without a compressor get the flag and the stored bytes.
+        flags, cas, data=self.plain.get('big')
+        self.assertEquals(7 | memcacheConstants.FLAG_COMPRESSED, flags)
+        self.assertEquals(big, zlib.decompress(data))
+        self.assertEquals(3, self.plain.getMulti(['m2'])['m2'][0])
+        stats=self.mc.compressor.stats()
+        self.assertEquals(2, stats['compressed'])
+        self.assertEquals(20000, stats['bytes_in'])
+        self.assertTrue(stats['bytes_saved'] > 19000)
+
+    def testIncompressible(self):
+        """Test values that don't shrink are stored as they are."""
+        noise=''.join(chr(random.randint(0, 255)) for i in range(1000))
+        self.mc.set('noise', 0, 0, noise)
+        self.assertEquals((0, noise), self.plain.get('noise')[::2])
+        self.assertEquals(1, self.mc.compressor.stats()['skipped'])
+
+    def testAppend(self):
+        """Test append and prepend refuse to corrupt compressed values."""
+        self.mc.set('big', 0, 0, 'x' * 1000)
+        self.assertRaises(exceptions.NotImplementedError,
+                          self.mc.append, 'big', 'y')
+        self.assertRaises(exceptions.NotImplementedError,
+                          self.mc.prepend, 'big', 'y')
+        self.assertEquals('x' * 1000, self.mc.get('big')[2])
+
+    def testCompressedFlag(self):
+        """Test FLAG_COMPRESSED is a user flag without a compressor."""
+        flags=memcacheConstants.FLAG_COMPRESSED | 1
+        self.plain.set('x', 0, flags, 'not zlib')
+        self.assertEquals((flags, 'not zlib'), self.plain.get('x')[::2])
+        self.assertRaises(exceptions.ValueError,
+                          self.mc.set, 'y', 0, flags, 'x' * 1000)
+        self.assertRaises(exceptions.ValueError,
+                          self.mc.setMulti, 0, flags, {'y': 'x'})
+
+class SerializerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mc=MemcachedClient()
+        self.mc.flush()
+        self.mc.serializer=Serializer()
+        self.plain=MemcachedClient()
+
+    def tearDown(self):
+        self.mc.flush()
+        self.mc.close()
+        self.plain.close()
+
+    def testTypes(self):
+        """Test values come back with the type they were stored with."""
+        values={'s': 'bytes', 'i': 42, 'l': 2 ** 70, 'u': u'\uc548\ub155',
+                'd': {'a': [1, 2.5, None]}, 't': (1, 'x')}
+        for k, v in values.items():
+            self.mc.set(k, 0, 9, v)
+        for k, v in values.items():
+            flags, cas, val=self.mc.get(k)
+            self.assertEquals((9, v, type(v)), (flags, val, type(val)))
+        self.assertEquals(values, dict((k, v[2]) for k, v in
+                                       self.mc.getMulti(values).items()))
+        self.mc.setMulti(0, 0, {'m': 7})
+        self.assertEquals(7, self.mc.get('m')[2])
+        # Strs and ints are stored as they are, the tag only in the flags.
+        self.assertEquals((9, 'bytes'), self.plain.get('s')[::2])
+        self.assertEquals((9 | memcacheConstants.TYPE_INT
+                           << memcacheConstants.FLAG_TYPE_SHIFT, '42'),
+                          self.plain.get('i')[::2])
+        self.mc.incr('i', 8)
+        self.assertEquals(50, self.mc.get('i')[2])
+
+    def testCodecs(self):
+        """Test per call serializers, registered types and compression."""
+        with self.mc.serializing(Serializer(memcacheConstants.TYPE_MARSHAL)):
+            self.mc.set('m', 0, 0, [1, 2])
+        self.assertEquals(memcacheConstants.TYPE_MARSHAL,
+                          self.plain.get('m')[0]
+                          >> memcacheConstants.FLAG_TYPE_SHIFT)
+        self.assertEquals([1, 2], self.mc.get('m')[2])
+        self.mc.serializer.register(float, 5, repr, float)
+        self.mc.set('f', 0, 0, 0.5)
+        self.assertEquals(0.5, self.mc.get('f')[2])
+        self.mc.compressor=Compressor(threshold=100)
+        self.mc.set('big', 0, 0, range(1000))
+        self.assertEquals(range(1000), self.mc.get('big')[2])
+        self.assertEquals(1, self.mc.compressor.stats()['compressed'])
+
+    def testReservedFlags(self):
+        """Test flags using the type tag bits are refused."""
+        for flags in (memcacheConstants.TYPE_INT
+                      << memcacheConstants.FLAG_TYPE_SHIFT,
+                      memcacheConstants.TYPE_UNICODE
+                      << memcacheConstants.FLAG_TYPE_SHIFT,
+                      memcacheConstants.FLAG_COMPRESSED):
+            self.assertRaises(exceptions.ValueError,
+                              self.mc.set, 'x', 0, flags, 'str')
+            self.assertRaises(exceptions.ValueError,
+                              self.mc.set, 'x', 0, flags | 1, 42)
+            self.assertRaises(exceptions.ValueError,
+                              self.mc.setMulti, 0, flags, {'x': 'str'})
+        self.assertRaises(MemcachedError, self.mc.get, 'x')
+        self.mc.set('x', 0, 0xffffff, 'str')
+        self.assertEquals((0xffffff, 'str'), self.mc.get('x')[::2])
+
+class StatsSamplerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mc=MemcachedClient()
+        self.mc.flush()
+        self.dir=tempfile.mkdtemp()
+        self.sampler=StatsSampler(['127.0.0.1:11211', ('127.0.0.1', 1)],
+                                  history=3,
+                                  textfile=os.path.join(self.dir, 'mc.prom'),
+                                  jsonfile=os.path.join(self.dir, 'mc.json'))
+
+    def tearDown(self):
+        self.sampler.stop()
+        self.mc.flush()
+        self.mc.close()
+        shutil.rmtree(self.dir)
+
+    def testRates(self):
+        """Test counters get deltas and rates between samples."""
+        first=self.sampler.sample()['127.0.0.1:11211']
+        self.assertEquals({}, first['rates'])
+        self.assertEquals(int, type(first['stats']['pid']))
+        self.mc.set('a', 0, 0, 'x')
+        for i in range(10):
+            self.mc.get('a')
+        self.assertRaises(MemcachedError, self.mc.get, 'missing')
+        rv=self.sampler.sample()
+        sample=rv['127.0.0.1:11211']
+        self.assertEquals({'cmd_get': 11, 'get_hits': 10, 'get_misses': 1,
+                           'cmd_set': 1, 'cmd_flush': 0, 'evictions': 0},
+                          sample['deltas'])
+        self.assertTrue(sample['rates']['cmd_get'] > 0)
+        self.assertEquals(1, sample['stats']['curr_items'])
+        self.assertTrue('error' in rv['127.0.0.1:1'])
+        self.assertEquals(sample, self.sampler.latest()['127.0.0.1:11211'])
+
+        self.sampler.sample()
+        self.sampler.sample()
+        self.assertEquals(3, len(self.sampler.history('127.0.0.1:11211')))
+        prom=open(self.sampler.textfile).read()
+        self.assertTrue('# TYPE memcached_cmd_get_total counter\n' in prom)
+        self.assertTrue('memcached_up{server="127.0.0.1:1"} 0\n' in prom)
+        self.assertTrue('memcached_curr_items{server="127.0.0.1:11211"} 1\n'
+                        in prom)
+        lines=[json.loads(l) for l in open(self.sampler.jsonfile)]
+        self.assertEquals(8, len(lines))
+        self.assertEquals(11, lines[2]['deltas']['cmd_get'])
+
+    def testThread(self):
+        """Test the sampler polls on its own until stopped."""
+        self.sampler.interval=0.05
+        self.sampler.start()
+        time.sleep(0.3)
+        self.sampler.stop()
+        n=len(self.sampler.history('127.0.0.1:1'))
+        self.assertEquals(3, n)
+        self.assertTrue(self.sampler.errors >= 4)
+        self.assertEquals(0, self.sampler.failedRounds)
+
+    def testThreadSurvivesErrors(self):
+        """Test the sampler keeps polling after a round fails."""
+        self.sampler.textfile=os.path.join(self.dir, 'missing', 'mc.prom')
+        self.sampler.interval=0.05
+        self.sampler.start()
+        time.sleep(0.3)
+        self.assertTrue(self.sampler.thread.is_alive())
+        self.sampler.stop()
+        self.assertTrue(self.sampler.failedRounds >= 4)
+        self.assertTrue(isinstance(self.sampler.lastError, exceptions.IOError))
+        self.assertEquals(3, len(self.sampler.history('127.0.0.1:11211')))
+
+class PoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool=MemcachedClientPool(minsize=1, maxsize=2)
+
+    def tearDown(self):
+        with self.pool.connection() as mc:
+            mc.flush()
+        self.pool.close()
+
+    def testThreadedUse(self):
+        """Test many threads sharing a small pool."""
+        def worker(n):
+            for i in range(20):
+                with self.pool.connection() as mc:
+                    key="k%d_%d" % (n, i)
+                    mc.set(key, 5, n, str(i))
+                    self.assertEquals((n, str(i)), mc.get(key)[::2])
+        threads=[threading.Thread(target=worker, args=(n,)) for n in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        stats=self.pool.stats()
+        self.assertEquals(120, stats['checkouts'])
+        self.assertEquals(0, stats['in_use'])
+        self.assertTrue(stats['peak_in_use'] <= 2)
+        self.assertTrue(stats['size'] <= 2)
+        self.assertEquals(stats['size'], stats['created'])
+
+    def testCheckoutTimeout(self):
+        """Test checkout gives up when the pool is exhausted."""
+        a=self.pool.checkout()
+        b=self.pool.checkout()
+        self.assertRaises(PoolTimeoutError, self.pool.checkout, 0.1)
+        self.pool.checkin(a)
+        self.pool.checkin(b)
+        self.assertEquals(1, self.pool.stats()['waits'])
+        self.assertEquals(1, self.pool.stats()['timeouts'])
+
+    def testBrokenConnectionIsDropped(self):
+        """Test a connection that raised something odd isn't reused."""
+        try:
+            with self.pool.connection() as mc:
+                broken=mc
+                raise ValueError("boom")
+        except ValueError:
+            pass
+        with self.pool.connection() as mc:
+            self.assertTrue(mc is not broken)
+            mc.noop()
+
+    def testFailedCheck(self):
+        """Test a dead idle connection is replaced on checkout."""
+        pool=MemcachedClientPool(maxsize=1, check_interval=0)
+        with pool.connection() as mc:
+            dead=mc
+            mc.s.shutdown(socket.SHUT_RDWR)
+        time.sleep(0.01)
+        with pool.connection() as mc:
+            self.assertTrue(mc is not dead)
+            mc.noop()
+        stats=pool.stats()
+        self.assertEquals(1, stats['failed_checks'])
+        self.assertEquals(2, stats['created'])
+        self.assertEquals(1, stats['size'])
+        pool.close()
+
+    def testSaslPool(self):
+        """Test pooled connections authenticate once."""
+        pool=MemcachedClientPool(maxsize=1, user='testuser',
+                                 password='testpass')
+        for i in range(3):
+            with pool.connection() as mc:
+                mc.noop()
+        self.assertEquals(1, pool.stats()['created'])
+        pool.close()
+
+class ClusterTest(unittest.TestCase):
+
+    def setUp(self):
+        # Two names for the same server make two nodes on the ring.
+        self.mcc=MemcachedCluster(['127.0.0.1:11211', ('localhost', 11211)])
+        self.mcc.flush()
+
+    def tearDown(self):
+        self.mcc.flush()
+        self.mcc.close()
+
+    def testRingRemapsFewKeys(self):
+        """Test adding a node only moves keys to that node."""
+        ring=HashRing(['node%d' % i for i in range(10)])
+        keys=['key%d' % i for i in range(10000)]
+        before=dict((k, ring.get(k)) for k in keys)
+        ring.add('node10')
+        moved=[k for k in keys if ring.get(k) != before[k]]
+        self.assertTrue(0 < len(moved) < 2000, len(moved))
+        for k in moved:
+            self.assertEquals('node10', ring.get(k))
+        ring.remove('node10')
+        self.assertEquals(before, dict((k, ring.get(k)) for k in keys))
+
+    def testKeysAreSpread(self):
+        """Test keys are routed to both nodes."""
+        owners=set(self.mcc.ring.get('k%d' % i) for i in range(100))
+        self.assertEquals(set(['127.0.0.1:11211', 'localhost:11211']), owners)
+
+    def testSetGet(self):
+        """Test single key commands through the cluster."""
+        self.mcc.set("x", 5, 19, "somevalue")
+        self.assertEquals((19, "somevalue"), self.mcc.get("x")[::2])
+        self.assertEquals(3, self.mcc.incr("y", init=3)[0])
+
+    def testMultiCalls(self):
+        """Test multi-key calls scatter over the nodes."""
+        items=dict(('k%d' % i, 'v%d' % i) for i in range(50))
+        self.assertEquals({}, self.mcc.setMulti(5, 7, items))
+        vals=self.mcc.getMulti(['k%d' % i for i in range(60)])
+        self.assertEquals(50, len(vals))
+        self.assertEquals((7, 'v3'), vals['k3'][::2])
+        results=self.mcc.callMulti('get', ['k1', 'k2', 'nothere'])
+        self.assertEquals((7, 'v2'), results['k2'][::2])
+        self.assertEquals(memcacheConstants.ERR_NOT_FOUND,
+                          results['nothere'].status)
+        failed=self.mcc.deleteMulti(['k1', 'nothere'])
+        self.assertEquals(['nothere'], failed.keys())
+
+class VBucketTest(unittest.TestCase):
+
+    def setUp(self):
+        self.servers=['127.0.0.1:11211', 'localhost:11211']
+        self.mcc=VBucketCluster(self.servers, [i % 2 for i in range(64)])
+        self.mcc.flush()
+
+    def tearDown(self):
+        self.mcc.flush()
+        self.mcc.close()
+
+    def testMapping(self):
+        """Test keys hash to vbuckets and vbuckets to servers."""
+        m=VBucketMap(['a', 'b'], [0, 1, 1, 0])
+        for i in range(100):
+            vb=m.vbucketOf('k%d' % i)
+            self.assertTrue(0 <= vb < 4)
+            self.assertEquals(['a', 'b', 'b', 'a'][vb], m.serverOf('k%d' % i))
+        self.assertRaises(AssertionError, VBucketMap, ['a'], [0, 0, 0])
+
+    def testRequestsAreStamped(self):
+        """Test requests carry the vbucket of their key."""
+        mc=self.mcc.clientFor('x')
+        msg=mc._encodeCmd(memcacheConstants.CMD_GET, 'x', '', 0)
+        vb=struct.unpack(memcacheConstants.REQ_PKT_FMT,
+                         msg[:memcacheConstants.MIN_RECV_PACKET])[5]
+        self.assertEquals(self.mcc.vbmap.vbucketOf('x'), vb)
+
+    def testSetMap(self):
+        """Test moving every vbucket to one server."""
+        self.mcc.set("x", 5, 19, "somevalue")
+        self.mcc.setMap(self.servers[:1], [0] * 64)
+        self.assertEquals(1, len(self.mcc.clients))
+        self.assertEquals((19, "somevalue"), self.mcc.get("x")[::2])
+        self.assertEquals(1, len(self.mcc.getMulti(['x', 'y'])))
+
+    def testNotMyVBucket(self):
+        """Test ERR_NOT_MY_VBUCKET reloads the map and retries."""
+        admin=MemcachedClient()
+        vb=self.mcc.vbmap.vbucketOf('x')
+        refreshes=[]
+        def provider():
+            # The vbucket moved; the new map points at where it's active.
+            refreshes.append(vb)
+            admin.set_vbucket_state(vb, 'active')
+            return self.servers[:1], [0] * 64
+        try:
+            admin.set_vbucket_state(vb, 'dead')
+            try:
+                self.mcc.set('x', 0, 3, 'v')
+                self.fail("Expected ERR_NOT_MY_VBUCKET without a provider")
+            except MemcachedError, e:
+                self.assertEquals(memcacheConstants.ERR_NOT_MY_VBUCKET,
+                                  e.status)
+            self.mcc.configProvider=provider
+            self.mcc.set('x', 0, 3, 'v')
+            self.assertEquals([vb], refreshes)
+            self.assertEquals(1, len(self.mcc.clients))
+            self.assertEquals((3, 'v'), self.mcc.get('x')[::2])
+        finally:
+            admin.set_vbucket_state(vb, 'active')
+            admin.close()
+
+class AsyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mc=AsyncMemcachedClient()
+        self.mc.flush().result()
+
+    def tearDown(self):
+        self.mc.flush().result()
+        self.mc.close()
+
+    def testConcurrentCommands(self):
+        """Test many outstanding commands resolve to the right results."""
+        sets=[self.mc.set('k%d' % i, 5, i, 'v%d' % i) for i in range(50)]
+        gets=[self.mc.get('k%d' % i) for i in range(50)]
+        missing=self.mc.get('nothere')
+        for i, f in enumerate(gets):
+            self.assertEquals((i, 'v%d' % i), f.result()[::2])
+        for f in sets:
+            self.assertTrue(f.done)
+        try:
+            missing.result()
+            self.fail("Expected an exception")
+        except MemcachedError, e:
+            self.assertEquals(memcacheConstants.ERR_NOT_FOUND, e.status)
+
+    def testCallbacks(self):
+        """Test callbacks run when the response arrives."""
+        seen=[]
+        self.mc.incr('x', init=4).addCallback(lambda f: seen.append(f.value[0]))
+        self.mc.noop().result()
+        self.assertEquals([4], seen)
+
+    def testGetMulti(self):
+        """Test async multiget."""
+        self.mc.set('x', 5, 1, 'ex')
+        self.mc.set('y', 5, 2, 'why')
+        vals=self.mc.getMulti('xyz').result()
+        self.assertEquals(2, len(vals))
+        self.assertEquals((2, 'why'), vals['y'][::2])
+
+    def testCas(self):
+        """Test async cas resolves to the new cas or a mismatch."""
+        cas=self.mc.set('x', 5, 1, 'ex').result()[1]
+        newcas=self.mc.cas('x', 5, 1, cas, 'ex2').result()[1]
+        self.assertNotEquals(cas, newcas)
+        try:
+            self.mc.cas('x', 5, 1, cas, 'ex3').result()
+            self.fail("Expected a CAS mismatch")
+        except MemcachedError, e:
+            self.assertEquals(memcacheConstants.ERR_EXISTS, e.status)
+        self.assertEquals('ex2', self.mc.get('x').result()[2])
+
+    def testClientStats(self):
+        """Test async commands are timed from request to response."""
+        stats=self.mc.enableStats()
+        self.mc.set('x', 5, 1, 'ex')
+        self.assertEquals('ex', self.mc.get('x').result()[2])
+        self.assertRaises(MemcachedError, self.mc.get('nothere').result)
+        snap=stats.snapshot()
+        self.assertEquals(1, snap['latency']['CMD_SET']['count'])
+        self.assertEquals(2, snap['latency']['CMD_GET']['count'])
+        self.assertEquals({memcacheConstants.ERR_NOT_FOUND: 1}, snap['errors'])
+        self.assertEquals(3 * 24 + 8 + len('xex' 'x' 'nothere'), snap['bytes_sent'])
+        self.mc.disableStats()
+        self.assertTrue(type(self.mc) is AsyncMemcachedClient)
+
+class TapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mc=MemcachedClient()
+        self.mc.flush()
+
+    def tearDown(self):
+        self.mc.flush()
+        self.mc.close()
+
+    def testDump(self):
+        """Test a dump streams every item and ends."""
+        big='v' * 1024
+        self.mc.setMulti(0, 7, (('k%d' % i, big) for i in range(1000)))
+        self.mc.sop_create('s')
+        tap=TapClient(name='dump', dump=True)
+        events=list(tap)
+        tap.close()
+        self.assertEquals(1000, len(events))
+        self.assertEquals(['k%d' % i for i in range(1000)],
+                          sorted([e.key for e in events],
+                                 key=lambda k: int(k[1:])))
+        for e in events:
+            self.assertEquals((memcacheConstants.CMD_TAP_MUTATION, 7, big),
+                              (e.cmd, e.flags, e.value))
+
+    def testBackfillAndLive(self):
+        """Test a backfill followed by live mutations, deletes and flushes."""
+        self.mc.set('old', 0, 0, 'o')
+        tap=TapClient(name='live', backfill=0)
+        try:
+            self.mc.vbucketId=3
+            self.mc.set('a', 0, 1, 'x')
+            self.mc.set('a', 0, 2, 'y')
+            self.mc.vbucketId=0
+            self.mc.delete('old')
+            self.mc.flush()
+            self.mc.set('b', 0, 0, 'z')
+            events=tap.__iter__()
+            seen=[]
+            while not seen or seen[-1][1] != 'b':
+                e=events.next()
+                seen.append((e.cmd, e.key, e.value, e.vbucket))
+        finally:
+            tap.close()
+        # Pending changes are coalesced and discarded by the flush, so all
+        # that's certain is how the stream ends.
+        self.assertEquals([(memcacheConstants.CMD_TAP_FLUSH, '', '', 0),
+                           (memcacheConstants.CMD_TAP_MUTATION, 'b', 'z', 0)],
+                          seen[-2:])
+
+    def testVBucketFilter(self):
+        """Test a dump limited to some vbuckets."""
+        for vb in range(4):
+            self.mc.vbucketId=vb
+            self.mc.set('k%d' % vb, 0, 0, 'v')
+        self.mc.vbucketId=0
+        tap=TapClient(name='vbs', dump=True, vbuckets=[1, 3])
+        events=list(tap)
+        tap.close()
+        self.assertEquals([('k1', 1), ('k3', 3)],
+                          sorted([(e.key, e.vbucket) for e in events]))
+
+class TapClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.listener=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+        self.port=self.listener.getsockname()[1]
+        self.received=[]
+
+    def tearDown(self):
+        self.listener.close()
+
+    def _recvall(self, s, n):
+        data=''
+        while len(data) < n:
+            data += s.recv(n - len(data))
+        return data
+
+    def _produce(self, messages, nacks):
+        """Accept a TAP connection, stream messages and collect the acks."""
+        s=self.listener.accept()[0]
+        hdr=self._recvall(s, memcacheConstants.MIN_RECV_PACKET)
+        self.received.append(struct.unpack(memcacheConstants.REQ_PKT_FMT, hdr))
+        self.received.append(self._recvall(s, self.received[0][6]))
+        s.sendall(''.join(messages))
+        for i in range(nacks):
+            self.received.append(struct.unpack(memcacheConstants.RES_PKT_FMT,
+                self._recvall(s, memcacheConstants.MIN_RECV_PACKET)))
+        s.close()
+
+    def _message(self, cmd, opaque, extras, key, value, vbucket=0,
+                 engine=''):
+        body=extras + engine + key + value
+        return struct.pack(memcacheConstants.REQ_PKT_FMT,
+                           memcacheConstants.REQ_MAGIC_BYTE, cmd, len(key),
+                           len(extras), 0, vbucket, len(body), opaque, 0) \
+            + body
+
+    def testStream(self):
+        """Test connect flags, event decoding and acks."""
+        messages=[
+            self._message(memcacheConstants.CMD_TAP_MUTATION, 1,
+                          struct.pack(memcacheConstants.TAP_MUTATION_PKT_FMT,
+                                      2, 0, 0, 19, 300),
+                          'a', 'value', vbucket=3, engine='es'),
+            self._message(memcacheConstants.CMD_TAP_DELETE, 2,
+                          struct.pack(memcacheConstants.TAP_GENERAL_PKT_FMT,
+                                      0, memcacheConstants.TAP_MSG_FLAG_ACK, 0),
+                          'b', ''),
+            self._message(memcacheConstants.CMD_TAP_FLUSH, 3,
+                          struct.pack(memcacheConstants.TAP_GENERAL_PKT_FMT,
+                                      0, memcacheConstants.TAP_MSG_FLAG_ACK, 0),
+                          '', '')]
+        t=threading.Thread(target=self._produce, args=(messages, 2))
+        t.start()
+        tap=TapClient(port=self.port, name='feed', backfill=5, vbuckets=[3, 4])
+        events=list(tap)
+        t.join()
+        tap.close()
+
+        connect, body=self.received[:2]
+        self.assertEquals(memcacheConstants.CMD_TAP_CONNECT, connect[1])
+        flags=struct.unpack('>I', body[:4])[0]
+        self.assertEquals(memcacheConstants.TAP_FLAG_BACKFILL
+                          | memcacheConstants.TAP_FLAG_LIST_VBUCKETS
+                          | memcacheConstants.TAP_FLAG_SUPPORT_ACK, flags)
+        self.assertEquals('feed' + struct.pack('>QHHH', 5, 2, 3, 4), body[4:])
+
+        self.assertEquals([(memcacheConstants.CMD_TAP_MUTATION, 3, 'a',
+                            'value', 19, 300, 0),
+                           (memcacheConstants.CMD_TAP_DELETE, 0, 'b', '',
+                            0, 0, 0),
+                           (memcacheConstants.CMD_TAP_FLUSH, 0, '', '',
+                            0, 0, 0)], events)
+        self.assertEquals([(memcacheConstants.CMD_TAP_DELETE, 2),
+                           (memcacheConstants.CMD_TAP_FLUSH, 3)],
+                          [(r[1], r[7]) for r in self.received[2:]])
+
 if __name__ == '__main__':
     unittest.main()
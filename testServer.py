@@ -10,18 +10,22 @@ import random
 import string
 import socket
 import struct
+import os
 import time
 import hmac
 import heapq
+import collections
 
 import memcacheConstants
 
-from memcacheConstants import MIN_RECV_PACKET, REQ_PKT_FMT, RES_PKT_FMT
-from memcacheConstants import INCRDECR_RES_FMT
-from memcacheConstants import REQ_MAGIC_BYTE, RES_MAGIC_BYTE, EXTRA_HDR_FMTS
+from memcacheConstants import MIN_RECV_PACKET, REQ_PKT, RES_PKT
+from memcacheConstants import REQ_MAGIC_BYTE, RES_MAGIC_BYTE, EXTRA_HDR_STRUCTS
 
 VERSION="1.0"
 
+# The extras of commands that don't have any.
+NO_EXTRAS=struct.Struct('')
+
 class BaseBackend(object):
     """Higher-level backend (processes commands and stuff)."""
 
@@ -45,23 +49,71 @@ class BaseBackend(object):
         memcacheConstants.CMD_SASL_LIST_MECHS: 'handle_sasl_mechs',
         memcacheConstants.CMD_SASL_AUTH: 'handle_sasl_auth',
         memcacheConstants.CMD_SASL_STEP: 'handle_sasl_step',
+        memcacheConstants.CMD_SOP_CREATE: 'handle_sop_create',
+        memcacheConstants.CMD_SOP_INSERT: 'handle_sop_insert',
+        memcacheConstants.CMD_SOP_DELETE: 'handle_sop_delete',
+        memcacheConstants.CMD_SOP_EXIST: 'handle_sop_exist',
+        memcacheConstants.CMD_SOP_EXIST_MULTI: 'handle_sop_exist_multi',
+        memcacheConstants.CMD_SOP_GET: 'handle_sop_get',
+        memcacheConstants.CMD_GETATTR: 'handle_getattr',
+        memcacheConstants.CMD_SETATTR: 'handle_setattr',
+        memcacheConstants.CMD_SET_VBUCKET_STATE: 'handle_set_vbucket_state',
+        }
+
+    # Quiet command IDs to the command they're a quiet version of.  Quiet
+    # commands only produce a response when they fail.
+    QUIET_CMDS={
+        memcacheConstants.CMD_SETQ: memcacheConstants.CMD_SET,
+        memcacheConstants.CMD_ADDQ: memcacheConstants.CMD_ADD,
+        memcacheConstants.CMD_REPLACEQ: memcacheConstants.CMD_REPLACE,
+        memcacheConstants.CMD_DELETEQ: memcacheConstants.CMD_DELETE,
+        memcacheConstants.CMD_INCRQ: memcacheConstants.CMD_INCR,
+        memcacheConstants.CMD_DECRQ: memcacheConstants.CMD_DECR,
+        memcacheConstants.CMD_FLUSHQ: memcacheConstants.CMD_FLUSH,
+        memcacheConstants.CMD_APPENDQ: memcacheConstants.CMD_APPEND,
+        memcacheConstants.CMD_PREPENDQ: memcacheConstants.CMD_PREPEND,
         }
 
+    # Commands whose success changes the item of their key.
+    MUTATIONS=frozenset([
+        memcacheConstants.CMD_SET,
+        memcacheConstants.CMD_ADD,
+        memcacheConstants.CMD_REPLACE,
+        memcacheConstants.CMD_DELETE,
+        memcacheConstants.CMD_INCR,
+        memcacheConstants.CMD_DECR,
+        memcacheConstants.CMD_APPEND,
+        memcacheConstants.CMD_PREPEND,
+        ])
+
     def __init__(self):
         self.handlers={}
         self.sched=[]
+        # Functions called with every changed key, or None after a flush.
+        self.listeners=[]
+        # key -> (time of its last change, vbucket), for TAP backfills
+        self.changes={}
+        self.vbucket=0
+        # vbuckets whose requests are answered with ERR_NOT_MY_VBUCKET
+        self.deadVBuckets=set()
+        self.started=time.time()
+        # command -> times processed, plus get_hits and get_misses
+        self.counts=collections.Counter()
 
         for id, method in self.CMDS.iteritems():
             self.handlers[id]=getattr(self, method, self.handle_unknown)
+        for id, loud in self.QUIET_CMDS.iteritems():
+            self.handlers[id]=self._quiet(self.handlers[loud])
 
-    def _splitKeys(self, fmt, keylen, data):
-        """Split the given data into the headers as specified in the given
-        format, the key, and the data.
+    def _splitKeys(self, hdrStruct, keylen, data):
+        """Split the given data into the headers as specified by the given
+        struct, the key, and the data.
 
         Return (hdrTuple, key, data)"""
-        hdrSize=struct.calcsize(fmt)
-        assert hdrSize <= len(data), "Data too short for " + fmt + ': ' + `data`
-        hdr=struct.unpack(fmt, data[:hdrSize])
+        hdrSize=hdrStruct.size
+        assert hdrSize <= len(data), \
+            "Data too short for " + hdrStruct.format + ': ' + `data`
+        hdr=hdrStruct.unpack_from(data)
         assert len(data) >= hdrSize + keylen
         key=data[hdrSize:keylen+hdrSize]
         assert len(key) == keylen, "len(%s) == %d, expected %d" \
@@ -69,9 +121,27 @@ class BaseBackend(object):
         val=data[keylen+hdrSize:]
         return hdr, key, val
 
+    def _quiet(self, handler):
+        """Wrap a command handler so its successful responses are swallowed."""
+        def f(cmd, hdrs, key, cas, data):
+            rv=handler(cmd, hdrs, key, cas, data)
+            if rv and rv[0] == 0:
+                rv=None
+            return rv
+        return f
+
     def _error(self, which, msg):
         return which, 0, msg
 
+    def _changed(self, key):
+        """Record a change and tell the listeners; key is None for a flush."""
+        if key is None:
+            self.changes.clear()
+        else:
+            self.changes[key]=(time.time(), self.vbucket)
+        for f in list(self.listeners):
+            f(key)
+
     def processCommand(self, cmd, keylen, vb, cas, data):
         """Entry point for command processing.  Lower level protocol
         implementations deliver values here."""
@@ -81,22 +151,77 @@ class BaseBackend(object):
             print "Running delayed job."
             heapq.heappop(self.sched)[1]()
 
-        hdrs, key, val=self._splitKeys(EXTRA_HDR_FMTS.get(cmd, ''),
+        hdrs, key, val=self._splitKeys(EXTRA_HDR_STRUCTS.get(cmd, NO_EXTRAS),
             keylen, data)
 
-        return self.handlers.get(cmd, self.handle_unknown)(cmd, hdrs, key,
+        self.vbucket=vb
+        if vb in self.deadVBuckets \
+                and cmd != memcacheConstants.CMD_SET_VBUCKET_STATE:
+            return self._error(memcacheConstants.ERR_NOT_MY_VBUCKET,
+                'Not my vbucket')
+        rv=self.handlers.get(cmd, self.handle_unknown)(cmd, hdrs, key,
             cas, val)
+        # Quiet commands only respond when they fail.
+        if self.QUIET_CMDS.get(cmd, cmd) in self.MUTATIONS \
+                and (rv is None or rv[0] == 0):
+            self._changed(key)
+        self.counts[self.QUIET_CMDS.get(cmd, cmd)] += 1
+        if cmd in (memcacheConstants.CMD_GET, memcacheConstants.CMD_GETQ):
+            # A quiet get only answers hits.
+            self.counts[rv is not None and rv[0] == 0
+                        and 'get_hits' or 'get_misses'] += 1
+        return rv
+
+    def stats(self, group):
+        """Get the dict of stats of the given group, or None if there's
+        no such group."""
+        if group:
+            return None
+        now=time.time()
+        return {'pid': os.getpid(),
+                'uptime': int(now - self.started),
+                'time': int(now),
+                'version': VERSION,
+                'cmd_get': self.counts[memcacheConstants.CMD_GET]
+                    + self.counts[memcacheConstants.CMD_GETQ],
+                'cmd_set': self.counts[memcacheConstants.CMD_SET]
+                    + self.counts[memcacheConstants.CMD_ADD]
+                    + self.counts[memcacheConstants.CMD_REPLACE],
+                'cmd_flush': self.counts[memcacheConstants.CMD_FLUSH],
+                'get_hits': self.counts['get_hits'],
+                'get_misses': self.counts['get_misses'],
+                'evictions': 0}
 
     def handle_noop(self, cmd, hdrs, key, cas, data):
         """Handle a noop"""
         print "Noop"
         return 0, 0, ''
 
+    def handle_set_vbucket_state(self, cmd, hdrs, key, cas, data):
+        """Only an active vbucket is served here."""
+        if data == 'active':
+            self.deadVBuckets.discard(int(key))
+        else:
+            self.deadVBuckets.add(int(key))
+        return 0, 0, ''
+
     def handle_unknown(self, cmd, hdrs, key, cas, data):
         """invoked for any unknown command."""
         return self._error(memcacheConstants.ERR_UNKNOWN_CMD,
             "The command %d is unknown" % cmd)
 
+class SetItem(set):
+    """The value of a set collection item."""
+
+    DEFAULT_MAXCOUNT = 4000
+    MAX_MAXCOUNT = 50000
+
+    def __init__(self, maxcount):
+        super(SetItem, self).__init__()
+        if maxcount == 0:
+            maxcount=self.DEFAULT_MAXCOUNT
+        self.maxcount=min(maxcount, self.MAX_MAXCOUNT)
+
 class DictBackend(BaseBackend):
     """Sample backend implementation with a non-expiring dict."""
 
@@ -119,11 +244,19 @@ class DictBackend(BaseBackend):
             print "Miss looking up", key
         return rv
 
+    def lookupKV(self, key):
+        """Get the (flags, exp, value) of a key's plain item, or None."""
+        val=self.__lookup(key)
+        if val and not isinstance(val[2], SetItem):
+            return val
+        return None
+
     def handle_get(self, cmd, hdrs, key, cas, data):
         val=self.__lookup(key)
-        if val:
-            rv = 0, id(val), struct.pack(
-                memcacheConstants.GET_RES_FMT, val[0]) + str(val[2])
+        if val and isinstance(val[2], SetItem):
+            rv=self._error(memcacheConstants.ERR_BADTYPE, 'Bad type')
+        elif val:
+            rv = 0, id(val), memcacheConstants.GET_RES.pack(val[0]) + str(val[2])
         else:
             rv=self._error(memcacheConstants.ERR_NOT_FOUND, 'Not found')
         return rv
@@ -169,8 +302,7 @@ class DictBackend(BaseBackend):
                 self.storage[key]=(0, time.time() + expiration, initial)
                 rv=0, id(self.storage[key]), str(initial)
         if rv[0] == 0:
-            rv = rv[0], rv[1], struct.pack(
-                memcacheConstants.INCRDECR_RES_FMT, long(rv[2]))
+            rv = rv[0], rv[1], memcacheConstants.INCRDECR_RES.pack(long(rv[2]))
         print "Returning", rv
         return rv
 
@@ -208,6 +340,7 @@ class DictBackend(BaseBackend):
         def f():
             self.storage.clear()
             self.held_keys.clear()
+            self._changed(None)
             print "Flushed"
         if timebomb_delay:
             heapq.heappush(self.sched, (time.time() + timebomb_delay, f))
@@ -228,6 +361,14 @@ class DictBackend(BaseBackend):
     def handle_version(self, cmd, hdrs, key, cas, data):
         return 0, 0, "Python test memcached server %s" % VERSION
 
+    def stats(self, group):
+        rv=super(DictBackend, self).stats(group)
+        if rv is not None:
+            rv['curr_items']=len(self.storage)
+            rv['bytes']=sum(len(str(v[2])) for v in self.storage.itervalues()
+                            if not isinstance(v[2], SetItem))
+        return rv
+
     def _withCAS(self, key, cas, f):
         val=self.storage.get(key, None)
         if cas == 0 or (val and cas == id(val)):
@@ -291,25 +432,154 @@ class DictBackend(BaseBackend):
             print "Unhandled auth type:  %s" % mech
             return self._error(memcacheConstants.ERR_AUTH, 'Auth error.')
 
+    def __set_lookup(self, key):
+        """Look up a set, returning (set, flags, None) or (None, None, error)."""
+        val=self.__lookup(key)
+        if not val:
+            return None, None, self._error(memcacheConstants.ERR_NOT_FOUND,
+                                           'Not found')
+        if not isinstance(val[2], SetItem):
+            return None, None, self._error(memcacheConstants.ERR_BADTYPE,
+                                           'Bad type')
+        return val[2], val[0], None
+
+    def handle_getattr(self, cmd, hdrs, key, cas, data):
+        val=self.__lookup(key)
+        if not val:
+            return self._error(memcacheConstants.ERR_NOT_FOUND, 'Not found')
+        flags, exp, item=val
+        exptime=0
+        if exp < 2 ** 31:
+            exptime=max(1, int(exp - time.time()))
+        if isinstance(item, SetItem):
+            attrs=(memcacheConstants.ITEM_TYPE_SET, len(item), item.maxcount)
+        else:
+            attrs=(memcacheConstants.ITEM_TYPE_KV, 0, 0)
+        type, count, maxcount=attrs
+        return 0, 0, memcacheConstants.GETATTR_RES.pack(flags,
+                                 exptime, count, maxcount, 0, type,
+                                 memcacheConstants.OVFL_ERROR, 0, 0)
+
+    def handle_setattr(self, cmd, hdrs, key, cas, data):
+        exptime, maxcount, maxbkeyrange, ovflaction, exptime_f, maxcount_f=\
+            hdrs[:6]
+        val=self.__lookup(key)
+        if not val:
+            return self._error(memcacheConstants.ERR_NOT_FOUND, 'Not found')
+        flags, exp, item=val
+        if maxcount_f and not isinstance(item, SetItem):
+            return self._error(memcacheConstants.ERR_BADATTR, 'Bad attr')
+        if maxcount_f:
+            item.maxcount=min(maxcount or item.DEFAULT_MAXCOUNT,
+                              item.MAX_MAXCOUNT)
+        if exptime_f:
+            exp=float(2 ** 31)
+            if exptime:
+                exp=time.time() + exptime
+            self.storage[key]=(flags, exp, item)
+        return 0, 0, ''
+
+    def __set_create(self, key, flags, exp, maxcount):
+        if exp == 0:
+            exp=float(2 ** 31)
+        self.storage[key]=(flags, time.time() + exp, SetItem(maxcount))
+        return self.storage[key][2]
+
+    def handle_sop_create(self, cmd, hdrs, key, cas, data):
+        flags, exp, maxcount=hdrs
+        if self.__lookup(key):
+            return self._error(memcacheConstants.ERR_EXISTS, 'Exists')
+        self.__set_create(key, flags, exp, maxcount)
+        return 0, 0, ''
+
+    def handle_sop_insert(self, cmd, hdrs, key, cas, data):
+        flags, exp, maxcount, create=hdrs[:4]
+        items, iflags, err=self.__set_lookup(key)
+        if items is None and create \
+                and err[0] == memcacheConstants.ERR_NOT_FOUND:
+            items=self.__set_create(key, flags, exp, maxcount)
+        elif items is None:
+            return err
+        if data in items:
+            return self._error(memcacheConstants.ERR_ELEM_EXISTS, 'Exists')
+        if len(items) >= items.maxcount:
+            return self._error(memcacheConstants.ERR_OVERFLOW, 'Overflow')
+        items.add(data)
+        return 0, 0, ''
+
+    def handle_sop_delete(self, cmd, hdrs, key, cas, data):
+        drop_if_empty=hdrs[0]
+        items, flags, err=self.__set_lookup(key)
+        if items is None:
+            return err
+        if data not in items:
+            return self._error(memcacheConstants.ERR_ELEM_NOENT, 'Not found')
+        items.remove(data)
+        if drop_if_empty and not items:
+            del self.storage[key]
+        return 0, 0, ''
+
+    def handle_sop_exist(self, cmd, hdrs, key, cas, data):
+        items, flags, err=self.__set_lookup(key)
+        if items is None:
+            return err
+        return 0, 0, memcacheConstants.EXIST_RES.pack(
+                                 int(data in items))
+
+    def handle_sop_exist_multi(self, cmd, hdrs, key, cas, data):
+        items, flags, err=self.__set_lookup(key)
+        if items is None:
+            return err
+        rv=[]
+        offset=0
+        while offset < len(data):
+            n=memcacheConstants.VLENG_RES.unpack_from(data,
+                                 offset)[0]
+            offset += 4
+            rv.append(data[offset:offset + n] in items and '\x01' or '\x00')
+            offset += n
+        return 0, 0, ''.join(rv)
+
+    def handle_sop_get(self, cmd, hdrs, key, cas, data):
+        count, delete, drop_if_empty=hdrs[:3]
+        items, flags, err=self.__set_lookup(key)
+        if items is None:
+            return err
+        if not items:
+            return self._error(memcacheConstants.ERR_ELEM_NOENT, 'Not found')
+        vals=list(items)
+        if count:
+            vals=vals[:count]
+        if delete:
+            items.difference_update(vals)
+            if drop_if_empty and not items:
+                del self.storage[key]
+        return 0, 0, ''.join([memcacheConstants.COLL_GET_RES.pack(flags, len(vals)),
+            struct.pack('>%dL' % len(vals), *[len(v) for v in vals])] + vals)
+
 class MemcachedBinaryChannel(asyncore.dispatcher):
     """A channel implementing the binary protocol for memcached."""
 
     # Receive buffer size
     BUFFER_SIZE = 4096
+    # TAP messages are only queued while wbuf holds less than this.
+    TAP_HIGH_WATER = 256 * 1024
 
     def __init__(self, channel, backend, wbuf=""):
         asyncore.dispatcher.__init__(self, channel)
         self.log_info("New bin connection from %s" % str(self.addr))
         self.backend=backend
-        self.wbuf=wbuf
+        self.wbuf=bytearray(wbuf)
         self.rbuf=""
+        # Keys waiting to be sent to a TAP consumer, once this is one.
+        self.tapKeys=None
 
-    def __hasEnoughBytes(self):
+    def __hasEnoughBytes(self, pos):
         rv=False
-        if len(self.rbuf) >= MIN_RECV_PACKET:
+        if len(self.rbuf) - pos >= MIN_RECV_PACKET:
             magic, cmd, keylen, extralen, datatype, vb, remaining, opaque, cas=\
-                struct.unpack(REQ_PKT_FMT, self.rbuf[:MIN_RECV_PACKET])
-            rv = len(self.rbuf) - MIN_RECV_PACKET >= remaining
+                REQ_PKT.unpack_from(self.rbuf, pos)
+            rv = len(self.rbuf) - pos - MIN_RECV_PACKET >= remaining
         return rv
 
     def processCommand(self, cmd, keylen, vb, extralen, cas, data):
@@ -317,19 +587,31 @@ class MemcachedBinaryChannel(asyncore.dispatcher):
 
     def handle_read(self):
         self.rbuf += self.recv(self.BUFFER_SIZE)
-        while self.__hasEnoughBytes():
+        # Requests are parsed in place and the buffer trimmed once at the end.
+        pos=0
+        while self.__hasEnoughBytes(pos):
             magic, cmd, keylen, extralen, datatype, vb, remaining, opaque, cas=\
-                struct.unpack(REQ_PKT_FMT, self.rbuf[:MIN_RECV_PACKET])
+                REQ_PKT.unpack_from(self.rbuf, pos)
+            if magic == RES_MAGIC_BYTE and self.tapKeys is not None:
+                # A TAP consumer's ack; the stream isn't throttled by them.
+                pos += MIN_RECV_PACKET + remaining
+                continue
             assert magic == REQ_MAGIC_BYTE
             assert keylen <= remaining, "Keylen is too big: %d > %d" \
                 % (keylen, remaining)
             assert extralen == memcacheConstants.EXTRA_HDR_SIZES.get(cmd, 0), \
                 "Extralen is too large for cmd 0x%x: %d" % (cmd, extralen)
             # Grab the data section of this request
-            data=self.rbuf[MIN_RECV_PACKET:MIN_RECV_PACKET+remaining]
+            start=pos + MIN_RECV_PACKET
+            data=self.rbuf[start:start + remaining]
             assert len(data) == remaining
-            # Remove this request from the read buffer
-            self.rbuf=self.rbuf[MIN_RECV_PACKET+remaining:]
+            pos=start + remaining
+            if cmd == memcacheConstants.CMD_TAP_CONNECT:
+                self.startTap(keylen, data)
+                continue
+            if cmd == memcacheConstants.CMD_STAT:
+                self.sendStats(data[:keylen], opaque)
+                continue
             # Process the command
             cmdVal = self.processCommand(cmd, keylen, vb, extralen, cas, data)
             # Queue the response to the client if applicable.
@@ -341,20 +623,131 @@ class MemcachedBinaryChannel(asyncore.dispatcher):
                     raise
                 dtype=0
                 extralen=memcacheConstants.EXTRA_HDR_SIZES.get(cmd, 0)
-                self.wbuf += struct.pack(RES_PKT_FMT,
+                self.wbuf += RES_PKT.pack(
                     RES_MAGIC_BYTE, cmd, keylen,
                     extralen, dtype, status,
-                    len(response), opaque, cas) + response
+                    len(response), opaque, cas)
+                self.wbuf += response
+        self.rbuf=self.rbuf[pos:]
+
+    def sendStats(self, group, opaque):
+        """Answer a stats request with a response per stat, ended by an
+        empty one."""
+        stats=self.backend.stats(group)
+        if stats is None:
+            msg='Unknown stats group'
+            self.wbuf += RES_PKT.pack(RES_MAGIC_BYTE, memcacheConstants.CMD_STAT,
+                0, 0, 0, memcacheConstants.ERR_NOT_FOUND, len(msg), opaque, 0)
+            self.wbuf += msg
+            return
+        for k, v in sorted(stats.items()) + [('', '')]:
+            v=str(v)
+            self.wbuf += RES_PKT.pack(RES_MAGIC_BYTE, memcacheConstants.CMD_STAT,
+                len(k), 0, 0, 0, len(k) + len(v), opaque, 0)
+            self.wbuf += k + v
+
+    def startTap(self, keylen, data):
+        """Turn this connection into the producer of a TAP stream.
+
+        Keys to send are queued in tapKeys, and their current item is only
+        encoded when there's room in wbuf, so a slow consumer holds back
+        the stream instead of growing wbuf.  A key changed again before
+        it's sent is only sent once."""
+        hdrStruct=EXTRA_HDR_STRUCTS[memcacheConstants.CMD_TAP_CONNECT]
+        flags=hdrStruct.unpack_from(data)[0]
+        pos=hdrStruct.size + keylen
+        self.log_info("TAP connect %r with flags 0x%x" % (
+            data[hdrStruct.size:pos], flags))
+        backfill=None
+        if flags & memcacheConstants.TAP_FLAG_BACKFILL:
+            backfill=struct.unpack_from('>Q', data, pos)[0]
+            pos += 8
+        self.tapVBuckets=None
+        if flags & memcacheConstants.TAP_FLAG_LIST_VBUCKETS:
+            n=struct.unpack_from('>H', data, pos)[0]
+            self.tapVBuckets=frozenset(
+                struct.unpack_from('>%dH' % n, data, pos + 2))
+        self.tapDump=bool(flags & memcacheConstants.TAP_FLAG_DUMP)
+        self.tapKeysOnly=bool(flags & memcacheConstants.TAP_FLAG_KEYS_ONLY)
+        self.tapFlush=False
+        self.tapOpaque=0
+        self.tapKeys=collections.OrderedDict()
+        if self.tapDump:
+            for key in self.backend.storage.keys():
+                if self.backend.lookupKV(key) is not None:
+                    self.__tapChanged(key)
+        elif backfill is not None:
+            for key, (when, vb) in self.backend.changes.items():
+                if when >= backfill:
+                    self.__tapChanged(key)
+        if not self.tapDump:
+            self.backend.listeners.append(self.__tapChanged)
+
+    def __tapChanged(self, key):
+        if key is None:
+            # Whatever was pending is gone now.
+            self.tapKeys.clear()
+            self.tapFlush=True
+            return
+        vb=self.backend.changes.get(key, (0, 0))[1]
+        if self.tapVBuckets is None or vb in self.tapVBuckets:
+            self.tapKeys[key]=vb
+
+    def __tapMessage(self, cmd, vb, extras, key, value=''):
+        self.tapOpaque += 1
+        self.wbuf += REQ_PKT.pack(REQ_MAGIC_BYTE, cmd, len(key), len(extras),
+                                  0, vb, len(extras) + len(key) + len(value),
+                                  self.tapOpaque, 0)
+        self.wbuf += extras
+        self.wbuf += key
+        self.wbuf += value
+
+    def __tapFill(self):
+        """Queue pending TAP messages until wbuf reaches its high water."""
+        if self.tapFlush:
+            self.tapFlush=False
+            self.__tapMessage(memcacheConstants.CMD_TAP_FLUSH, 0,
+                              memcacheConstants.TAP_GENERAL_PKT.pack(0, 0, 0),
+                              '')
+        while self.tapKeys and len(self.wbuf) < self.TAP_HIGH_WATER:
+            key, vb=self.tapKeys.popitem(last=False)
+            val=self.backend.lookupKV(key)
+            if val is None:
+                self.__tapMessage(memcacheConstants.CMD_TAP_DELETE, vb,
+                    memcacheConstants.TAP_GENERAL_PKT.pack(0, 0, 0), key)
+                continue
+            flags, exp, value=val
+            exp=exp < 2 ** 31 and int(exp) or 0
+            tapflags=0
+            if self.tapKeysOnly:
+                tapflags=memcacheConstants.TAP_MSG_FLAG_NO_VALUE
+                value=''
+            self.__tapMessage(memcacheConstants.CMD_TAP_MUTATION, vb,
+                memcacheConstants.TAP_MUTATION_PKT.pack(0, tapflags, 0,
+                                                        flags, exp),
+                key, str(value))
+
+    def __tapDumped(self):
+        return self.tapKeys is not None and self.tapDump and not self.tapKeys
 
     def writable(self):
-        return self.wbuf
+        if self.tapKeys is not None:
+            self.__tapFill()
+        # A finished dump still needs a write to close the connection.
+        return self.wbuf or self.__tapDumped()
 
     def handle_write(self):
         sent = self.send(self.wbuf)
-        self.wbuf = self.wbuf[sent:]
+        del self.wbuf[:sent]
+        if not self.wbuf and self.__tapDumped():
+            self.log_info("TAP dump complete")
+            self.handle_close()
 
     def handle_close(self):
         self.log_info("Disconnected from %s" % str(self.addr))
+        if self.tapKeys is not None and not self.tapDump:
+            self.backend.listeners.remove(self.__tapChanged)
+            self.tapKeys=None
         self.close()
 
 class MemcachedServer(asyncore.dispatcher):